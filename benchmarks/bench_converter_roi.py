@@ -0,0 +1,87 @@
+#times ConverterMasked.convert_face with region of interest compositing against the whole frame path
+#and against ConverterMasked of baseline git revision, and compares outputs
+#run from repository root: python benchmarks/bench_converter_roi.py [baseline revision, first commit by default]
+import sys
+import time
+import types
+import subprocess
+from pathlib import Path
+import numpy as np
+import cv2
+
+root_path = Path(__file__).resolve().parent.parent
+sys.path.insert (0, str(root_path))
+from facelib import LandmarksProcessor
+from facelib import FaceType
+from models.ConverterMasked import ConverterMasked
+
+def load_baseline(revision):
+    #ConverterMasked class of models/ConverterMasked.py at git revision, it imports current facelib and utils
+    if revision is None:
+        revision = subprocess.check_output ( ['git', 'rev-list', '--max-parents=0', 'HEAD'], cwd=str(root_path) ).decode().split()[0]
+    source = subprocess.check_output ( ['git', 'show', '%s:models/ConverterMasked.py' % (revision)], cwd=str(root_path) ).decode('utf-8')
+    module = types.ModuleType ('baseline_ConverterMasked')
+    exec (compile (source, 'baseline_ConverterMasked.py', 'exec'), module.__dict__)
+    return revision, module.ConverterMasked
+
+def get_landmarks(cx, cy, size):
+    #68 points: jaw arc and mean face for the rest
+    angles = np.linspace (np.pi, 0, 17)
+    jaw = np.stack ( [ 0.5 - 0.55*np.cos(angles), 0.35 + 0.65*np.sin(angles) ], axis=1 )
+    face = np.stack ( [LandmarksProcessor.mean_face_x, LandmarksProcessor.mean_face_y], axis=1 )
+    pts = np.concatenate ( [jaw, face], axis=0 )
+    return ( (pts - 0.5) * size + (cx, cy) ).astype(np.int32)
+
+def predictor(bgra):
+    #face is returned as it came, mask of dst face is used as predicted mask
+    #batched and single inputs are returned as they came, so predictor works with baseline converter too
+    return bgra.copy()
+
+def timeit(func, repeats):
+    t = time.time()
+    for i in range(repeats):
+        result = func()
+    return (time.time() - t) / repeats, result
+
+def convert_baseline(converter, frame, landmarks):
+    #baseline converter took float32 frame and returned float32 frame, converted to uint8 by converter process
+    image = frame.astype(np.float32) / 255.0
+    image = converter.convert_face (image, landmarks, False)
+    image *= 255
+    return image.astype(np.uint8)
+
+def print_result(name, t_from, t_to, r_from, r_to):
+    diff = np.abs (r_from.astype(np.int32) - r_to)
+    print ("  %s: %.0f ms -> %.0f ms, pixels off by more than 1: %d, max difference %d" % (name, t_from*1000, t_to*1000, (diff.max(axis=-1) > 1).sum(), diff.max() ) )
+
+def main():
+    revision, BaselineConverterMasked = load_baseline ( sys.argv[1] if len(sys.argv) > 1 else None )
+    print ("baseline is %s" % (revision) )
+
+    rnd = np.random.RandomState(0)
+    for frame_w, frame_h in [ (1920, 1080), (3840, 2160) ]:
+        #smooth frame like a photo, on noise subpixel differences of warps are large
+        frame = cv2.resize ( rnd.uniform (0, 1, (frame_h // 32, frame_w // 32, 3)).astype(np.float32), (frame_w, frame_h), interpolation=cv2.INTER_CUBIC )
+        np.clip (frame, 0, 1, out=frame)
+        frame = (frame*255).astype(np.uint8)
+        landmarks = get_landmarks (frame_w // 2, frame_h // 2, frame_h // 4)
+
+        for mode in ['seamless', 'hist-match', 'seamless-hist-match']:
+            options = dict (predictor_input_size=128, output_size=128, face_type=FaceType.FULL, mode=mode, erode_mask_modifier=30, blur_mask_modifier=30)
+
+            converter = BaselineConverterMasked (predictor, **options)
+            t_base, r_base = timeit ( lambda: convert_baseline (converter, frame, landmarks), 3 )
+
+            results = []
+            for use_roi in [False, True]:
+                converter = ConverterMasked (predictor, use_roi=use_roi, **options)
+                #face is pasted to frame in place
+                results.append ( timeit ( lambda: converter.convert_face (frame.copy(), landmarks, False), 3 ) )
+            (t_full, r_full), (t_roi, r_roi) = results
+
+            print ("%dx%d %s" % (frame_w, frame_h, mode) )
+            print_result ("baseline -> whole frame", t_base, t_full, r_base, r_full)
+            print_result ("baseline -> roi        ", t_base, t_roi, r_base, r_roi)
+
+if __name__ == "__main__":
+    main()
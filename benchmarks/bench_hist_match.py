@@ -0,0 +1,63 @@
+#times image_utils.color_hist_match against the np.unique implementation it replaced, and compares outputs
+#run from repository root: python benchmarks/bench_hist_match.py
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import cv2
+
+sys.path.insert (0, str(Path(__file__).resolve().parent.parent))
+from utils import image_utils
+
+def channel_hist_match_unique(source, template):
+    oldshape = source.shape
+    source = source.ravel()
+    template = template.ravel()
+    s_values, bin_idx, s_counts = np.unique(source, return_inverse=True, return_counts=True)
+    t_values, t_counts = np.unique(template, return_counts=True)
+    s_quantiles = np.cumsum(s_counts).astype(np.float64)
+    s_quantiles /= s_quantiles[-1]
+    t_quantiles = np.cumsum(t_counts).astype(np.float64)
+    t_quantiles /= t_quantiles[-1]
+    interp_t_values = np.interp(s_quantiles, t_quantiles, t_values)
+    return interp_t_values[bin_idx].reshape(oldshape)
+
+def color_hist_match_unique(src_im, tar_im):
+    return np.stack ( [ channel_hist_match_unique(src_im[:,:,i], tar_im[:,:,i]) for i in range(3) ], axis=-1 ).astype(src_im.dtype)
+
+def get_face(rnd, size):
+    #smooth image with noise, like predicted face
+    img = cv2.resize ( rnd.uniform (0, 1, (8, 8, 3)).astype(np.float32), (size, size), interpolation=cv2.INTER_CUBIC )
+    img += rnd.normal (0, 0.02, img.shape).astype(np.float32)
+    return np.clip (img, 0, 1)
+
+def get_mask(size):
+    mask = np.zeros ( (size, size), dtype=np.float32 )
+    cv2.ellipse (mask, (size//2, size//2), (size*3//8, size*7//16), 0, 0, 360, 1, -1)
+    return cv2.blur (mask, (size//16, size//16))[...,np.newaxis]
+
+def timeit(func, repeats):
+    t = time.time()
+    for i in range(repeats):
+        result = func()
+    return (time.time() - t) / repeats, result
+
+def main():
+    rnd = np.random.RandomState(0)
+    for size in [64, 128, 256]:
+        src = get_face (rnd, size)
+        tar = get_face (rnd, size)
+        mask = get_mask (size)
+
+        t_old, r_old = timeit ( lambda: color_hist_match_unique(src, tar), 10 )
+        t_new, r_new = timeit ( lambda: image_utils.color_hist_match(src, tar), 10 )
+        diff = np.abs (r_old - r_new)
+        print ("%dx%d: %.1f ms -> %.1f ms, mean difference %.5f, values off by more than 1/255: %d of %d" % (size, size, t_old*1000, t_new*1000, diff.mean(), (diff > 1/255.0).sum(), diff.size) )
+
+        #masked: old way multiplied faces by mask, now mask weights pixels
+        t_old, r_old = timeit ( lambda: color_hist_match_unique(src*mask, tar*mask), 10 )
+        t_new, r_new = timeit ( lambda: image_utils.color_hist_match(src, tar, mask=mask), 10 )
+        print ("%dx%d masked: %.1f ms -> %.1f ms" % (size, size, t_old*1000, t_new*1000) )
+
+if __name__ == "__main__":
+    main()
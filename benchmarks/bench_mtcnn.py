@@ -0,0 +1,85 @@
+#times mtcnn nms and crop_boxes against the per box loops they replaced, and checks results are the same
+#run from repository root: python benchmarks/bench_mtcnn.py
+import sys
+import time
+from pathlib import Path
+import numpy as np
+
+sys.path.insert (0, str(Path(__file__).resolve().parent.parent))
+from facelib import mtcnn
+
+def nms_loop(boxes, threshold, method):
+    x1 = boxes[:,0]
+    y1 = boxes[:,1]
+    x2 = boxes[:,2]
+    y2 = boxes[:,3]
+    s = boxes[:,4]
+    area = (x2-x1+1) * (y2-y1+1)
+    I = np.argsort(s)
+    pick = []
+    while I.size>0:
+        i = I[-1]
+        pick.append(i)
+        idx = I[0:-1]
+        xx1 = np.maximum(x1[i], x1[idx])
+        yy1 = np.maximum(y1[i], y1[idx])
+        xx2 = np.minimum(x2[i], x2[idx])
+        yy2 = np.minimum(y2[i], y2[idx])
+        w = np.maximum(0.0, xx2-xx1+1)
+        h = np.maximum(0.0, yy2-yy1+1)
+        inter = w * h
+        if method == 'Min':
+            o = inter / np.minimum(area[i], area[idx])
+        else:
+            o = inter / (area[i] + area[idx] - inter)
+        I = I[np.where(o<=threshold)]
+    return np.array(pick)
+
+def crop_boxes_loop(img, total_boxes, w, h, size):
+    dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = mtcnn.pad(total_boxes.copy(), w, h)
+    numbox = total_boxes.shape[0]
+    tempimg = np.zeros((size,size,3,numbox))
+    for k in range(0,numbox):
+        tmp = np.zeros((int(tmph[k]),int(tmpw[k]),3))
+        tmp[dy[k]-1:edy[k],dx[k]-1:edx[k],:] = img[y[k]-1:ey[k],x[k]-1:ex[k],:]
+        if tmp.shape[0]>0 and tmp.shape[1]>0:
+            tempimg[:,:,:,k] = mtcnn.imresample(tmp, (size, size))
+    tempimg = (tempimg-127.5)*0.0078125
+    return np.transpose(tempimg, (3,1,0,2))
+
+def random_boxes(rnd, count, w, h):
+    #centers are inside of image, boxes may cross its border
+    size = rnd.uniform (12, 200, count)
+    x1 = rnd.uniform (0, w, count) - size / 2
+    y1 = rnd.uniform (0, h, count) - size / 2
+    return np.stack ( [x1, y1, x1+size, y1+size, rnd.uniform(0, 1, count)], axis=1 )
+
+def timeit(func, repeats):
+    t = time.time()
+    for i in range(repeats):
+        result = func()
+    return (time.time() - t) / repeats, result
+
+def main():
+    rnd = np.random.RandomState(0)
+    w, h = 1920, 1080
+    img = rnd.randint (0, 256, (h, w, 3)).astype(np.uint8)
+
+    for count in [500, 3000, 10000]:
+        boxes = random_boxes (rnd, count, w, h)
+        for method in ['Union', 'Min']:
+            t_old, r_old = timeit ( lambda: nms_loop(boxes, 0.5, method), 3 )
+            t_new, r_new = timeit ( lambda: mtcnn.nms(boxes, 0.5, method), 3 )
+            assert np.array_equal (r_old, r_new)
+            print ("nms %s, %d boxes: %.4fs -> %.4fs" % (method, count, t_old, t_new) )
+
+    boxes = random_boxes (rnd, 2000, w, h)
+    boxes = mtcnn.rerec(boxes)
+    boxes[:,0:4] = np.fix(boxes[:,0:4]).astype(np.int32)
+    for size in [24, 48]:
+        t_old, r_old = timeit ( lambda: crop_boxes_loop(img, boxes, w, h, size), 3 )
+        t_new, r_new = timeit ( lambda: mtcnn.crop_boxes(img, boxes, w, h, size), 3 )
+        print ("crop_boxes 2000 boxes to %dx%d: %.4fs -> %.4fs, max difference %g" % (size, size, t_old, t_new, np.abs(r_old - r_new).max()) )
+
+if __name__ == "__main__":
+    main()
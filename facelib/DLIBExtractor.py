@@ -38,3 +38,6 @@ class DLIBExtractor(object):
             result.append ( (int(left/input_scale), int(top/input_scale), int(right/input_scale), int(bottom/input_scale)) )
 
         return result
+
+    def extract_from_bgr_batch (self, input_images):
+        return [ self.extract_from_bgr (input_image) for input_image in input_images ]
@@ -37,25 +37,39 @@ def crop(image, center, scale, resolution=256.0):
     newImg = cv2.resize(newImg, dsize=(int(resolution), int(resolution)), interpolation=cv2.INTER_LINEAR)
     return newImg
            
+def transform_points(points, center, scale, resolution):
+    h = 200.0 * scale
+    m = np.eye(3)
+    m[0,0] = resolution / h
+    m[1,1] = resolution / h
+    m[0,2] = resolution * ( -center[0] / h + 0.5 )
+    m[1,2] = resolution * ( -center[1] / h + 0.5 )
+    m = np.linalg.inv(m)
+    return np.matmul (points, m[0:2,0:2].T) + m[0:2,2]
+
 def get_pts_from_predict(a, center, scale):
-    b = a.reshape ( (a.shape[0], a.shape[1]*a.shape[2]) )    
-    c = b.argmax(1).reshape ( (a.shape[0], 1) ).repeat(2, axis=1).astype(np.float)
-    c[:,0] %= a.shape[2]    
-    c[:,1] = np.apply_along_axis ( lambda x: np.floor(x / a.shape[2]), 0, c[:,1] )
-
-    for i in range(a.shape[0]):
-        pX, pY = int(c[i,0]), int(c[i,1])
-        if pX > 0 and pX < 63 and pY > 0 and pY < 63:
-            diff = np.array ( [a[i,pY,pX+1]-a[i,pY,pX-1], a[i,pY+1,pX]-a[i,pY-1,pX]] )
-            c[i] += np.sign(diff)*0.25
-   
+    a_ch, a_h, a_w = a.shape
+
+    b = a.reshape ( (a_ch, a_h*a_w) )
+    c = b.argmax(1).reshape ( (a_ch, 1) ).repeat(2, axis=1).astype(np.float64)
+    c[:,0] %= a_w
+    c[:,1] = np.floor(c[:,1] / a_w)
+
+    #shift by quarter pixel to the higher neighbour, same as per landmark loop did
+    pX, pY = c[:,0].astype(np.int32), c[:,1].astype(np.int32)
+    inner = np.where ( (pX > 0) & (pX < a_w-1) & (pY > 0) & (pY < a_h-1) )[0]
+    pX, pY = pX[inner], pY[inner]
+    diff = np.stack ( [a[inner,pY,pX+1]-a[inner,pY,pX-1], a[inner,pY+1,pX]-a[inner,pY-1,pX]], axis=-1 )
+    c[inner] += np.sign(diff)*0.25
+
     c += 0.5
-    return [ transform (c[i], center, scale, a.shape[2]) for i in range(a.shape[0]) ]
+    return transform_points (c, center, scale, a_w)
 
     
 class LandmarksExtractor(object):
-    def __init__ (self, keras):
+    def __init__ (self, keras, batch_size=16):
         self.keras = keras
+        self.batch_size = batch_size
         K = self.keras.backend
         class TorchBatchNorm2D(self.keras.engine.topology.Layer):
             def __init__(self, axis=-1, momentum=0.99, epsilon=1e-3, **kwargs):
@@ -110,24 +124,38 @@ class LandmarksExtractor(object):
         return False #pass exception between __enter__ and __exit__ to outter level
         
     def extract_from_bgr (self, input_image, rects):
-        input_image = input_image[:,:,::-1].copy()
-        (h, w, ch) = input_image.shape
-        
-        landmarks = []
-        for (left, top, right, bottom) in rects:
-            
-            center = np.array( [ (left + right) / 2.0, (top + bottom) / 2.0] )
-            center[1] -= (bottom - top) * 0.12
-            scale = (right - left + bottom - top) / 195.0
-        
-            image = crop(input_image, center, scale).transpose ( (2,0,1) ).astype(np.float32) / 255.0
-            image = np.expand_dims(image, 0)
-            
+        return self.extract_from_bgr_batch ( [input_image], [rects] )[0]
+
+    def extract_from_bgr_batch (self, input_images, rects_list):
+        #crops faces of all images, predicts them in batches of self.batch_size
+        crops = []
+        crops_info = []
+        for input_image, rects in zip(input_images, rects_list):
+            input_image = input_image[:,:,::-1]
+            for (left, top, right, bottom) in rects:
+                center = np.array( [ (left + right) / 2.0, (top + bottom) / 2.0] )
+                center[1] -= (bottom - top) * 0.12
+                scale = (right - left + bottom - top) / 195.0
+
+                crops.append ( crop(input_image, center, scale).transpose ( (2,0,1) ) )
+                crops_info.append ( ( (left, top, right, bottom), center, scale) )
+
+        predicted = []
+        if len(crops) > 0:
+            crops = np.array(crops, dtype=np.float32) / 255.0
             with std_utils.suppress_stdout_stderr():
-                predicted = self.keras_model.predict (image)
-                
-            pts_img = get_pts_from_predict ( predicted[-1][0], center, scale)
-            pts_img = [ ( int(pt[0]), int(pt[1]) ) for pt in pts_img ]             
-            landmarks.append ( ( (left, top, right, bottom),pts_img ) )
-   
-        return landmarks
+                predicted = self.keras_model.predict (crops, batch_size=self.batch_size)[-1]
+
+        result = []
+        i = 0
+        for rects in rects_list:
+            landmarks = []
+            for _ in rects:
+                rect, center, scale = crops_info[i]
+                pts_img = get_pts_from_predict ( predicted[i], center, scale)
+                pts_img = [ ( int(pt[0]), int(pt[1]) ) for pt in pts_img ]
+                landmarks.append ( ( rect, pts_img ) )
+                i += 1
+            result.append (landmarks)
+
+        return result
@@ -52,15 +52,21 @@ class MTCExtractor(object):
         return False #pass exception between __enter__ and __exit__ to outter level
         
     def extract_from_bgr (self, input_image):
-        input_image = input_image[:,:,::-1].copy()
-        (h, w, ch) = input_image.shape
+        return self.extract_from_bgr_batch ( [input_image] )[0]
 
+    def extract_from_bgr_batch (self, input_images):
+        #same-sized frames are detected together, so every pyramid scale runs once per group
+        groups = {}
+        for i, input_image in enumerate(input_images):
+            groups.setdefault ( input_image.shape, [] ).append (i)
 
-        input_scale = self.scale_to / (w if w > h else h)
-        input_image = cv2.resize (input_image, ( int(w*input_scale), int(h*input_scale) ), interpolation=cv2.INTER_LINEAR)
+        result = [None] * len(input_images)
+        for (h, w, ch), idxs in groups.items():
+            input_scale = self.scale_to / (w if w > h else h)
+            images = [ cv2.resize (input_images[i][:,:,::-1], ( int(w*input_scale), int(h*input_scale) ), interpolation=cv2.INTER_LINEAR) for i in idxs ]
 
-        detected_faces, pnts = detect_face ( input_image, self.min_face_size, self.pnet_fun, self.rnet_fun, self.onet_fun, [ self.thresh1, self.thresh2, self.thresh3 ], self.scale_factor )
-        detected_faces = [ ( int(face[0]/input_scale), int(face[1]/input_scale), int(face[2]/input_scale), int(face[3]/input_scale)) for face in detected_faces ]
-          
-        return detected_faces
+            detected = detect_face_batch ( images, self.min_face_size, self.pnet_fun, self.rnet_fun, self.onet_fun, [ self.thresh1, self.thresh2, self.thresh3 ], self.scale_factor )
+            for i, (detected_faces, pnts) in zip(idxs, detected):
+                result[i] = [ ( int(face[0]/input_scale), int(face[1]/input_scale), int(face[2]/input_scale), int(face[3]/input_scale)) for face in detected_faces ]
 
+        return result
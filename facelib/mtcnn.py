@@ -302,8 +302,9 @@ def detect_face(img, minsize, pnet, rnet, onet, threshold, factor):
         hs=int(np.ceil(h*scale))
         ws=int(np.ceil(w*scale))
         #print ('scale %f %d %d' % (scale, ws,hs))
-        im_data = imresample(img, (hs, ws))
-        im_data = (im_data-127.5)*0.0078125
+        im_data = imresample(img, (hs, ws)).astype(np.float32)
+        im_data -= 127.5
+        im_data *= 0.0078125
         img_x = np.expand_dims(im_data, 0)
         img_y = np.transpose(img_x, (0,2,1,3))
         out = pnet([img_y])
@@ -331,21 +332,11 @@ def detect_face(img, minsize, pnet, rnet, onet, threshold, factor):
         total_boxes = np.transpose(np.vstack([qq1, qq2, qq3, qq4, total_boxes[:,4]]))
         total_boxes = rerec(total_boxes.copy())
         total_boxes[:,0:4] = np.fix(total_boxes[:,0:4]).astype(np.int32)
-        dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(total_boxes.copy(), w, h)
 
     numbox = total_boxes.shape[0]
     if numbox>0:
         # second stage
-        tempimg = np.zeros((24,24,3,numbox))
-        for k in range(0,numbox):
-            tmp = np.zeros((int(tmph[k]),int(tmpw[k]),3))
-            tmp[dy[k]-1:edy[k],dx[k]-1:edx[k],:] = img[y[k]-1:ey[k],x[k]-1:ex[k],:]
-            if tmp.shape[0]>0 and tmp.shape[1]>0 or tmp.shape[0]==0 and tmp.shape[1]==0:
-                tempimg[:,:,:,k] = imresample(tmp, (24, 24))
-            else:
-                return np.empty()
-        tempimg = (tempimg-127.5)*0.0078125
-        tempimg1 = np.transpose(tempimg, (3,1,0,2))
+        tempimg1 = crop_boxes(img, total_boxes, w, h, 24)
         out = rnet([tempimg1])
         out0 = np.transpose(out[0])
         out1 = np.transpose(out[1])
@@ -363,17 +354,7 @@ def detect_face(img, minsize, pnet, rnet, onet, threshold, factor):
     if numbox>0:
         # third stage
         total_boxes = np.fix(total_boxes).astype(np.int32)
-        dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(total_boxes.copy(), w, h)
-        tempimg = np.zeros((48,48,3,numbox))
-        for k in range(0,numbox):
-            tmp = np.zeros((int(tmph[k]),int(tmpw[k]),3))
-            tmp[dy[k]-1:edy[k],dx[k]-1:edx[k],:] = img[y[k]-1:ey[k],x[k]-1:ex[k],:]
-            if tmp.shape[0]>0 and tmp.shape[1]>0 or tmp.shape[0]==0 and tmp.shape[1]==0:
-                tempimg[:,:,:,k] = imresample(tmp, (48, 48))
-            else:
-                return np.empty()
-        tempimg = (tempimg-127.5)*0.0078125
-        tempimg1 = np.transpose(tempimg, (3,1,0,2))
+        tempimg1 = crop_boxes(img, total_boxes, w, h, 48)
         out = onet([tempimg1])
         out0 = np.transpose(out[0])
         out1 = np.transpose(out[1])
@@ -449,8 +430,9 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
             if (ws, hs) not in images_obj_per_resolution:
                 images_obj_per_resolution[(ws, hs)] = []
 
-            im_data = imresample(images[index], (hs, ws))
-            im_data = (im_data - 127.5) * 0.0078125
+            im_data = imresample(images[index], (hs, ws)).astype(np.float32)
+            im_data -= 127.5
+            im_data *= 0.0078125
             img_y = np.transpose(im_data, (1, 0, 2))  # caffe uses different dimensions ordering
             images_obj_per_resolution[(ws, hs)].append({'scale': scale, 'image': img_y, 'index': index})
 
@@ -490,28 +472,16 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
             image_obj['total_boxes'] = np.transpose(np.vstack([qq1, qq2, qq3, qq4, image_obj['total_boxes'][:, 4]]))
             image_obj['total_boxes'] = rerec(image_obj['total_boxes'].copy())
             image_obj['total_boxes'][:, 0:4] = np.fix(image_obj['total_boxes'][:, 0:4]).astype(np.int32)
-            dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(image_obj['total_boxes'].copy(), w, h)
 
             numbox = image_obj['total_boxes'].shape[0]
-            tempimg = np.zeros((24, 24, 3, numbox))
-
             if numbox > 0:
-                for k in range(0, numbox):
-                    tmp = np.zeros((int(tmph[k]), int(tmpw[k]), 3))
-                    tmp[dy[k] - 1:edy[k], dx[k] - 1:edx[k], :] = images[index][y[k] - 1:ey[k], x[k] - 1:ex[k], :]
-                    if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
-                        tempimg[:, :, :, k] = imresample(tmp, (24, 24))
-                    else:
-                        return np.empty()
-
-                tempimg = (tempimg - 127.5) * 0.0078125
-                image_obj['rnet_input'] = np.transpose(tempimg, (3, 1, 0, 2))
+                image_obj['rnet_input'] = crop_boxes(images[index], image_obj['total_boxes'], w, h, 24)
 
     # # # # # # # # # # # # #
     # second stage - refinement of face candidates with rnet
     # # # # # # # # # # # # #
 
-    bulk_rnet_input = np.empty((0, 24, 24, 3))
+    bulk_rnet_input = np.empty((0, 24, 24, 3), dtype=np.float32)
     for index, image_obj in enumerate(images_with_boxes):
         if 'rnet_input' in image_obj:
             bulk_rnet_input = np.append(bulk_rnet_input, image_obj['rnet_input'], axis=0)
@@ -547,19 +517,8 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
             numbox = image_obj['total_boxes'].shape[0]
 
             if numbox > 0:
-                tempimg = np.zeros((48, 48, 3, numbox))
                 image_obj['total_boxes'] = np.fix(image_obj['total_boxes']).astype(np.int32)
-                dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(image_obj['total_boxes'].copy(), w, h)
-
-                for k in range(0, numbox):
-                    tmp = np.zeros((int(tmph[k]), int(tmpw[k]), 3))
-                    tmp[dy[k] - 1:edy[k], dx[k] - 1:edx[k], :] = images[index][y[k] - 1:ey[k], x[k] - 1:ex[k], :]
-                    if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
-                        tempimg[:, :, :, k] = imresample(tmp, (48, 48))
-                    else:
-                        return np.empty()
-                tempimg = (tempimg - 127.5) * 0.0078125
-                image_obj['onet_input'] = np.transpose(tempimg, (3, 1, 0, 2))
+                image_obj['onet_input'] = crop_boxes(images[index], image_obj['total_boxes'], w, h, 48)
 
         i += rnet_input_count
 
@@ -567,7 +526,7 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
     # third stage - further refinement and facial landmarks positions with onet
     # # # # # # # # # # # # #
 
-    bulk_onet_input = np.empty((0, 48, 48, 3))
+    bulk_onet_input = np.empty((0, 48, 48, 3), dtype=np.float32)
     for index, image_obj in enumerate(images_with_boxes):
         if 'onet_input' in image_obj:
             bulk_onet_input = np.append(bulk_onet_input, image_obj['onet_input'], axis=0)
@@ -622,6 +581,135 @@ def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, thre
     return ret
 
 
+def detect_face_batch(imgs, minsize, pnet, rnet, onet, threshold, factor):
+    """Detects faces in a list of same-sized images, and returns a list of (bounding boxes, points) per image.
+    Unlike bulk_detect_face every pyramid scale is passed through pnet once for the whole list,
+    and rnet/onet candidates of all images are evaluated in one call per stage.
+    imgs: list of input images with identical shape
+    minsize: minimum faces' size
+    pnet, rnet, onet: caffemodel
+    threshold: threshold=[th1, th2, th3], th1-3 are three steps's threshold
+    factor: the factor used to create a scaling pyramid of face sizes to detect in the image.
+    """
+    num_imgs = len(imgs)
+    h=imgs[0].shape[0]
+    w=imgs[0].shape[1]
+    for img in imgs:
+        if img.shape[0:2] != (h,w):
+            raise ValueError ('detect_face_batch() requires images of the same size')
+
+    factor_count=0
+    minl=np.amin([h, w])
+    m=12.0/minsize
+    minl=minl*m
+    # create scale pyramid
+    scales=[]
+    while minl>=12:
+        scales += [m*np.power(factor, factor_count)]
+        minl = minl*factor
+        factor_count += 1
+
+    all_boxes = [ np.empty((0,9)) for i in range(num_imgs) ]
+    all_points = [ np.empty(0) for i in range(num_imgs) ]
+
+    # first stage, one pnet call per scale for all images
+    for scale in scales:
+        hs=int(np.ceil(h*scale))
+        ws=int(np.ceil(w*scale))
+        im_data = np.empty ( (num_imgs, hs, ws, 3), dtype=np.float32 )
+        for i, img in enumerate(imgs):
+            im_data[i] = imresample(img, (hs, ws))
+        im_data -= 127.5
+        im_data *= 0.0078125
+        img_y = np.transpose(im_data, (0,2,1,3))
+        out = pnet([img_y])
+        out0 = np.transpose(out[0], (0,2,1,3))
+        out1 = np.transpose(out[1], (0,2,1,3))
+
+        for i in range(num_imgs):
+            boxes, _ = generateBoundingBox(out1[i,:,:,1].copy(), out0[i,:,:,:].copy(), scale, threshold[0])
+
+            # inter-scale nms
+            pick = nms(boxes.copy(), 0.5, 'Union')
+            if boxes.size>0 and pick.size>0:
+                all_boxes[i] = np.append(all_boxes[i], boxes[pick,:], axis=0)
+
+    for i in range(num_imgs):
+        total_boxes = all_boxes[i]
+        if total_boxes.shape[0]>0:
+            pick = nms(total_boxes.copy(), 0.7, 'Union')
+            total_boxes = total_boxes[pick,:]
+            regw = total_boxes[:,2]-total_boxes[:,0]
+            regh = total_boxes[:,3]-total_boxes[:,1]
+            qq1 = total_boxes[:,0]+total_boxes[:,5]*regw
+            qq2 = total_boxes[:,1]+total_boxes[:,6]*regh
+            qq3 = total_boxes[:,2]+total_boxes[:,7]*regw
+            qq4 = total_boxes[:,3]+total_boxes[:,8]*regh
+            total_boxes = np.transpose(np.vstack([qq1, qq2, qq3, qq4, total_boxes[:,4]]))
+            total_boxes = rerec(total_boxes.copy())
+            total_boxes[:,0:4] = np.fix(total_boxes[:,0:4]).astype(np.int32)
+            all_boxes[i] = total_boxes
+
+    # second stage, rnet candidates of all images in one call
+    counts = [ total_boxes.shape[0] for total_boxes in all_boxes ]
+    if sum(counts) > 0:
+        tempimg1 = np.concatenate ( [ crop_boxes(imgs[i], all_boxes[i], w, h, 24) for i in range(num_imgs) if counts[i] > 0 ] )
+        out = rnet([tempimg1])
+        out0 = np.transpose(out[0])
+        out1 = np.transpose(out[1])
+
+        start = 0
+        for i in range(num_imgs):
+            if counts[i] == 0:
+                continue
+            score = out1[1,start:start+counts[i]]
+            ipass = np.where(score>threshold[1])
+            total_boxes = np.hstack([all_boxes[i][ipass[0],0:4].copy(), np.expand_dims(score[ipass].copy(),1)])
+            mv = out0[:,start:start+counts[i]][:,ipass[0]]
+            if total_boxes.shape[0]>0:
+                pick = nms(total_boxes, 0.7, 'Union')
+                total_boxes = total_boxes[pick,:]
+                total_boxes = bbreg(total_boxes.copy(), np.transpose(mv[:,pick]))
+                total_boxes = rerec(total_boxes.copy())
+                total_boxes = np.fix(total_boxes).astype(np.int32)
+            all_boxes[i] = total_boxes
+            start += counts[i]
+
+    # third stage, onet candidates of all images in one call
+    counts = [ total_boxes.shape[0] for total_boxes in all_boxes ]
+    if sum(counts) > 0:
+        tempimg1 = np.concatenate ( [ crop_boxes(imgs[i], all_boxes[i], w, h, 48) for i in range(num_imgs) if counts[i] > 0 ] )
+        out = onet([tempimg1])
+        out0 = np.transpose(out[0])
+        out1 = np.transpose(out[1])
+        out2 = np.transpose(out[2])
+
+        start = 0
+        for i in range(num_imgs):
+            if counts[i] == 0:
+                continue
+            score = out2[1,start:start+counts[i]]
+            points = out1[:,start:start+counts[i]]
+            ipass = np.where(score>threshold[2])
+            points = points[:,ipass[0]]
+            total_boxes = np.hstack([all_boxes[i][ipass[0],0:4].copy(), np.expand_dims(score[ipass].copy(),1)])
+            mv = out0[:,start:start+counts[i]][:,ipass[0]]
+
+            bw = total_boxes[:,2]-total_boxes[:,0]+1
+            bh = total_boxes[:,3]-total_boxes[:,1]+1
+            points[0:5,:] = np.tile(bw,(5, 1))*points[0:5,:] + np.tile(total_boxes[:,0],(5, 1))-1
+            points[5:10,:] = np.tile(bh,(5, 1))*points[5:10,:] + np.tile(total_boxes[:,1],(5, 1))-1
+            if total_boxes.shape[0]>0:
+                total_boxes = bbreg(total_boxes.copy(), np.transpose(mv))
+                pick = nms(total_boxes.copy(), 0.7, 'Min')
+                total_boxes = total_boxes[pick,:]
+                points = points[:,pick]
+            all_boxes[i] = total_boxes
+            all_points[i] = points
+            start += counts[i]
+
+    return list(zip(all_boxes, all_points))
+
 # function [boundingbox] = bbreg(boundingbox,reg)
 def bbreg(boundingbox,reg):
     """Calibrate bounding boxes"""
@@ -663,38 +751,106 @@ def generateBoundingBox(imap, reg, scale, t):
     boundingbox = np.hstack([q1, q2, np.expand_dims(score,1), reg])
     return boundingbox, reg
  
-# function pick = nms(boxes,threshold,type)
-def nms(boxes, threshold, method):
-    if boxes.size==0:
-        return np.empty((0,3))
+def nms_window(boxes, threshold, method, I, xs):
+    """Greedy pass of nms, where every kept box suppresses only boxes of its window along x.
+    Faster than overlaps of all pairs, when few kept boxes suppress most of the others.
+    """
     x1 = boxes[:,0]
     y1 = boxes[:,1]
     x2 = boxes[:,2]
     y2 = boxes[:,3]
-    s = boxes[:,4]
     area = (x2-x1+1) * (y2-y1+1)
-    I = np.argsort(s)
-    pick = np.zeros_like(s, dtype=np.int16)
-    counter = 0
-    while I.size>0:
-        i = I[-1]
-        pick[counter] = i
-        counter += 1
-        idx = I[0:-1]
-        xx1 = np.maximum(x1[i], x1[idx])
-        yy1 = np.maximum(y1[i], y1[idx])
-        xx2 = np.minimum(x2[i], x2[idx])
-        yy2 = np.minimum(y2[i], y2[idx])
-        w = np.maximum(0.0, xx2-xx1+1)
-        h = np.maximum(0.0, yy2-yy1+1)
+    x1s = x1[xs]
+    # window holds every box, which may intersect along x
+    reach = (x2-x1).max() + 1
+    lo = np.searchsorted(x1s, x1 - reach - 1, side='left')
+    hi = np.searchsorted(x1s, x2 + 1, side='right')
+
+    suppressed = np.zeros(boxes.shape[0], dtype=np.bool_)
+    pick = []
+    for i in I:
+        if suppressed[i]:
+            continue
+        pick.append(i)
+        idx = xs[lo[i]:hi[i]]
+        idx = idx[~suppressed[idx]]
+        w = np.maximum(0.0, np.minimum(x2[i], x2[idx]) - np.maximum(x1[i], x1[idx]) + 1)
+        h = np.maximum(0.0, np.minimum(y2[i], y2[idx]) - np.maximum(y1[i], y1[idx]) + 1)
         inter = w * h
-        if method is 'Min':
+        if method == 'Min':
             o = inter / np.minimum(area[i], area[idx])
         else:
             o = inter / (area[i] + area[idx] - inter)
-        I = I[np.where(o<=threshold)]
-    pick = pick[0:counter]
-    return pick
+        suppressed[idx[o > threshold]] = True
+    return np.array(pick, dtype=np.intp)
+
+# function pick = nms(boxes,threshold,type)
+def nms(boxes, threshold, method, chunk_pairs=1000000, window_pairs=64):
+    """Greedy non-maximum suppression, returns indices of kept boxes in descending score order.
+    Overlaps are only computed for pairs of boxes intersecting along x (found by a sweep over boxes
+    sorted by x1, at most chunk_pairs pairs at a time), the greedy pass then walks the suppression lists.
+    'Min' suppresses most boxes in few steps, so with more than window_pairs such pairs per box nms_window is used.
+    """
+    if boxes.size==0:
+        return np.empty((0,3))
+    x1 = boxes[:,0]
+    y1 = boxes[:,1]
+    x2 = boxes[:,2]
+    y2 = boxes[:,3]
+    s = boxes[:,4]
+    area = (x2-x1+1) * (y2-y1+1)
+    I = np.argsort(s)[::-1]
+    n = I.shape[0]
+    rank = np.empty(n, dtype=np.intp)
+    rank[I] = np.arange(n)
+
+    xs = np.argsort(x1, kind='mergesort')
+    counts = np.maximum(np.searchsorted(x1[xs], x2[xs]+1, side='left') - np.arange(1, n+1), 0)
+    offsets = np.cumsum(counts)
+    if method == 'Min' and offsets[-1] > window_pairs * n:
+        return nms_window(boxes, threshold, method, I, xs)
+
+    over_a = [ np.empty(0, dtype=np.intp) ]
+    over_b = [ np.empty(0, dtype=np.intp) ]
+    start = 0
+    while start < n:
+        end = np.searchsorted(offsets, (offsets[start-1] if start > 0 else 0) + chunk_pairs, side='right')
+        end = min(max(end, start+1), n)
+        c = counts[start:end]
+        num = c.sum()
+        if num > 0:
+            a = np.repeat(np.arange(start, end), c)
+            b = np.arange(num) - np.repeat(np.cumsum(c) - c, c) + a + 1
+            a, b = xs[a], xs[b]
+            h = np.minimum(y2[a], y2[b]) - np.maximum(y1[a], y1[b]) + 1
+            m = h > 0
+            a, b, h = a[m], b[m], h[m]
+            w = np.maximum(0.0, np.minimum(x2[a], x2[b]) - np.maximum(x1[a], x1[b]) + 1)
+            inter = w * h
+            if method == 'Min':
+                o = inter / np.minimum(area[a], area[b])
+            else:
+                o = inter / (area[a] + area[b] - inter)
+            m = o > threshold
+            over_a.append(a[m])
+            over_b.append(b[m])
+        start = end
+
+    # higher scored box of an overlapping pair suppresses the other one
+    ra = rank[np.concatenate(over_a)]
+    rb = rank[np.concatenate(over_b)]
+    ra, rb = np.minimum(ra, rb), np.maximum(ra, rb)
+    order = np.argsort(ra, kind='mergesort')
+    ra, rb = ra[order], rb[order]
+    starts = np.searchsorted(ra, np.arange(n+1))
+
+    suppressed = np.zeros(n, dtype=np.bool_)
+    pick = []
+    for r in range(n):
+        if not suppressed[r]:
+            pick.append(r)
+            suppressed[rb[starts[r]:starts[r+1]]] = True
+    return I[pick]
 
 # function [dy edy dx edx y ey x ex tmpw tmph] = pad(total_boxes,w,h)
 def pad(total_boxes, w, h):
@@ -731,6 +887,35 @@ def pad(total_boxes, w, h):
     
     return dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph
 
+# function [tempimg] = crop_boxes(img,total_boxes,w,h,size)
+def crop_boxes(img, total_boxes, w, h, size):
+    """Crop boxes to size x size network input in caffe ordering, pixels outside of the image are zero.
+    Boxes inside the image are resampled straight into a preallocated float32 buffer,
+    only boxes crossing the border get a zero padded copy.
+    """
+    numbox = total_boxes.shape[0]
+    tempimg = np.zeros((numbox,size,size,3), dtype=np.float32)
+
+    x = total_boxes[:,0].astype(np.int32) - 1
+    y = total_boxes[:,1].astype(np.int32) - 1
+    ex = total_boxes[:,2].astype(np.int32)
+    ey = total_boxes[:,3].astype(np.int32)
+    valid = (ex > x) & (ey > y)
+    inside = valid & (x >= 0) & (y >= 0) & (ex <= w) & (ey <= h)
+
+    for k in np.flatnonzero(inside):
+        cv2.resize(img[y[k]:ey[k],x[k]:ex[k]].astype(np.float32), (size, size), dst=tempimg[k], interpolation=cv2.INTER_LINEAR)
+
+    for k in np.flatnonzero(valid & ~inside):
+        cx, cy, cex, cey = max(x[k],0), max(y[k],0), min(ex[k],w), min(ey[k],h)
+        if cex > cx and cey > cy:
+            tmp = cv2.copyMakeBorder(img[cy:cey,cx:cex].astype(np.float32), cy-y[k], ey[k]-cey, cx-x[k], ex[k]-cex, cv2.BORDER_CONSTANT, value=0)
+            cv2.resize(tmp, (size, size), dst=tempimg[k], interpolation=cv2.INTER_LINEAR)
+
+    tempimg -= 127.5
+    tempimg *= 0.0078125
+    return np.transpose(tempimg, (0,2,1,3))
+
 # function [bboxA] = rerec(bboxA)
 def rerec(bboxA):
     """Convert bboxA to square."""
@@ -21,6 +21,17 @@ def str2bool(v):
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
+def str2workers(v):
+    try:
+        values = [ int(x) for x in v.split(':') ]
+    except:
+        raise argparse.ArgumentTypeError('Workers count or range min:max expected.')
+    if len(values) == 1:
+        values = values*2
+    if len(values) != 2 or values[0] < 1 or values[0] > values[1]:
+        raise argparse.ArgumentTypeError('Workers count or range min:max expected.')
+    return tuple(values)
+
 if __name__ == "__main__":
     os_utils.set_process_lowest_prio()
 
@@ -42,10 +53,12 @@ if __name__ == "__main__":
             multi_gpu=arguments.multi_gpu,
             manual_fix=arguments.manual_fix,
             manual_window_size=arguments.manual_window_size,
-            recursive=arguments.recursive)
+            recursive=arguments.recursive,
+            single_pass=arguments.single_pass,
+            workers=arguments.workers)
 
     extract_parser = subparsers.add_parser( "extract", help="Extract the faces from a pictures.")
-    extract_parser.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory. A directory containing the files you wish to process.")
+    extract_parser.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory. A directory containing the files you wish to process, or video file, its frames are read without dumping them to disk.")
     extract_parser.add_argument('--remove-existing', required=False, action="store_true", dest="remove_existing", help="Remove existing output images before creating new")
     extract_parser.add_argument('--recursive', required=False, default=False, action="store_true", help="Recursively search input directory")
     extract_parser.add_argument('--output-dir', required=True, action=fixPathAction, dest="output_dir", help="Output directory. This is where the extracted files will be stored.")
@@ -55,7 +68,9 @@ if __name__ == "__main__":
     extract_parser.add_argument('--multi-gpu', action="store_true", dest="multi_gpu", default=False, help="Enables multi GPU.")
     extract_parser.add_argument('--manual-fix', action="store_true", dest="manual_fix", default=False, help="Enables manual extract only frames where faces were not recognized.")
     extract_parser.add_argument('--manual-window-size', type=int, dest="manual_window_size", default=0, help="Manual fix window size. Example: 1368. Default: frame size.")
+    extract_parser.add_argument('--single-pass', action="store_true", dest="single_pass", default=False, help="Decode every frame once and detect, landmark and save faces in one pass. Not used with manual detector or --manual-fix.")
 
+    extract_parser.add_argument('--workers', type=str2workers, dest="workers", default=None, help="Count of CPU processes saving faces, fixed N or range min:max. Started with min and grown while throughput improves. Default 2:<CPU count>.")
     extract_parser.set_defaults (func=process_extract)
 
     def process_sort(arguments):
@@ -67,6 +82,19 @@ if __name__ == "__main__":
     sort_parser.add_argument('--by', required=True, dest="sort_by_method", choices=("blur", "face", "face-dissim", "face-yaw", "hist", "hist-dissim", "hist-blur", "ssim", "brightness", "hue", "origname", "restore_origname"), help="Method of sorting. 'origname' sort by original filename to recover original sequence." )
     sort_parser.set_defaults (func=process_sort)
 
+    def process_util(arguments):
+        from mainscripts import Util
+        Util.main (input_path=arguments.input_dir, operation=arguments.operation, delete_packed=arguments.delete_packed)
+
+    util_parser = subparsers.add_parser( "util", help="Utilities for aligned faces in a directory.")
+    util_parser.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory. A directory containing aligned faces.")
+    util_operation = util_parser.add_mutually_exclusive_group(required=True)
+    util_operation.add_argument('--convert-metadata', action="store_const", const="convert-metadata", dest="operation", help="Rewrite embedded data of faces, extracted by older versions, in current binary format.")
+    util_operation.add_argument('--pack-faceset', action="store_const", const="pack-faceset", dest="operation", help="Pack aligned faces of directory to single file faceset.pak in it, which is used by trainer instead of them.")
+    util_operation.add_argument('--unpack-faceset', action="store_const", const="unpack-faceset", dest="operation", help="Write faces of faceset.pak back to directory and remove faceset.pak.")
+    util_parser.add_argument('--delete-packed', action="store_true", dest="delete_packed", default=False, help="With --pack-faceset, remove packed files after faceset.pak is verified against them.")
+    util_parser.set_defaults (func=process_util)
+
     def process_train(arguments):
 
         if 'DFL_TARGET_EPOCH' in os.environ.keys():
@@ -157,12 +185,20 @@ if __name__ == "__main__":
             masked_hist_match = arguments.masked_hist_match,
             erode_mask_modifier = arguments.erode_mask_modifier,
             blur_mask_modifier = arguments.blur_mask_modifier,
-            force_best_gpu_idx = arguments.force_best_gpu_idx
+            force_best_gpu_idx = arguments.force_best_gpu_idx,
+            workers = arguments.workers,
+            predict_batch_size = arguments.predict_batch_size,
+            predict_batch_wait_ms = arguments.predict_batch_wait_ms,
+            use_plan_cache = arguments.use_plan_cache,
+            cache_predictions = arguments.cache_predictions,
+            temporal_coherence = arguments.temporal_coherence,
+            output_format = arguments.output_format,
+            output_compression = arguments.output_compression
             )
 
     convert_parser = subparsers.add_parser( "convert", help="Converter")
-    convert_parser.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory. A directory containing the files you wish to process.")
-    convert_parser.add_argument('--output-dir', required=True, action=fixPathAction, dest="output_dir", help="Output directory. This is where the converted files will be stored.")
+    convert_parser.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory. A directory containing the files you wish to process, or video file, its frames are read without dumping them to disk.")
+    convert_parser.add_argument('--output-dir', required=True, action=fixPathAction, dest="output_dir", help="Output directory. This is where the converted files will be stored. If path has video extension, converted frames are written to this video file.")
     convert_parser.add_argument('--aligned-dir', action=fixPathAction, dest="aligned_dir", help="Aligned directory. This is where the aligned files stored. Not used in AVATAR model.")
     convert_parser.add_argument('--model-dir', required=True, action=fixPathAction, dest="model_dir", help="Model dir.")
     convert_parser.add_argument('--model', required=True, dest="model_name", choices=Path_utils.get_all_dir_names_startswith ( Path(__file__).parent / 'models' , 'Model_'), help="Type of model")
@@ -174,6 +210,14 @@ if __name__ == "__main__":
     convert_parser.add_argument('--debug', action="store_true", dest="debug", default=False, help="Debug converter.")
     convert_parser.add_argument('--force-best-gpu-idx', type=int, dest="force_best_gpu_idx", default=-1, help="Force to choose this GPU idx as best.")
 
+    convert_parser.add_argument('--workers', type=str2workers, dest="workers", default=None, help="Count of converter processes, fixed N or range min:max. Started with min and grown while throughput improves. Default 2:<CPU count>.")
+    convert_parser.add_argument('--predict-batch-size', type=int, dest="predict_batch_size", default=16, help="Max count of faces predicted by model in one batch, gathered from all converter processes.")
+    convert_parser.add_argument('--predict-batch-wait-ms', type=float, dest="predict_batch_wait_ms", default=5, help="Max time in milliseconds the model waits for more faces before predicting incomplete batch.")
+    convert_parser.add_argument('--no-plan-cache', action="store_false", dest="use_plan_cache", default=True, help="Do not use face geometry cached by previous runs in <aligned-dir>_cache and do not save it.")
+    convert_parser.add_argument('--cache-predictions', action="store_true", dest="cache_predictions", default=False, help="Cache model predictions of faces in <aligned-dir>_cache, per saved model state. Next convert runs with other mode or mask modifiers do not predict these faces again.")
+    convert_parser.add_argument('--temporal-coherence', action="store_true", dest="temporal_coherence", default=False, help="Input is sequence of frames. Every process converts contiguous ranges of frames, landmarks of moving faces are smoothed and still faces reuse geometry of previous frame.")
+    convert_parser.add_argument('--output-format', dest="output_format", choices=['png','jpg','webp'], default=None, help="Format of output files. Default - format of input files.")
+    convert_parser.add_argument('--output-compression', type=int, dest="output_compression", default=None, help="PNG compression level 0..9 (default 3), JPG quality 1..100 (default 95), WEBP quality 1..100 (default lossless).")
     convert_parser.set_defaults(func=process_convert)
 
     def bad_args(arguments):
@@ -1,90 +1,567 @@
 ﻿import traceback
+import os
+import tempfile
 from pathlib import Path
 from utils import Path_utils
 import cv2
 from tqdm import tqdm
 from utils.AlignedPNG import AlignedPNG
+from utils.PackedFaceset import PackedFaceset
+from utils.WorkQueue import WorkQueue
+from utils import VideoIO
 from utils import image_utils
+from utils import os_utils
 import shutil
 import numpy as np
 import time
+import zlib
 import multiprocessing
+import queue
+import threading
 from models import ConverterBase
 
+class AlignmentsTable(object):
+    #landmarks of all faces stored contiguously in single memory mapped file
+    #and index source filename stem -> (first face, faces count)
+    #pickling keeps only index and file path, so converter processes share the landmarks without copying
+
+    def __init__(self, alignments):
+        self.index = {}
+        faces = []
+        for stem, faces_landmarks in alignments.items():
+            self.index[stem] = ( len(faces), len(faces_landmarks) )
+            faces += faces_landmarks
+
+        #landmarks written by extractor are integer, keep them integer for cv2 polygon functions
+        if all ( [ np.issubdtype(x.dtype, np.integer) for x in faces ] ):
+            self.dtype = np.int32
+        else:
+            self.dtype = np.float32
+
+        self.filepath = None
+        if len(faces) == 0:
+            self.shape = (0,68,2)
+            self.landmarks = np.zeros (self.shape, dtype=self.dtype)
+            return
+
+        faces = np.array (faces, dtype=self.dtype)
+        self.shape = faces.shape
+
+        fd, self.filepath = tempfile.mkstemp (suffix='.alignments')
+        os.close(fd)
+        mm = np.memmap (self.filepath, dtype=self.dtype, mode='w+', shape=self.shape)
+        mm[:] = faces
+        mm.flush()
+        del mm
+        self.landmarks = self.open_landmarks()
+
+    def open_landmarks(self):
+        if self.filepath is None:
+            return np.zeros (self.shape, dtype=self.dtype)
+        return np.memmap (self.filepath, dtype=self.dtype, mode='r', shape=self.shape)
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d.pop ('landmarks')
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update (d)
+        self.landmarks = self.open_landmarks()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, stem):
+        return stem in self.index
+
+    def __getitem__(self, stem):
+        #returns read-only array of shape (faces count, points, 2)
+        start, count = self.index[stem]
+        return self.landmarks[start:start+count]
+
+    def close(self):
+        #called by owner process after all converter processes are finished
+        self.landmarks = None
+        if self.filepath is not None:
+            try:
+                Path(self.filepath).unlink()
+            except:
+                pass
+            self.filepath = None
+
+class FaceSlots(object):
+    #memory mapped file with one slot per converter process
+    #converter process writes predictor input into its slot, model process writes prediction back into the same slot,
+    #so only (shape, dtype) of arrays goes through queues
+    #pickling keeps only file path
+
+    def __init__(self, slots_count, slot_size):
+        self.slots_count = slots_count
+        self.slot_size = ( (slot_size + 63) // 64 ) * 64
+        fd, self.filepath = tempfile.mkstemp (suffix='.slots')
+        os.close(fd)
+        self.buffer = np.memmap (self.filepath, dtype=np.uint8, mode='w+', shape=(self.slots_count, self.slot_size))
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d.pop ('buffer')
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update (d)
+        self.buffer = np.memmap (self.filepath, dtype=np.uint8, mode='r+', shape=(self.slots_count, self.slot_size))
+
+    def fits(self, arr):
+        return arr.nbytes <= self.slot_size
+
+    def write(self, idx, arr):
+        self.read (idx, arr.shape, arr.dtype)[...] = arr
+        return (arr.shape, arr.dtype.str)
+
+    def read(self, idx, shape, dtype):
+        #returns view of slot, valid until slot is written again
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self.buffer[idx,0:nbytes].view(dtype).reshape(shape)
+
+    def close(self):
+        self.buffer = None
+        try:
+            Path(self.filepath).unlink()
+        except:
+            pass
+
+class PlanCache(object):
+    #conversion plans of faces (converter.build_plan results), stored between runs in directory of .npy columns
+    #each array of plan is stacked over all faces into column, together with landmarks and frame size the plan is built from,
+    #so plan is rebuilt if alignments or frames are changed
+    #columns are opened memory mapped, so converter processes share them instead of holding own copies
+    #pickling keeps only path, converter processes open plans themselves, new plans are saved by host
+
+    def __init__(self, dir_path):
+        self.dir_path = Path(dir_path)
+        self.new_plans = {}
+        self.load()
+
+    def load(self):
+        #index (source stem, face idx) -> row of columns
+        self.index = {}
+        self.columns = {}
+        if not self.dir_path.exists():
+            return
+        try:
+            columns = {}
+            for filepath in self.dir_path.glob('*.npy'):
+                try:
+                    columns[filepath.stem] = np.load (str(filepath), mmap_mode='r')
+                except ValueError:
+                    #column without rows cannot be memory mapped
+                    columns[filepath.stem] = np.load (str(filepath))
+            keys = columns.pop ('keys')
+            if any ( [ len(column) != len(keys) for column in columns.values() ] ):
+                raise ValueError ("columns have different length")
+        except:
+            print ("Unable to load conversion plans %s, they will be rebuilt." % (self.dir_path) )
+            return
+        for i, key in enumerate(keys):
+            stem, face_idx = key.rsplit('/', 1)
+            self.index[ (stem, int(face_idx)) ] = i
+        self.columns = columns
+
+    def __getstate__(self):
+        return {'dir_path': self.dir_path}
+
+    def __setstate__(self, d):
+        self.__dict__.update (d)
+        self.new_plans = {}
+        self.load()
+
+    def get(self, stem, face_idx, img_size, img_face_landmarks):
+        #returns plan or None, if it is not cached or outdated
+        i = self.index.get ( (stem, face_idx), None )
+        if i is None:
+            return None
+        if not np.array_equal (self.columns['img_size'][i], img_size) or not np.array_equal (self.columns['landmarks'][i], img_face_landmarks):
+            return None
+        return { name : np.array(column[i]) for name, column in self.columns.items() if name != 'img_size' and name != 'landmarks' }
+
+    def put(self, stem, face_idx, img_size, img_face_landmarks, plan):
+        plan = dict(plan)
+        plan['img_size'] = np.array (img_size)
+        plan['landmarks'] = np.array (img_face_landmarks)
+        self.new_plans[ (stem, face_idx) ] = plan
+
+    def save(self):
+        #writes cached plans updated by new plans, columns are written to new directory, which replaces the old one
+        if len(self.new_plans) == 0:
+            return
+
+        names = sorted ( next(iter(self.new_plans.values())).keys() )
+        rows = [ (key, None) for key in self.index.keys() if key not in self.new_plans ]
+        if any ( [ name not in self.columns for name in names ] ):
+            rows = []
+        rows += list ( self.new_plans.items() )
+
+        columns = { name : np.array ( [ self.columns[name][self.index[key]] if plan is None else plan[name] for key, plan in rows ] ) for name in names }
+        columns['keys'] = np.array ( [ '%s/%d' % key for key, plan in rows ] )
+        #mapped columns are released before their files are removed
+        self.index = {}
+        self.columns = {}
+
+        tmp_path = self.dir_path.parent / (self.dir_path.name + '.tmp')
+        if tmp_path.exists():
+            shutil.rmtree ( str(tmp_path) )
+        tmp_path.mkdir (parents=True)
+        for name, column in columns.items():
+            np.save ( str(tmp_path / (name + '.npy')), column )
+
+        if self.dir_path.exists():
+            shutil.rmtree ( str(self.dir_path) )
+        tmp_path.rename (self.dir_path)
+        self.new_plans = {}
+        self.load()
+
 class model_process_predictor(object):
-    def __init__(self, sq, cq, lock):
+    #sends faces to model process and waits for the result
+    #model process predicts requests of all converter processes together in batches
+    #faces which do not fit in slot are pickled through queues
+    #restarted converter process gets the same client_idx, queue and slot, so requests are identified by (pid, counter)
+    #and first request of process waits for 'sync' reply, which model process sends after replies to all earlier requests
+    def __init__(self, sq, cq, client_idx, slots=None, model_pid=None):
         self.sq = sq
         self.cq = cq
-        self.lock = lock
-        
-    def __call__(self, face):
-        self.lock.acquire()
-        
-        self.sq.put ( {'op': 'predict', 'face' : face} )
+        self.client_idx = client_idx
+        self.slots = slots
+        self.model_pid = model_pid
+        self.pid = None
+        self.request_id = 0
+
+    def request(self, obj):
+        self.request_id += 1
+        obj.update ( {'client_idx': self.client_idx, 'id': (self.pid, self.request_id) } )
+        self.sq.put (obj)
+
+        #replies to requests of terminated process with the same client_idx are skipped
         while True:
-            if not self.cq.empty():
-                obj = self.cq.get()
-                obj_op = obj['op']
-                if obj_op == 'predict_result':
-                    self.lock.release()
-                    return obj['result']
-            time.sleep(0.005)
-        
-def model_process(model_name, model_dir, in_options, sq, cq):
+            try:
+                reply = self.cq.get (timeout=1.0)
+            except queue.Empty:
+                if self.model_pid is not None and not os_utils.is_process_alive (self.model_pid):
+                    raise Exception ('Model process is terminated.')
+                continue
+            if reply['id'] == obj['id']:
+                return reply
+
+    def __call__(self, faces):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.request ( {'op': 'sync'} )
+
+        obj = {'op': 'predict'}
+        if self.slots is not None and self.slots.fits(faces):
+            obj['slot'] = self.slots.write (self.client_idx, faces)
+        else:
+            obj['faces'] = faces
+
+        obj = self.request (obj)
+        if obj['op'] == 'predict_result':
+            if 'slot' in obj:
+                #copy, because slot will be overwritten by next request
+                return self.slots.read (self.client_idx, *obj['slot']).copy()
+            return obj['result']
+        raise Exception ( obj['message'] )
+
+class cached_predictor(object):
+    #predictor, which returns cached prediction, if the same faces were predicted by the same model before
+    #predictions of each source file are stored in <predictions_path>/<stem>.npz as float16 and found by crc32 of predictor input,
+    #so different blending options of converter reuse predictions, but changed frames or alignments are predicted again
+    def __init__(self, predictor, predictions_path):
+        self.predictor = predictor
+        self.predictions_path = Path(predictions_path)
+        self.stem = None
+
+    def load(self, stem):
+        #called before converting source file
+        self.stem = stem
+        self.crcs = []
+        self.predictions = []
+        self.changed = False
+        filepath = self.predictions_path / (stem + '.npz')
+        if filepath.exists():
+            try:
+                with np.load (str(filepath)) as npz:
+                    self.crcs = list ( npz['crcs'] )
+                    self.predictions = list ( npz['predictions'] )
+            except:
+                print ( "Unable to load cached predictions %s, predicting again." % (filepath) )
+
+    def save(self):
+        #called after converting source file
+        if self.stem is not None and self.changed:
+            self.predictions_path.mkdir (parents=True, exist_ok=True)
+            filepath = self.predictions_path / (self.stem + '.npz')
+            tmp_filepath = self.predictions_path / (self.stem + '.tmp.npz')
+            np.savez_compressed ( str(tmp_filepath), crcs=np.array(self.crcs, dtype=np.uint32), predictions=np.array(self.predictions) )
+            tmp_filepath.replace (filepath)
+        self.stem = None
+
+    def __call__(self, faces):
+        if self.stem is None:
+            return self.predictor (faces)
+
+        crc = zlib.crc32 ( np.ascontiguousarray(faces) )
+        if crc in self.crcs:
+            prediction = self.predictions[ self.crcs.index(crc) ]
+            if prediction.shape[0] == faces.shape[0]:
+                return prediction.astype(np.float32)
+
+        result = self.predictor (faces)
+        self.crcs.append (crc)
+        self.predictions.append ( result.astype(np.float16) )
+        self.changed = True
+        return result
+
+def model_process(model_name, model_dir, in_options, sq, cq, client_cqs, batch_size, batch_wait_sec):
+    slots = None
     try:    
         model_path = Path(model_dir)
         
         import models 
         model = models.import_model(model_name)(model_path, **in_options)
         converter = model.get_converter(**in_options)
+
+        #measure sizes of predictor input and output by dummy predict, to allocate slots for them
+        predictor = converter.predictor
+        face_sizes = [0]
+        def dummy_predictor(faces):
+            result = predictor(faces)
+            face_sizes.append ( max (faces[0].nbytes, result[0].nbytes) )
+            return result
+        converter.predictor = dummy_predictor
         converter.dummy_predict()
-        
-        cq.put ( {'op':'init', 'converter' : converter.copy_and_set_predictor( None ) } )
+        converter.predictor = predictor
+
+        slots = FaceSlots (len(client_cqs), max(face_sizes)) if max(face_sizes) > 0 else None
+
+        cq.put ( {'op':'init', 'converter' : converter.copy_and_set_predictor( None ), 'slots' : slots, 'model_key' : model.get_model_key() } )
 
         closing = False
         while not closing:
-            while not sq.empty():
-                obj = sq.get()
-                obj_op = obj['op']
-                if obj_op == 'predict':
-                    result = converter.predictor ( obj['face'] )
-                    cq.put ( {'op':'predict_result', 'result':result} )
-                elif obj_op == 'close':                    
+            #gather requests until batch_size faces collected or batch_wait_sec passed since first request
+            requests = []
+            syncs = []
+            faces_count = 0
+            deadline = None
+            obj = sq.get()
+            while True:
+                if obj['op'] == 'sync':
+                    syncs.append (obj)
+                elif obj['op'] == 'predict':
+                    if 'slot' in obj:
+                        obj['faces'] = slots.read (obj['client_idx'], *obj['slot'])
+                    requests.append (obj)
+                    faces_count += len(obj['faces'])
+                elif obj['op'] == 'close':
                     closing = True
+
+                if closing or faces_count >= batch_size:
                     break
-            time.sleep(0.005)        
-                    
+
+                if deadline is None:
+                    deadline = time.time() + batch_wait_sec
+                try:
+                    obj = sq.get ( timeout=max(0, deadline - time.time()) )
+                except queue.Empty:
+                    break
+
+            if len(requests) != 0:
+                try:
+                    result = converter.predictor ( np.concatenate ( [ obj['faces'] for obj in requests ], 0 ) )
+                except Exception as e:
+                    result = None
+                    for obj in requests:
+                        client_cqs[ obj['client_idx'] ].put ( {'op':'predict_error', 'id': obj['id'], 'message': str(e) } )
+
+                i = 0
+                for obj in (requests if result is not None else []):
+                    n = len(obj['faces'])
+                    client_idx = obj['client_idx']
+                    obj_result = result[i:i+n]
+                    if 'slot' in obj and slots.fits(obj_result):
+                        client_cqs[client_idx].put ( {'op':'predict_result', 'id': obj['id'], 'slot': slots.write (client_idx, obj_result) } )
+                    else:
+                        client_cqs[client_idx].put ( {'op':'predict_result', 'id': obj['id'], 'result': obj_result } )
+                    i += n
+
+            #all requests sent before sync are replied, so slot of client is not written by model process anymore
+            for obj in syncs:
+                client_cqs[ obj['client_idx'] ].put ( {'op':'sync', 'id': obj['id'] } )
+
         model.finalize()
         
     except Exception as e:
         print ( 'Error: %s' % (str(e)))
         traceback.print_exc()
+    finally:
+        #slots file is owned by model process, removed on any exit
+        if slots is not None:
+            slots.close()
             
+def get_imwrite_params(ext, compression=None):
+    #cv2.imwrite params for output file extension
+    #compression - png: compression level 0..9, jpg: quality 1..100, webp: quality 1..100, lossless if None
+    ext = ext.lower()
+    if ext == '.png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(np.clip(compression, 0, 9)) if compression is not None else 3]
+    if ext == '.jpg' or ext == '.jpeg':
+        return [cv2.IMWRITE_JPEG_QUALITY, int(np.clip(compression, 1, 100)) if compression is not None else 95]
+    if ext == '.webp':
+        #quality above 100 is lossless
+        return [cv2.IMWRITE_WEBP_QUALITY, int(np.clip(compression, 1, 100)) if compression is not None else 101]
+    return []
+
 from utils.SubprocessorBase import SubprocessorBase
 class ConvertSubprocessor(SubprocessorBase):
+    #temporal coherence: max count of consecutive frames sent to process at once, plans of still faces are reused inside of the chunk
+    temporal_chunk_size = 16
+    #temporal coherence: memory of decoded frames held by process, chunk being converted and prefetched one,
+    #chunk is made smaller for large frames to fit it
+    temporal_chunk_memory = 256*1024*1024
+    #video input: memory of decoded frames sent by host to all processes, chunk is made smaller for large frames to fit it
+    video_sent_memory = 512*1024*1024
+    #temporal coherence: mean landmarks delta relative to face size, below which landmarks and plan of previous frame are reused
+    temporal_reuse_delta = 0.005
+    #temporal coherence: mean landmarks delta relative to face size, below which landmarks are smoothed, above it face is new
+    temporal_smooth_delta = 0.05
+    #temporal coherence: weight of landmarks of current frame in smoothed landmarks
+    temporal_smooth_factor = 0.5
+    #count of converted frames, which wait for writer thread of process
+    write_queue_size = 4
 
     #override
-    def __init__(self, converter, input_path_image_paths, output_path, alignments, debug): 
-        super().__init__('Converter')    
-        self.converter = converter
+    def __init__(self, converters, input_path_image_paths, output_path, alignments, debug, workers=None, video_path=None, frame_sink=None, plans=None, predictions_path=None, temporal_coherence=False, output_format=None, output_compression=None, resume_path=None):
+        #converters - one per process, count must be not less than max workers
+        #plans - PlanCache of converter, new plans built by processes are put to it
+        #predictions_path - directory, where predictions of model are cached by processes
+        #video_path - input_path_image_paths are frames of this video, decoded by host
+        #frame_sink - converted frames are returned to host and written to it in order of input_path_image_paths
+        #temporal_coherence - faces of consecutive frames are tracked by host over all frames before convert, to smooth their landmarks
+        #                     and to reuse landmarks of still faces, so tracks do not depend on chunks,
+        #                     frames are given to processes in contiguous ranges to reuse plans of still faces
+        #output_format - extension of output files 'png', 'jpg', 'webp', None - same as input file
+        #output_compression - see get_imwrite_params
+        #resume_path - file, where remaining frames are saved if convert is interrupted, it is removed when convert is finished
+        self.workers_range = SubprocessorBase.get_workers_range(workers) if not debug else None
+        if debug:
+            chunk_size = 1
+        elif temporal_coherence:
+            chunk_size = ConvertSubprocessor.get_temporal_chunk_size (input_path_image_paths)
+        else:
+            chunk_size = 0
+        super().__init__('Converter', chunk_size = chunk_size, workers_range = self.workers_range, client_prefetch = not debug)
+        if video_path is not None and not debug and len(input_path_image_paths) > 0:
+            count = VideoIO.get_frames_per_memory (input_path_image_paths[0], ConvertSubprocessor.video_sent_memory // (self.workers_range[1]*self.prefetch_depth) )
+            if count is not None:
+                self.chunk_max_size = int ( np.clip (count, 1, self.chunk_max_size) )
+                if self.chunk_size != 0:
+                    self.chunk_size = min (self.chunk_size, self.chunk_max_size)
+        self.converters = converters
         self.input_path_image_paths = input_path_image_paths
         self.output_path = output_path
         self.alignments = alignments
         self.debug = debug
-        
-        self.input_data = self.input_path_image_paths
+        self.plans = plans
+        self.predictions_path = predictions_path
+        self.temporal_coherence = temporal_coherence
+        self.output_format = output_format
+        self.output_compression = output_compression
+        self.resume_path = resume_path
+
+        self.frame_source = None
+        if video_path is not None:
+            self.input_path_image_paths = sorted ( self.input_path_image_paths, key=VideoIO.get_frame_idx )
+            self.frame_source = VideoIO.VideoFrameSource (video_path, [ VideoIO.get_frame_idx(x) for x in self.input_path_image_paths ] )
+        elif temporal_coherence:
+            self.input_path_image_paths = sorted ( self.input_path_image_paths )
+
+        self.tracked_alignments = None
+        if temporal_coherence:
+            self.tracked_alignments = ConvertSubprocessor.track_alignments (alignments, [ Path(str(x)).stem for x in self.input_path_image_paths ] )
+
+        self.frame_sink = frame_sink
+        self.frame_positions = { x : i for i, x in enumerate(self.input_path_image_paths) } if frame_sink is not None else None
+
+        self.input_data = WorkQueue(self.input_path_image_paths)
         self.files_processed = 0
         self.faces_processed = 0
         
+    @staticmethod
+    def get_temporal_chunk_size(input_path_image_paths):
+        #frame size is taken from first frame
+        count = VideoIO.get_frames_per_memory (input_path_image_paths[0], ConvertSubprocessor.temporal_chunk_memory // 2) if len(input_path_image_paths) > 0 else None
+        if count is None:
+            return ConvertSubprocessor.temporal_chunk_size
+        return int ( np.clip ( count, 2, ConvertSubprocessor.temporal_chunk_size ) )
+
+    @staticmethod
+    def track_alignments(alignments, stems):
+        #returns AlignmentsTable of float32 landmarks, in which faces of frames stems, given in order of frames,
+        #are matched to the nearest faces of previous frame
+        #still faces reuse landmarks of previous frame, slowly moving faces get smoothed landmarks,
+        #so geometry of face does not jitter between frames
+        tracked = {}
+        tracks = []
+        for stem in stems:
+            if stem not in alignments:
+                tracks = []
+                continue
+            prev_tracks = list(tracks)
+            tracks = []
+            for image_landmarks in alignments[stem]:
+                landmarks = image_landmarks.astype(np.float32)
+                face_size = max ( np.ptp (landmarks, axis=0).max(), 1.0 )
+
+                delta = None
+                for i, prev_landmarks in enumerate(prev_tracks):
+                    d = np.mean ( np.linalg.norm (landmarks - prev_landmarks, axis=1) ) / face_size
+                    if delta is None or d < delta:
+                        track_idx, delta = i, d
+
+                if delta is not None and delta < ConvertSubprocessor.temporal_smooth_delta:
+                    prev_landmarks = prev_tracks.pop (track_idx)
+                    if delta < ConvertSubprocessor.temporal_reuse_delta:
+                        landmarks = prev_landmarks
+                    else:
+                        landmarks = prev_landmarks + (landmarks - prev_landmarks) * ConvertSubprocessor.temporal_smooth_factor
+                tracks.append (landmarks)
+            tracked[stem] = tracks
+        return AlignmentsTable (tracked)
+
+    #override
+    def process(self):
+        try:
+            return super().process()
+        finally:
+            if self.tracked_alignments is not None:
+                self.tracked_alignments.close()
+
     #override
     def process_info_generator(self):
-        r = [0] if self.debug else range(multiprocessing.cpu_count())
+        r = [0] if self.debug else range(self.workers_range[1])
         for i in r:
             yield 'CPU%d' % (i), {}, {'device_idx': i,
                                       'device_name': 'CPU%d' % (i), 
-                                      'converter' : self.converter, 
+                                      'converter' : self.converters[i],
                                       'output_dir' : str(self.output_path), 
+                                      'output_frames' : self.frame_sink is not None,
                                       'alignments' : self.alignments,
+                                      'tracked_alignments' : self.tracked_alignments,
+                                      'plans' : self.plans,
+                                      'predictions_path' : self.predictions_path,
+                                      'temporal_coherence' : self.temporal_coherence,
+                                      'output_format' : self.output_format,
+                                      'output_compression' : self.output_compression,
                                       'debug': self.debug }
      
     #override
@@ -101,13 +578,19 @@ class ConvertSubprocessor(SubprocessorBase):
         
     #override
     def onHostGetData(self):
-        if len (self.input_data) > 0:
-            return self.input_data.pop(0)            
-        return None
+        data = self.input_data.get()
+        if data is not None and self.frame_source is not None and not isinstance(data, VideoIO.VideoFrame):
+            data = self.frame_source.get(data)
+        return data
     
+    #override
+    def onHostKeepSentData (self, data):
+        #decoded frame is not kept, it is decoded again if data is returned
+        return str(data)
+
     #override
     def onHostDataReturn (self, data):
-        self.input_data.insert(0, data)   
+        self.input_data.put_front (data)
         
     #override
     def onClientInitialize(self, client_dict):
@@ -116,32 +599,106 @@ class ConvertSubprocessor(SubprocessorBase):
         self.device_name = client_dict['device_name']
         self.converter   = client_dict['converter']
         self.output_path = Path(client_dict['output_dir']) if 'output_dir' in client_dict.keys() else None        
+        self.output_frames = client_dict['output_frames']
         self.alignments  = client_dict['alignments']
+        self.tracked_alignments = client_dict['tracked_alignments']
+        self.plans       = client_dict['plans']
+        self.temporal_coherence = client_dict['temporal_coherence']
+        self.output_format = client_dict['output_format']
+        self.output_compression = client_dict['output_compression']
         self.debug       = client_dict['debug']
+        #[ (landmarks, plan) ] of faces of previous frame
+        self.prev_plans = []
+
+        #converted frames are encoded and written by separate thread, while next frame is converted
+        self.write_queue = queue.Queue(maxsize=ConvertSubprocessor.write_queue_size)
+        self.write_thread = threading.Thread(target=self.write_thread_func)
+        self.write_thread.daemon = True
+        self.write_thread.start()
+        self.frame_buffer = None
+        self.predictions = None
+        if client_dict['predictions_path'] is not None:
+            self.predictions = cached_predictor (self.converter.predictor, client_dict['predictions_path'])
+            self.converter.predictor = self.predictions
         return None
 
     #override
     def onClientFinalize(self):
-        pass
-        
+        self.write_queue.put (None)
+        self.write_thread.join()
+
+    #override
+    def onClientSendResult(self, obj):
+        #results are sent by writer thread after frames of their data are written
+        self.write_queue.put ( ('send', obj) )
+
+    def write_thread_func(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            if item[0] == 'send':
+                self.client_cq.put (item[1])
+                continue
+
+            _, filepath, image, result = item
+            try:
+                if not cv2.imwrite (filepath, image, get_imwrite_params (os.path.splitext(filepath)[1], self.output_compression) ):
+                    result[4] = 'Unable to write %s' % (filepath)
+            except:
+                result[4] = 'Unable to write %s: %s' % (filepath, traceback.format_exc())
+            if result[4] is not None:
+                #frame is reported to host as not processed
+                result[0] = 0
+                result[1] = 0
+
+    #override
+    def onClientPrefetchData(self, data):
+        #decodes frame, while previous one is converted
+        if isinstance(data, VideoIO.VideoFrame):
+            return data
+        if self.converter.get_mode() == ConverterBase.MODE_FACE and Path(data).stem not in self.alignments and \
+           not self.output_frames and self.output_format is None:
+            #file is copied without decoding
+            return data
+        return VideoIO.VideoFrame (data, VideoIO.imread(data))
+
     #override
     def onClientProcessData(self, data):
         filename_path = Path(data)
 
         files_processed = 1
         faces_processed = 0
+        output_image = None
+        new_plans = []
             
-        output_filename_path = self.output_path / filename_path.name
-        if self.converter.get_mode() == ConverterBase.MODE_FACE and filename_path.stem not in self.alignments.keys():                    
+        if self.output_format is not None:
+            output_filename_path = self.output_path / (filename_path.stem + '.' + self.output_format)
+        else:
+            output_filename_path = self.output_path / filename_path.name
+
+        if self.converter.get_mode() == ConverterBase.MODE_FACE and filename_path.stem not in self.alignments:                    
+            self.prev_plans = []
             if not self.debug:
                 print ( 'no faces found for %s, copying without faces' % (filename_path.name) )
-                shutil.copy ( str(filename_path), str(output_filename_path) )
+                if self.output_frames or self.output_format is not None or VideoIO.split_frame_path(data) is not None:
+                    output_image = VideoIO.imread(data)
+                else:
+                    shutil.copy ( str(filename_path), str(output_filename_path) )
         else:
-            image = (cv2.imread(str(filename_path)) / 255.0).astype(np.float32)
+            image = VideoIO.imread(data)
+            if image is None:
+                #frame count of video container may be larger than count of its frames
+                print ( 'Unable to read %s, skipping it' % (filename_path.name) )
+                return [0, 0, None, new_plans, None]
+
+            if self.predictions is not None:
+                self.predictions.load (filename_path.stem)
 
             if self.converter.get_mode() == ConverterBase.MODE_IMAGE:
+                image = self.load_frame (image)
                 image_landmarks = None
-                a_png = AlignedPNG.load( str(filename_path) )
+                a_png = AlignedPNG.load_metadata( str(filename_path) ) if VideoIO.split_frame_path(data) is None else None
                 if a_png is not None:                 
                     d = a_png.getFaceswapDictData()
                     if d is not None and 'landmarks' in d.keys():
@@ -152,38 +709,119 @@ class ConvertSubprocessor(SubprocessorBase):
                     for img in image:
                         cv2.imshow ('Debug convert', img )
                         cv2.waitKey(0)
+                else:
+                    image *= 255
+                    image = image.astype(np.uint8)
                 faces_processed = 1
             elif self.converter.get_mode() == ConverterBase.MODE_FACE:
                 faces = self.alignments[filename_path.stem]
-                for image_landmarks in faces:                
-                    image = self.converter.convert_face(image, image_landmarks, self.debug)     
+                img_size = (image.shape[1], image.shape[0])
+                if self.temporal_coherence:
+                    faces = self.get_tracked_faces (filename_path.stem, img_size, new_plans)
+                else:
+                    faces = [ (image_landmarks, self.get_plan (filename_path.stem, face_idx, img_size, image_landmarks, new_plans) ) for face_idx, image_landmarks in enumerate(faces) ]
+
+                #faces are pasted to uint8 frame in place, float32 is used only around faces
+                for image_landmarks, plan in faces:
+                    image = self.converter.convert_face(image, image_landmarks, self.debug, plan=plan)     
                     if self.debug:
                         for img in image:
                             cv2.imshow ('Debug convert', img )
                             cv2.waitKey(0)
                 faces_processed = len(faces)
+
+            if self.predictions is not None:
+                self.predictions.save()
                     
             if not self.debug:
-                cv2.imwrite (str(output_filename_path), (image*255).astype(np.uint8) )
-            
+                output_image = image
+
+        #result - [files processed, faces processed, output image for host, new plans, error message of write]
+        result = [files_processed, faces_processed, None, new_plans, None]
+        if output_image is not None:
+            if self.output_frames:
+                result[2] = output_image
+            else:
+                self.write_queue.put ( ('write', str(output_filename_path), output_image, result) )
             
-        return (files_processed, faces_processed)
+        return result
         
+    def get_plan(self, stem, face_idx, img_size, image_landmarks, new_plans):
+        #returns cached plan or builds it, built plans are appended to new_plans for host
+        if self.plans is None:
+            return None
+        plan = self.plans.get (stem, face_idx, img_size, image_landmarks)
+        if plan is None:
+            plan = self.converter.build_plan (img_size, image_landmarks)
+            new_plans.append ( (stem, face_idx, img_size, np.array(image_landmarks), plan) )
+        return plan
+
+    def get_tracked_faces(self, stem, img_size, new_plans):
+        #returns [ (landmarks, plan) ] of tracked faces of frame, still faces reuse plan of previous frame
+        prev_plans = self.prev_plans
+        self.prev_plans = []
+        faces = []
+        for face_idx, landmarks in enumerate(self.tracked_alignments[stem]):
+            plan = None
+            for prev_landmarks, prev_plan in prev_plans:
+                if np.array_equal (landmarks, prev_landmarks):
+                    plan = prev_plan
+                    break
+            if plan is None:
+                plan = self.get_plan (stem, face_idx, img_size, landmarks, new_plans)
+                if plan is None:
+                    plan = self.converter.build_plan (img_size, landmarks)
+            self.prev_plans.append ( (landmarks, plan) )
+
+            #landmarks of frame are kept integer for cv2 polygon functions
+            image_landmarks = np.round(landmarks).astype(self.alignments.dtype) if np.issubdtype(self.alignments.dtype, np.integer) else landmarks
+            faces.append ( (image_landmarks, plan) )
+        return faces
+
+    def load_frame(self, image):
+        #converts uint8 frame to float32 [0..1] in reused per-process buffer, without float64 temporaries
+        if self.frame_buffer is None or self.frame_buffer.shape != image.shape:
+            self.frame_buffer = np.empty (image.shape, dtype=np.float32)
+        self.frame_buffer[...] = image
+        self.frame_buffer /= 255.0
+        return self.frame_buffer
+
     #override
     def onHostResult (self, data, result):
+        if result[4] is not None:
+            print (result[4])
         self.files_processed += result[0]
         self.faces_processed += result[1]    
+        if self.frame_sink is not None:
+            #frame without output is skipped by sink, so next frames are not held
+            self.frame_sink.put ( self.frame_positions[str(data)], result[2] )
+        for plan in result[3]:
+            self.plans.put (*plan)
         return 1
+
+    #override
+    def onHostProcessEnd(self):
+        if self.frame_source is not None:
+            self.frame_source.close()
+
+        if self.resume_path is not None:
+            if self.interrupted and len(self.input_data) > 0:
+                WorkQueue ( [ str(x) for x in self.input_data ] ).save (self.resume_path)
+                print ('Convert is interrupted, %d frames are left. Run it again with the same input and output to continue.' % (len(self.input_data)) )
+            elif self.resume_path.exists():
+                self.resume_path.unlink()
              
     #override
     def get_start_return(self):
         return self.files_processed, self.faces_processed
         
-def main (input_dir, output_dir, aligned_dir, model_dir, model_name, **in_options):
+def main (input_dir, output_dir, aligned_dir, model_dir, model_name, workers=None, predict_batch_size=16, predict_batch_wait_ms=5, use_plan_cache=True, cache_predictions=False, temporal_coherence=False, output_format=None, output_compression=None, **in_options):
     print ("Running converter.\r\n")
     
     debug = in_options['debug']
     
+    model_p = None
+    alignments = None
     try:
         input_path = Path(input_dir)
         output_path = Path(output_dir)
@@ -194,9 +832,33 @@ def main (input_dir, output_dir, aligned_dir, model_dir, model_name, **in_option
             print('Input directory not found. Please ensure it exists.')
             return
 
-        if output_path.exists():
-            for filename in Path_utils.get_image_paths(output_path):
-                Path(filename).unlink()
+        #input and output may be video files, frames are decoded and encoded on the fly
+        video_path = str(input_path) if input_path.is_file() and VideoIO.is_video_path(input_path) else None
+        output_video = VideoIO.is_video_path(output_path) and not output_path.is_dir() and not debug
+
+        if video_path is not None:
+            input_path_image_paths = VideoIO.get_frame_paths(video_path)
+        else:
+            input_path_image_paths = Path_utils.get_image_paths(input_path)
+
+        #frames left by interrupted convert into the same output dir, converted frames are kept
+        resume_path = output_path.parent / (output_path.name + '_resume.dat') if not output_video and not debug else None
+        resumed_paths = None
+        if resume_path is not None and resume_path.exists():
+            resumed_paths = list ( WorkQueue.load (resume_path) )
+            if not set(resumed_paths).issubset (input_path_image_paths):
+                #input is changed since
+                resumed_paths = None
+
+        if output_video:
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+        elif output_path.exists():
+            if resumed_paths is not None:
+                print ('Resuming interrupted convert, %d of %d frames are left.' % (len(resumed_paths), len(input_path_image_paths)) )
+                input_path_image_paths = resumed_paths
+            else:
+                for filename in Path_utils.get_image_paths(output_path):
+                    Path(filename).unlink()
         else:
             output_path.mkdir(parents=True, exist_ok=True)
             
@@ -208,30 +870,36 @@ def main (input_dir, output_dir, aligned_dir, model_dir, model_name, **in_option
             print('Model directory not found. Please ensure it exists.')
             return
    
+        workers = SubprocessorBase.get_workers_range(workers)
+        clients_count = 1 if debug else workers[1]
+
         model_sq = multiprocessing.Queue()
         model_cq = multiprocessing.Queue()
-        model_lock = multiprocessing.Lock()
-        
-        model_p = multiprocessing.Process(target=model_process, args=(model_name, model_dir, in_options, model_sq, model_cq))
+        model_client_cqs = [ multiprocessing.Queue() for i in range(clients_count) ]
+
+        model_p = multiprocessing.Process(target=model_process, args=(model_name, model_dir, in_options, model_sq, model_cq, model_client_cqs, max(1, predict_batch_size), predict_batch_wait_ms / 1000.0))
         model_p.start()
         
         while True:
-            if not model_cq.empty():
-                obj = model_cq.get()
-                obj_op = obj['op']
-                if obj_op == 'init':
-                    converter = obj['converter']
-                    break
+            try:
+                obj = model_cq.get (timeout=1.0)
+            except queue.Empty:
+                if not model_p.is_alive():
+                    raise Exception ('Model process is terminated before its initialization.')
+                continue
+            obj_op = obj['op']
+            if obj_op == 'init':
+                converter = obj['converter']
+                model_slots = obj['slots']
+                model_key = obj['model_key']
+                break
                     
-        alignments = {}            
+        alignments = {}
         if converter.get_mode() == ConverterBase.MODE_FACE:
-            aligned_path_image_paths = Path_utils.get_image_paths(aligned_path)
-            for filename in tqdm(aligned_path_image_paths, desc= "Collecting alignments" ):
-                a_png = AlignedPNG.load( str(filename) )
-                if a_png is None:
-                    print ( "%s - no embedded data found." % (filename) )
-                    continue
-                d = a_png.getFaceswapDictData()
+            aligned_index = PackedFaceset.load_index (aligned_path)
+            for i in tqdm( range(len(aligned_index)), desc= "Collecting alignments" ):
+                filename = aligned_index.get_filepath(i)
+                d = aligned_index.get_dict(i)
                 if d is None or d['source_filename'] is None or d['source_rect'] is None or d['source_landmarks'] is None:
                     print ( "%s - no embedded data found." % (filename) )
                     continue
@@ -242,15 +910,45 @@ def main (input_dir, output_dir, aligned_dir, model_dir, model_name, **in_option
 
                 alignments[ source_filename_stem ].append ( np.array(d['source_landmarks']) )
 
+        alignments = AlignmentsTable (alignments)
+
+        #plans are cached next to aligned dir, so convert of the same faces with other blending options skips geometry work
+        plans = None
+        plan_key = converter.get_plan_key()
+        if use_plan_cache and plan_key is not None and converter.get_mode() == ConverterBase.MODE_FACE:
+            plans = PlanCache ( aligned_path.parent / (aligned_path.name + '_cache') / ('plans_%s' % (plan_key)) )
+
+        #predictions are cached per saved state of model, so convert of the same faces with other blending options does not predict again
+        predictions_path = None
+        if cache_predictions:
+            predictions_path = str ( aligned_path.parent / (aligned_path.name + '_cache') / ('predictions_%s' % (model_key)) )
+
+        frame_sink = None
+        if output_video:
+            fps = VideoIO.get_video_info(video_path)[1] if video_path is not None else None
+            frame_sink = VideoIO.VideoFrameSink (output_path, fps)
+
         files_processed, faces_processed = ConvertSubprocessor ( 
-                    converter              = converter.copy_and_set_predictor( model_process_predictor(model_sq,model_cq,model_lock) ), 
-                    input_path_image_paths = Path_utils.get_image_paths(input_path), 
+                    converters             = [ converter.copy_and_set_predictor( model_process_predictor(model_sq, model_client_cqs[i], i, model_slots, model_p.pid) ) for i in range(clients_count) ],
+                    input_path_image_paths = input_path_image_paths,
                     output_path            = output_path,
                     alignments             = alignments,                                     
-                    debug                  = debug ).process()
-                              
-        model_sq.put ( {'op':'close'} )
-        model_p.join()
+                    debug                  = debug,
+                    workers                = workers,
+                    video_path             = video_path,
+                    frame_sink             = frame_sink,
+                    plans                  = plans,
+                    predictions_path       = predictions_path,
+                    temporal_coherence     = temporal_coherence,
+                    output_format          = output_format,
+                    output_compression     = output_compression,
+                    resume_path            = resume_path ).process()
+
+        if frame_sink is not None:
+            frame_sink.close()
+
+        if plans is not None:
+            plans.save()
         
         '''            
         if model_name == 'AVATAR':
@@ -279,5 +977,13 @@ def main (input_dir, output_dir, aligned_dir, model_dir, model_name, **in_option
     except Exception as e:
         print ( 'Error: %s' % (str(e)))
         traceback.print_exc()
+    finally:
+        #converter processes are finished here, shared files are removed and model process is stopped on any exit
+        if isinstance(alignments, AlignmentsTable):
+            alignments.close()
+        if model_p is not None:
+            if model_p.is_alive():
+                model_sq.put ( {'op':'close'} )
+            model_p.join()
     
    
@@ -2,6 +2,9 @@
 import os
 import sys
 import time
+import pickle
+import queue
+import threading
 import multiprocessing
 from tqdm import tqdm
 from pathlib import Path
@@ -9,6 +12,9 @@ import numpy as np
 import cv2
 from utils import Path_utils
 from utils.AlignedPNG import AlignedPNG
+from utils.WorkQueue import WorkQueue
+from utils.PackedFaceset import PackedFaceset
+from utils import VideoIO
 from utils import image_utils
 from facelib import FaceType
 import facelib
@@ -16,10 +22,19 @@ import gpufmkmgr
 
 from utils.SubprocessorBase import SubprocessorBase
 class ExtractSubprocessor(SubprocessorBase):
+    #video input of final pass: memory of decoded frames sent by host to all processes, chunk is made smaller for large frames to fit it
+    video_sent_memory = 512*1024*1024
 
     #override
-    def __init__(self, input_data, type, image_size, face_type, debug, multi_gpu=False, manual=False, manual_window_size=0, detector=None, output_path=None, input_path=None ):
-        self.input_data = input_data
+    def __init__(self, input_data, type, image_size, face_type, debug, multi_gpu=False, manual=False, manual_window_size=0, detector=None, output_path=None, input_path=None, manifest=None, workers=None, video_path=None ):
+        self.frame_source = None
+        if video_path is not None:
+            #frames are decoded in order by host and sent to clients with data
+            input_data = sorted ( input_data, key=lambda data: VideoIO.get_frame_idx(data[0]) )
+            if not manual:
+                self.frame_source = VideoIO.VideoFrameSource (video_path, [ VideoIO.get_frame_idx(data[0]) for data in input_data ] )
+
+        self.input_data = WorkQueue(input_data)
         self.type = type
         self.image_size = image_size
         self.face_type = face_type
@@ -31,10 +46,25 @@ class ExtractSubprocessor(SubprocessorBase):
         self.input_path = str(input_path)
         self.manual = manual
         self.manual_window_size = manual_window_size
+        self.manifest = manifest
+        self.workers_range = SubprocessorBase.get_workers_range(workers) if self.type == 'final' else None
         self.result = []
 
         no_response_time_sec = 60 if not self.manual else 999999
-        super().__init__('Extractor', no_response_time_sec)
+        #manual pass draws every result before asking for the next rect
+        prefetch_depth = 2 if not self.manual else 1
+        if self.manual:
+            chunk_size = 1
+        elif self.type == 'final':
+            chunk_size = 0
+        else:
+            #frames detected on GPU in one batch
+            chunk_size = 4
+        super().__init__('Extractor', no_response_time_sec, prefetch_depth, chunk_size, self.workers_range)
+        if self.frame_source is not None and self.type == 'final' and len(input_data) > 0:
+            count = VideoIO.get_frames_per_memory (input_data[0][0], ExtractSubprocessor.video_sent_memory // (self.workers_range[1]*self.prefetch_depth) )
+            if count is not None:
+                self.chunk_max_size = int ( np.clip (count, 1, self.chunk_max_size) )
 
     #override
     def onHostClientsInitialized(self):
@@ -62,7 +92,7 @@ class ExtractSubprocessor(SubprocessorBase):
             cv2.setMouseCallback(self.wnd_name, onMouse, self.param)
 
     def get_devices_for_type (self, type, multi_gpu):
-        if (type == 'rects' or type == 'landmarks'):
+        if (type == 'rects' or type == 'landmarks' or type == 'all'):
             if not multi_gpu:
                 devices = [gpufmkmgr.getBestDeviceIdx()]
             else:
@@ -70,7 +100,7 @@ class ExtractSubprocessor(SubprocessorBase):
             devices = [ (idx, gpufmkmgr.getDeviceName(idx), gpufmkmgr.getDeviceVRAMTotalGb(idx) ) for idx in devices]
 
         elif type == 'final':
-            devices = [ (i, 'CPU%d' % (i), 0 ) for i in range(0, multiprocessing.cpu_count()) ]
+            devices = [ (i, 'CPU%d' % (i), 0 ) for i in range(0, self.workers_range[1]) ]
 
         return devices
 
@@ -80,6 +110,9 @@ class ExtractSubprocessor(SubprocessorBase):
             num_processes = 1
             if not self.manual and self.type == 'rects' and self.detector == 'mt':
                 num_processes = int ( max (1, device_total_vram_gb / 2) )
+            elif not self.manual and self.type == 'all' and self.detector == 'mt':
+                #each process also holds 2DFAN
+                num_processes = int ( max (1, device_total_vram_gb / 3) )
 
             for i in range(0, num_processes ):
                 device_name_for_process = device_name if num_processes == 1 else '%s #%d' % (device_name,i)
@@ -94,7 +127,7 @@ class ExtractSubprocessor(SubprocessorBase):
 
     #override
     def get_no_process_started_message(self):
-        if (self.type == 'rects' or self.type == 'landmarks'):
+        if (self.type == 'rects' or self.type == 'landmarks' or self.type == 'all'):
             print ( 'You have no capable GPUs. Try to close programs which can consume VRAM, and run again.')
         elif self.type == 'final':
             print ( 'Unable to start CPU processes.')
@@ -110,13 +143,15 @@ class ExtractSubprocessor(SubprocessorBase):
     #override
     def onHostGetData(self):
         if not self.manual:
-            if len (self.input_data) > 0:
-                return self.input_data.pop(0)
+            data = self.input_data.get()
+            if data is not None and self.frame_source is not None and not isinstance(data[0], VideoIO.VideoFrame):
+                data = [ self.frame_source.get(data[0]) ] + list(data[1:])
+            return data
         else:
             skip_remaining = False
             allow_remark_faces = False
             while len (self.input_data) > 0:
-                data = self.input_data[0]
+                data = self.input_data.peek()
                 filename, faces = data
 
                 is_frame_done = False
@@ -127,7 +162,7 @@ class ExtractSubprocessor(SubprocessorBase):
                     self.param['rect_locked'] = False
                     self.param['skipped'] = False
 
-                    new_image = cv2.imread(filename)
+                    new_image = VideoIO.imread(filename)
                     old_image = self.original_image
                     self.original_image = new_image
 
@@ -257,27 +292,34 @@ class ExtractSubprocessor(SubprocessorBase):
 
                 if is_frame_done:
                     self.result.append ( data )
-                    self.input_data.pop(0)
+                    self.input_data.get()
                     self.inc_progress_bar(1)
                     self.param['redraw_needed'] = True
                     self.param['rect_locked'] = False
                 elif go_to_prev_frame:
-                    self.input_data.insert(0, self.result.pop() )
+                    self.input_data.put_front ( self.result.pop() )
                     self.inc_progress_bar(-1)
                     allow_remark_faces = True
                     self.param['redraw_needed'] = True
                     self.param['rect_locked'] = False
                 elif skip_remaining:
                     while len(self.input_data) > 0:
-                        self.result.append( self.input_data.pop(0) )
+                        self.result.append( self.input_data.get() )
                         self.inc_progress_bar(1)
 
         return None
 
+    #override
+    def onHostKeepSentData (self, data):
+        #decoded frame is not kept, it is decoded again if data is returned
+        if self.frame_source is not None:
+            return [ str(data[0]) ] + list(data[1:])
+        return data
+
     #override
     def onHostDataReturn (self, data):
         if not self.manual:
-            self.input_data.insert(0, data)
+            self.input_data.put_front (data)
 
     #override
     def onClientInitialize(self, client_dict):
@@ -294,110 +336,186 @@ class ExtractSubprocessor(SubprocessorBase):
         self.tf = None
         self.tf_session = None
 
-        self.e = None
-        if self.type == 'rects':
+        self.rects_extractor = None
+        self.landmarks_extractor = None
+        self.final_thread = None
+
+        if self.type == 'rects' or self.type == 'all':
             if self.detector is not None:
                 if self.detector == 'mt':
                     self.tf = gpufmkmgr.import_tf ([self.device_idx], allow_growth=True)
                     self.tf_session = gpufmkmgr.get_tf_session()
                     self.keras = gpufmkmgr.import_keras()
-                    self.e = facelib.MTCExtractor(self.keras, self.tf, self.tf_session)
+                    self.rects_extractor = facelib.MTCExtractor(self.keras, self.tf, self.tf_session)
                 elif self.detector == 'dlib':
                     self.tf = gpufmkmgr.import_tf ([self.device_idx], allow_growth=True)
                     self.tf_session = gpufmkmgr.get_tf_session()
                     self.dlib = gpufmkmgr.import_dlib( self.device_idx )
-                    self.e = facelib.DLIBExtractor(self.dlib)
-                self.e.__enter__()
+                    self.rects_extractor = facelib.DLIBExtractor(self.dlib)
+                self.rects_extractor.__enter__()
+
+        if self.type == 'landmarks' or self.type == 'all':
+            if self.tf is None:
+                self.tf = gpufmkmgr.import_tf([self.device_idx], allow_growth=True)
+                self.tf_session = gpufmkmgr.get_tf_session()
+            if self.keras is None:
+                self.keras = gpufmkmgr.import_keras()
+            self.landmarks_extractor = facelib.LandmarksExtractor(self.keras)
+            self.landmarks_extractor.__enter__()
+
+        if self.type == 'all':
+            #align and write faces on CPU while GPU detects next frame
+            self.final_queue = queue.Queue(maxsize=4)
+            self.final_thread = threading.Thread(target=self.final_thread_func)
+            self.final_thread.daemon = True
+            self.final_thread.start()
 
-        elif self.type == 'landmarks':
-            self.tf = gpufmkmgr.import_tf([self.device_idx], allow_growth=True)
-            self.tf_session = gpufmkmgr.get_tf_session()
-            self.keras = gpufmkmgr.import_keras()
-            self.e = facelib.LandmarksExtractor(self.keras)
-            self.e.__enter__()
+        return None
 
-        elif self.type == 'final':
-            pass
+    def final_thread_func(self):
+        while True:
+            item = self.final_queue.get()
+            if item is None:
+                break
+            if item[0] == 'send':
+                self.client_cq.put (item[1])
+                continue
+
+            _, filename_path, image, faces, result = item
+            try:
+                self.save_faces (filename_path, image, faces)
+            except:
+                #frame is reported to host as not extracted
+                result[2] = 'Exception while saving faces [%s]: %s' % (filename_path, traceback.format_exc())
 
-        return None
+    #override
+    def onClientSendResult(self, obj):
+        if self.final_thread is not None:
+            #results are sent by final thread after faces of their frames are saved
+            self.final_queue.put ( ('send', obj) )
+        else:
+            super().onClientSendResult (obj)
 
     #override
     def onClientFinalize(self):
-        if self.e is not None:
-            self.e.__exit__()
+        if self.final_thread is not None:
+            self.final_queue.put (None)
+            self.final_thread.join()
+        if self.rects_extractor is not None:
+            self.rects_extractor.__exit__()
+        if self.landmarks_extractor is not None:
+            self.landmarks_extractor.__exit__()
 
     #override
     def onClientProcessData(self, data):
+        if self.type != 'final':
+            return self.extract_batch ( [data] )[0]
+
         filename_path = data[0]
 
-        image = cv2.imread( filename_path )
+        image = VideoIO.imread( filename_path )
         if image is None:
             print ( 'Failed to extract %s, reason: cv2.imread() fail.' % ( filename_path ) )
         else:
-            if self.type == 'rects':
-                rects = self.e.extract_from_bgr (image)
-                return [filename_path, rects]
+            return self.save_faces (filename_path, image, data[1])
+        return None
+
+    #override
+    def onClientProcessDataList(self, data_list, result_list):
+        if self.type == 'final':
+            super().onClientProcessDataList (data_list, result_list)
+        else:
+            result_list += self.extract_batch (data_list)
 
-            elif self.type == 'landmarks':
-                rects = data[1]
-                landmarks = self.e.extract_from_bgr (image, rects)
-                return [filename_path, landmarks]
+    def extract_batch(self, data_list):
+        result = [None] * len(data_list)
 
-            elif self.type == 'final':
-                result = []
-                faces = data[1]
-
-                rel_output_name, abs_output_name, debug_file_name = ExtractSubprocessor.GenerateOutputPaths( filename_path, self.input_path, self.output_path )
-                os.makedirs( os.path.dirname(abs_output_name), exist_ok=True)
-                if self.debug:
-                    os.makedirs( os.path.dirname(debug_file_name), exist_ok=True)
-                    debug_image = image.copy()
-
-                out_path,out_ext = os.path.splitext(abs_output_name)
-                for (face_idx, face) in enumerate(faces):
-                    if face is None: # indicates skip
-                        output_file = "{}.skip".format( out_path )
-                        open( output_file, 'w' )
-                        break
-
-                    output_file = "{}_{}{}".format( out_path, face_idx, out_ext )
-                    rect = face[0]
-                    image_landmarks = np.array(face[1])
-
-                    if self.debug:
-                        facelib.LandmarksProcessor.draw_rect_landmarks (debug_image, rect, image_landmarks, self.image_size, self.face_type)
-
-                    if self.face_type == FaceType.MARK_ONLY:
-                        face_image = image
-                        face_image_landmarks = image_landmarks
-                    else:
-                        image_to_face_mat = facelib.LandmarksProcessor.get_transform_mat (image_landmarks, self.image_size, self.face_type)
-                        face_image = cv2.warpAffine(image, image_to_face_mat, (self.image_size, self.image_size), cv2.INTER_LANCZOS4)
-                        face_image_landmarks = facelib.LandmarksProcessor.transform_points (image_landmarks, image_to_face_mat)
+        images = []
+        idxs = []
+        for i, data in enumerate(data_list):
+            image = VideoIO.imread( data[0] )
+            if image is None:
+                print ( 'Failed to extract %s, reason: cv2.imread() fail.' % ( data[0] ) )
+            else:
+                images.append (image)
+                idxs.append (i)
 
-                    cv2.imwrite(output_file, face_image)
+        if len(images) == 0:
+            return result
 
-                    a_png = AlignedPNG.load (output_file)
+        if self.type == 'rects':
+            rects_list = self.rects_extractor.extract_from_bgr_batch (images)
+            for i, rects in zip(idxs, rects_list):
+                result[i] = [str(data_list[i][0]), rects]
 
-                    d = {
-                      'face_type': FaceType.toString(self.face_type),
-                      'landmarks': face_image_landmarks.tolist(),
-                      'yaw_value': facelib.LandmarksProcessor.calc_face_yaw (face_image_landmarks),
-                      'pitch_value': facelib.LandmarksProcessor.calc_face_pitch (face_image_landmarks),
-                      'source_filename': rel_output_name,
-                      'source_rect': rect,
-                      'source_landmarks': image_landmarks.tolist()
-                    }
-                    a_png.setFaceswapDictData (d)
-                    a_png.save(output_file)
+        elif self.type == 'landmarks':
+            landmarks_list = self.landmarks_extractor.extract_from_bgr_batch (images, [ data_list[i][1] for i in idxs ] )
+            for i, landmarks in zip(idxs, landmarks_list):
+                result[i] = [str(data_list[i][0]), landmarks]
+
+        elif self.type == 'all':
+            rects_list = self.rects_extractor.extract_from_bgr_batch (images)
+            faces_list = self.landmarks_extractor.extract_from_bgr_batch (images, rects_list)
+            for i, image, faces in zip(idxs, images, faces_list):
+                #[filename, faces count, error message of save]
+                result[i] = [str(data_list[i][0]), len(faces), None]
+                self.final_queue.put ( ('save', data_list[i][0], image, faces, result[i]) )
+
+        return result
+
+    def save_faces(self, filename_path, image, faces):
+        result = []
+
+        rel_output_name, abs_output_name, debug_file_name = ExtractSubprocessor.GenerateOutputPaths( filename_path, self.input_path, self.output_path )
+        os.makedirs( os.path.dirname(abs_output_name), exist_ok=True)
+        if self.debug:
+            os.makedirs( os.path.dirname(debug_file_name), exist_ok=True)
+            debug_image = image.copy()
+
+        out_path,out_ext = os.path.splitext(abs_output_name)
+        for (face_idx, face) in enumerate(faces):
+            if face is None: # indicates skip
+                output_file = "{}.skip".format( out_path )
+                open( output_file, 'w' )
+                break
+
+            output_file = "{}_{}{}".format( out_path, face_idx, out_ext )
+            rect = face[0]
+            image_landmarks = np.array(face[1])
+
+            if self.debug:
+                facelib.LandmarksProcessor.draw_rect_landmarks (debug_image, rect, image_landmarks, self.image_size, self.face_type)
+
+            if self.face_type == FaceType.MARK_ONLY:
+                face_image = image
+                face_image_landmarks = image_landmarks
+            else:
+                image_to_face_mat = facelib.LandmarksProcessor.get_transform_mat (image_landmarks, self.image_size, self.face_type)
+                face_image = cv2.warpAffine(image, image_to_face_mat, (self.image_size, self.image_size), cv2.INTER_LANCZOS4)
+                face_image_landmarks = facelib.LandmarksProcessor.transform_points (image_landmarks, image_to_face_mat)
 
-                    result.append (output_file)
+            #face is encoded in memory and written once together with its data
+            ret, buf = cv2.imencode('.png', face_image)
+            a_png = AlignedPNG.from_bytes (buf.tobytes(), verify_crc=False)
 
-                if self.debug:
-                    cv2.imwrite(debug_file_name, debug_image )
+            d = {
+              'face_type': FaceType.toString(self.face_type),
+              'landmarks': face_image_landmarks,
+              'yaw_value': facelib.LandmarksProcessor.calc_face_yaw (face_image_landmarks),
+              'pitch_value': facelib.LandmarksProcessor.calc_face_pitch (face_image_landmarks),
+              'source_filename': rel_output_name,
+              'source_rect': rect,
+              'source_landmarks': image_landmarks
+            }
+            a_png.setFaceswapDictData (d)
+            a_png.save(output_file)
 
-                return result
-        return None
+            result.append (output_file)
+
+        if self.debug:
+            cv2.imwrite(debug_file_name, debug_image )
+
+        return result
 
         #overridable
     def onClientGetDataName (self, data):
@@ -423,12 +541,23 @@ class ExtractSubprocessor(SubprocessorBase):
             cv2.imshow (self.wnd_name, image)
             return 0
         else:
-            if self.type == 'rects':
-                self.result.append ( result )
-            elif self.type == 'landmarks':
-                self.result.append ( result )
+            if self.type == 'rects' or self.type == 'landmarks':
+                #frame failed to decode, for example frame count of video container is larger than count of its frames
+                if result is not None:
+                    self.result.append ( result )
             elif self.type == 'final':
-                self.result += result
+                if result is not None:
+                    self.result += result
+                    if self.manifest is not None:
+                        self.manifest.set (data[0], len(result), any ( [ face is None for face in data[1] ] ) )
+            elif self.type == 'all':
+                if result is not None:
+                    if result[2] is not None:
+                        print (result[2])
+                    else:
+                        self.result.append ( result )
+                        if self.manifest is not None:
+                            self.manifest.set (data[0], result[1], False )
 
             return 1
 
@@ -436,6 +565,10 @@ class ExtractSubprocessor(SubprocessorBase):
     def onHostProcessEnd(self):
         if self.manual == True:
             cv2.destroyAllWindows()
+        if self.frame_source is not None:
+            self.frame_source.close()
+        if self.manifest is not None:
+            self.manifest.save()
 
     #override
     def get_start_return(self):
@@ -455,17 +588,115 @@ class ExtractSubprocessor(SubprocessorBase):
         debug_file_name = os.path.join( output_path, output_folders, "debug", "{}_debug{}".format(name, ext) )
         return relative_output_name, abs_output_file_name, debug_file_name
 
+class ExtractManifest(object):
+    #record of extracted source images in the output dir, lets reruns skip unchanged inputs without probing output files
+    filename = 'extract_manifest.dat'
+    autosave_interval_sec = 30
+
+    def __init__(self, input_path, output_path):
+        self.input_path = input_path
+        self.output_path = Path(output_path)
+        self.filepath = self.output_path / ExtractManifest.filename
+        self.entries = {}
+        self.dirty = False
+        self.last_save_time = time.time()
+
+    def load(self):
+        if self.filepath.exists():
+            try:
+                self.entries = pickle.loads ( self.filepath.read_bytes() )['entries']
+            except:
+                print ('Unable to load %s, it will be rebuilt.' % (self.filepath) )
+                self.entries = {}
+
+    def get_output_names(self, filename):
+        rel_output_name, abs_output_name, _ = ExtractSubprocessor.GenerateOutputPaths( filename, self.input_path, self.output_path )
+        return rel_output_name, abs_output_name
+
+    def filter_pending(self, input_paths):
+        #returns inputs which are not extracted yet or have changed since extraction
+        output_files = None
+        result = []
+        for filename in input_paths:
+            rel_output_name, abs_output_name = self.get_output_names(filename)
+            st = os.stat( VideoIO.get_source_path(filename) )
+
+            entry = self.entries.get(rel_output_name, None)
+            if entry is not None:
+                if entry['mtime'] == st.st_mtime and entry['size'] == st.st_size:
+                    continue
+                self.remove_outputs (abs_output_name, entry)
+                del self.entries[rel_output_name]
+                self.dirty = True
+            else:
+                #output dir may be extracted without manifest, scan it once
+                if output_files is None:
+                    output_files = set ( [ os.path.join(root, f) for root, _, files in os.walk(str(self.output_path)) for f in files ] )
+
+                fname, fext = os.path.splitext(abs_output_name)
+                skipped = (fname + '.skip') in output_files
+                faces = 0
+                while "{}_{}{}".format(fname, faces, fext) in output_files:
+                    faces += 1
+
+                if skipped or faces > 0 or abs_output_name in output_files:
+                    self.entries[rel_output_name] = {'mtime': st.st_mtime, 'size': st.st_size, 'faces': faces, 'skipped': skipped}
+                    self.dirty = True
+                    continue
+
+            result.append (filename)
+        return result
+
+    def remove_outputs(self, abs_output_name, entry):
+        fname, fext = os.path.splitext(abs_output_name)
+        names = [ "{}_{}{}".format(fname, face_idx, fext) for face_idx in range(entry['faces']) ]
+        if entry['skipped']:
+            names.append ( fname + '.skip' )
+        for name in names:
+            if os.path.exists(name):
+                os.remove(name)
+
+    def set(self, filename, faces, skipped):
+        #images without faces are not recorded, so they are detected again on rerun, as if extracted without manifest
+        if faces == 0 and not skipped:
+            return
+        rel_output_name, _ = self.get_output_names(filename)
+        st = os.stat( VideoIO.get_source_path(filename) )
+        self.entries[rel_output_name] = {'mtime': st.st_mtime, 'size': st.st_size, 'faces': faces, 'skipped': skipped}
+        self.dirty = True
+        if (time.time() - self.last_save_time) > ExtractManifest.autosave_interval_sec:
+            self.save()
+
+    def reset(self):
+        #forgets all recorded images, previous manifest is replaced at once
+        self.entries = {}
+        self.dirty = True
+        self.save()
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        tmp_filepath = Path( str(self.filepath) + '.tmp' )
+        tmp_filepath.write_bytes ( pickle.dumps ( {'version': 1, 'entries': self.entries} ) )
+        os.replace ( str(tmp_filepath), str(self.filepath) )
+        self.dirty = False
+        self.last_save_time = time.time()
+
 '''
 detector
     'dlib'
     'mt'
     'manual'
 
+single_pass
+    decode every frame once and detect, landmark and save it in the same worker
+
 face_type
     'full_face'
     'avatar'
 '''
-def main (input_dir, output_dir, debug, detector='mt', multi_gpu=True, manual_fix=False, manual_window_size=0, image_size=256, face_type='full_face', recursive=False, remove_existing=False):
+def main (input_dir, output_dir, debug, detector='mt', multi_gpu=True, manual_fix=False, manual_window_size=0, image_size=256, face_type='full_face', recursive=False, remove_existing=False, single_pass=False, workers=None):
     print ("Running extractor.\r\n")
 
     input_path = Path(input_dir)
@@ -476,6 +707,12 @@ def main (input_dir, output_dir, debug, detector='mt', multi_gpu=True, manual_fi
         print('Input directory not found. Please ensure it exists.')
         return
 
+    if PackedFaceset.get_path(output_path).exists():
+        print ("Warning: %s is packed, extracted faces are not used until it is unpacked and packed again." % (str(output_path)) )
+
+    #input may be video file, its frames are decoded on the fly
+    video_path = str(input_path) if input_path.is_file() and VideoIO.is_video_path(input_path) else None
+
 
 
 #     if output_path.exists() and remove_existing:
@@ -492,34 +729,40 @@ def main (input_dir, output_dir, debug, detector='mt', multi_gpu=True, manual_fi
 #         else:
 #             debug_output_path.mkdir(parents=True, exist_ok=True)
 
-    input_path_image_paths = Path_utils.get_image_unique_filestem_paths(input_path, verbose=True, recursive=recursive)
-    if not remove_existing:
-        for item in input_path_image_paths[:]:
-            _, abs_output_name,_ = ExtractSubprocessor.GenerateOutputPaths( item, input_path, output_path )
-            fname, fext = os.path.splitext(abs_output_name)
-            face_names = []
-            face_names.append( os.path.join( "{}.skip".format( fname )) )
-            face_names.append( os.path.join(abs_output_name) )
-            for face_idx in range(5):
-                face_names.append( os.path.join( "{}_{}{}".format(fname, face_idx, fext)) )
-
-            for face_file_name in face_names:
-                if os.path.exists( face_file_name ):
-                    input_path_image_paths.remove(item)
-                    break
+    if video_path is not None:
+        input_path_image_paths = VideoIO.get_frame_paths(video_path)
+    else:
+        input_path_image_paths = Path_utils.get_image_unique_filestem_paths(input_path, verbose=True, recursive=recursive)
+
+    manifest = ExtractManifest (input_path, output_path)
+    if remove_existing:
+        #all images are extracted again and recorded in new manifest
+        manifest.reset()
+    else:
+        manifest.load()
+        images_total = len(input_path_image_paths)
+        input_path_image_paths = manifest.filter_pending (input_path_image_paths)
+        if len(input_path_image_paths) != images_total:
+            print ('Skipping %d already extracted images.' % (images_total - len(input_path_image_paths)) )
+        manifest.save()
 
     images_found = len(input_path_image_paths)
     faces_detected = 0
     if images_found != 0:
         if detector == 'manual':
             print ('Performing manual extract...')
-            extracted_faces = ExtractSubprocessor ([ (filename,[]) for filename in input_path_image_paths ], 'landmarks', image_size, face_type, debug, manual=True, manual_window_size=manual_window_size).process()
+            extracted_faces = ExtractSubprocessor ([ (filename,[]) for filename in input_path_image_paths ], 'landmarks', image_size, face_type, debug, manual=True, manual_window_size=manual_window_size, video_path=video_path).process()
+        elif single_pass and not manual_fix:
+            print ('Performing single pass...')
+            extracted_faces = []
+            extracted_counts = ExtractSubprocessor ([ (x,) for x in input_path_image_paths ], 'all', image_size, face_type, debug, multi_gpu=multi_gpu, manual=False, detector=detector, output_path=output_path, input_path=input_path, manifest=manifest, video_path=video_path).process()
+            faces_detected = sum ( [ result[1] for result in extracted_counts ] )
         else:
             print ('Performing 1st pass...')
-            extracted_rects = ExtractSubprocessor ([ (x,) for x in input_path_image_paths ], 'rects', image_size, face_type, debug, multi_gpu=multi_gpu, manual=False, detector=detector).process()
+            extracted_rects = ExtractSubprocessor ([ (x,) for x in input_path_image_paths ], 'rects', image_size, face_type, debug, multi_gpu=multi_gpu, manual=False, detector=detector, video_path=video_path).process()
 
             print ('Performing 2nd pass...')
-            extracted_faces = ExtractSubprocessor (extracted_rects, 'landmarks', image_size, face_type, debug, multi_gpu=multi_gpu, manual=False).process()
+            extracted_faces = ExtractSubprocessor (extracted_rects, 'landmarks', image_size, face_type, debug, multi_gpu=multi_gpu, manual=False, video_path=video_path).process()
 
             if manual_fix:
                 print ('Performing manual fix...')
@@ -527,11 +770,11 @@ def main (input_dir, output_dir, debug, detector='mt', multi_gpu=True, manual_fi
                 if all ( np.array ( [ len(data[1]) > 0 for data in extracted_faces] ) == True ):
                     print ('All faces are detected, manual fix not needed.')
                 else:
-                    extracted_faces = ExtractSubprocessor (extracted_faces, 'landmarks', image_size, face_type, debug, manual=True, manual_window_size=manual_window_size).process()
+                    extracted_faces = ExtractSubprocessor (extracted_faces, 'landmarks', image_size, face_type, debug, manual=True, manual_window_size=manual_window_size, video_path=video_path).process()
 
         if len(extracted_faces) > 0:
             print ('Performing 3rd pass...')
-            final_imgs_paths = ExtractSubprocessor (extracted_faces, 'final', image_size, face_type, debug, multi_gpu=multi_gpu, manual=False, output_path=output_path, input_path=input_path).process()
+            final_imgs_paths = ExtractSubprocessor (extracted_faces, 'final', image_size, face_type, debug, multi_gpu=multi_gpu, manual=False, output_path=output_path, input_path=input_path, manifest=manifest, workers=workers, video_path=video_path).process()
             faces_detected = len(final_imgs_paths)
 
     print('-------------------------')
@@ -8,7 +8,8 @@ from shutil import copyfile
 
 from pathlib import Path
 from utils import Path_utils
-from utils.AlignedPNG import AlignedPNG
+from utils.AlignedIndex import AlignedIndex
+from utils.PackedFaceset import PackedFaceset
 from facelib import LandmarksProcessor
 
 def estimate_blur(image):
@@ -50,6 +51,7 @@ def sort_by_face(input_path):
     print ("Sorting by face similarity...")
 
     img_list = []
+    index = AlignedIndex.load (input_path)
     for filepath in tqdm( Path_utils.get_image_paths(input_path), desc="Loading"):
         filepath = Path(filepath)
         
@@ -57,12 +59,12 @@ def sort_by_face(input_path):
             print ("%s is not a png file required for sort_by_face" % (filepath.name) ) 
             continue
         
-        a_png = AlignedPNG.load (str(filepath))
-        if a_png is None:
+        i = index.find (filepath)
+        if i is None:
             print ("%s failed to load" % (filepath.name) ) 
             continue
             
-        d = a_png.getFaceswapDictData()
+        d = index.get_dict (i)
         
         if d is None or d['landmarks'] is None:          
             print ("%s - no embedded data found required for sort_by_face" % (filepath.name) )
@@ -93,6 +95,7 @@ def sort_by_face_dissim(input_path):
     print ("Sorting by face dissimilarity...")
 
     img_list = []
+    index = AlignedIndex.load (input_path)
     for filepath in tqdm( Path_utils.get_image_paths(input_path), desc="Loading"):
         filepath = Path(filepath)
         
@@ -100,12 +103,12 @@ def sort_by_face_dissim(input_path):
             print ("%s is not a png file required for sort_by_face_dissim" % (filepath.name) ) 
             continue
         
-        a_png = AlignedPNG.load (str(filepath))
-        if a_png is None:
+        i = index.find (filepath)
+        if i is None:
             print ("%s failed to load" % (filepath.name) ) 
             continue
             
-        d = a_png.getFaceswapDictData()
+        d = index.get_dict (i)
         
         if d is None or d['landmarks'] is None:          
             print ("%s - no embedded data found required for sort_by_face_dissim" % (filepath.name) )
@@ -133,6 +136,7 @@ def sort_by_face_dissim(input_path):
 def sort_by_face_yaw(input_path):
     print ("Sorting by face yaw...")
     img_list = []
+    index = AlignedIndex.load (input_path)
     for filepath in tqdm( Path_utils.get_image_paths(input_path), desc="Loading"):
         filepath = Path(filepath)
         
@@ -140,12 +144,12 @@ def sort_by_face_yaw(input_path):
             print ("%s is not a png file required for sort_by_face_dissim" % (filepath.name) ) 
             continue
         
-        a_png = AlignedPNG.load (str(filepath))
-        if a_png is None:
+        i = index.find (filepath)
+        if i is None:
             print ("%s failed to load" % (filepath.name) ) 
             continue
             
-        d = a_png.getFaceswapDictData()
+        d = index.get_dict (i)
         
         if d is None or d['yaw_value'] is None:          
             print ("%s - no embedded data found required for sort_by_face_dissim" % (filepath.name) )
@@ -305,6 +309,7 @@ def sort_by_origname(input_path):
     print ("Sort by original filename...")
     
     img_list = []
+    index = AlignedIndex.load (input_path)
     for filepath in tqdm( Path_utils.get_image_paths(input_path), desc="Loading"):
         filepath = Path(filepath)
         
@@ -312,12 +317,12 @@ def sort_by_origname(input_path):
             print ("%s is not a png file required for sort_by_origname" % (filepath.name) ) 
             continue
         
-        a_png = AlignedPNG.load (str(filepath))
-        if a_png is None:
+        i = index.find (filepath)
+        if i is None:
             print ("%s failed to load" % (filepath.name) ) 
             continue
             
-        d = a_png.getFaceswapDictData()
+        d = index.get_dict (i)
         
         if d is None or d['source_filename'] is None:          
             print ("%s - no embedded data found required for sort_by_origname" % (filepath.name) )
@@ -333,6 +338,7 @@ def restore_origname(input_path):
     print ("Restoring original filename...")
     
     img_list = []
+    index = AlignedIndex.load (input_path)
     for filepath in tqdm( Path_utils.get_image_paths(input_path), desc="Loading"):
         filepath = Path(filepath)
 
@@ -340,12 +346,12 @@ def restore_origname(input_path):
             print ("%s is not a png file required for sort_by_origname" % (filepath.name) )
             continue
 
-        a_png = AlignedPNG.load (str(filepath))
-        if a_png is None:
+        i = index.find (filepath)
+        if i is None:
             print ("%s failed to load" % (filepath.name) )
             continue
 
-        d = a_png.getFaceswapDictData()
+        d = index.get_dict (i)
 
         if d is None or d['source_filename'] is None:
             print ("%s - no embedded data found required for sort_by_origname" % (filepath.name) )
@@ -359,6 +365,11 @@ def main (input_path, sort_by_method):
     sort_by_method = sort_by_method.lower()
 
     print ("Running sort tool.\r\n")
+
+    if PackedFaceset.load(input_path) is not None:
+        #sort renames files, which are not available in packed directory
+        print ("%s is packed. Unpack it by util --unpack-faceset before sorting." % (str(input_path)) )
+        return
     
     img_list = []
 
@@ -0,0 +1,63 @@
+from pathlib import Path
+from tqdm import tqdm
+from utils import Path_utils
+from utils.AlignedPNG import AlignedPNG
+from utils.PackedFaceset import PackedFaceset
+
+def convert_metadata(input_path):
+    #rewrites pickled fcWp chunks of aligned faces in binary schema, image data is not touched
+    print ("Converting metadata...")
+    converted = 0
+    errors = 0
+    for filepath in tqdm( [ x for x in Path_utils.get_image_paths(input_path) if Path(x).suffix == '.png' ], desc="Converting"):
+        try:
+            a_png = AlignedPNG.load (filepath)
+            if not a_png.isFaceswapDataLegacy():
+                continue
+
+            a_png.setFaceswapDictData (a_png.getFaceswapDictData())
+            a_png.save (filepath)
+            converted += 1
+        except Exception as e:
+            print ("%s : %s" % (filepath, str(e)) )
+            errors += 1
+
+    print ("Converted %d files, %d errors." % (converted, errors) )
+
+def pack_faceset(input_path, delete_packed=False):
+    #aligned faces are packed in <input_dir>/faceset.pak
+    #delete_packed - packed files are removed, after pak is read back and verified against them
+    if PackedFaceset.load(input_path) is not None:
+        print ("%s is already packed." % (str(input_path)) )
+        return
+
+    print ("Packing faceset...")
+    filepaths = PackedFaceset.pack (input_path)
+    print ("Packed %d files to %s" % (len(filepaths), str(PackedFaceset.get_path(input_path))) )
+    if not delete_packed or len(filepaths) == 0:
+        return
+
+    packed_faceset = PackedFaceset.load (input_path)
+    verified = packed_faceset.verify (filepaths)
+    packed_faceset.close()
+    if not verified:
+        print ("Packed files are not removed.")
+        return
+
+    for filepath in filepaths:
+        Path(filepath).unlink()
+    print ("Removed %d packed files." % (len(filepaths)) )
+
+def unpack_faceset(input_path):
+    print ("Unpacking faceset...")
+    filepaths = PackedFaceset.unpack (input_path)
+    print ("Unpacked %d files." % (len(filepaths)) )
+
+def main (input_path, operation, delete_packed=False):
+    input_path = Path(input_path)
+
+    print ("Running util tool.\r\n")
+
+    if operation == 'convert-metadata':     convert_metadata (input_path)
+    elif operation == 'pack-faceset':       pack_faceset (input_path, delete_packed=delete_packed)
+    elif operation == 'unpack-faceset':     unpack_faceset (input_path)
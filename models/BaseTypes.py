@@ -19,7 +19,7 @@ class TrainingDataType(IntEnum):
     
 class TrainingDataSample(object):
 
-    def __init__(self, filename=None, face_type=None, shape=None, landmarks=None, yaw=None, mirror=None, nearest_target_list=None):
+    def __init__(self, filename=None, face_type=None, shape=None, landmarks=None, yaw=None, mirror=None, nearest_target_list=None, packed_faceset=None):
         self.filename = filename
         self.face_type = face_type
         self.shape = shape
@@ -27,8 +27,9 @@ class TrainingDataSample(object):
         self.yaw = yaw
         self.mirror = mirror
         self.nearest_target_list = nearest_target_list
+        self.packed_faceset = packed_faceset #PackedFaceset which holds file of filename, None if file is on disk
     
-    def copy_and_set(self, filename=None, face_type=None, shape=None, landmarks=None, yaw=None, mirror=None, nearest_target_list=None):
+    def copy_and_set(self, filename=None, face_type=None, shape=None, landmarks=None, yaw=None, mirror=None, nearest_target_list=None, packed_faceset=None):
         return TrainingDataSample( 
             filename=filename if filename is not None else self.filename, 
             face_type=face_type if face_type is not None else self.face_type, 
@@ -36,10 +37,15 @@ class TrainingDataSample(object):
             landmarks=landmarks if landmarks is not None else self.landmarks.copy(), 
             yaw=yaw if yaw is not None else self.yaw, 
             mirror=mirror if mirror is not None else self.mirror, 
-            nearest_target_list=nearest_target_list if nearest_target_list is not None else self.nearest_target_list)
+            nearest_target_list=nearest_target_list if nearest_target_list is not None else self.nearest_target_list,
+            packed_faceset=packed_faceset if packed_faceset is not None else self.packed_faceset)
     
     def load_bgr(self):
-        img = cv2.imread (self.filename).astype(np.float32) / 255.0
+        if self.packed_faceset is not None:
+            img = self.packed_faceset.load_image (self.filename)
+        else:
+            img = cv2.imread (self.filename)
+        img = img.astype(np.float32) / 255.0
         if self.mirror:
             img = img[:,::-1].copy()
         return img
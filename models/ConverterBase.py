@@ -9,6 +9,7 @@ class ConverterBase(object):
     
     #overridable
     def __init__(self, predictor):
+        #predictor takes batch of inputs and returns batch of outputs
         self.predictor = predictor
         
     #overridable
@@ -18,8 +19,23 @@ class ConverterBase(object):
         return ConverterBase.MODE_FACE
         
     #overridable
-    def convert_face (self, img_bgr, img_face_landmarks, debug):
-        #return float32 image        
+    def get_plan_key(self):
+        #name of conversion plans cache of this converter, None if converter does not use plans
+        #must include every option, which plans depend on
+        return None
+        
+    #overridable
+    def build_plan (self, img_size, img_face_landmarks):
+        #return dict of numpy arrays, computed only from frame size and landmarks of face,
+        #which is cached between runs and passed to convert_face
+        #each array must have the same shape for all faces
+        return None
+        
+    #overridable
+    def convert_face (self, img_bgr, img_face_landmarks, debug, plan=None):
+        #img_bgr - uint8 frame, face is pasted to it in place, so faces of one frame are pasted to single image
+        #plan - result of build_plan for this face, or None
+        #return img_bgr        
         #if debug , return tuple ( images of any size and channels, ...)
         return image
         
@@ -8,8 +8,8 @@ from utils import image_utils
 
 '''
 predictor: 
-    input:  [predictor_input_size, predictor_input_size, BGR]
-    output: [predictor_input_size, predictor_input_size, BGR]
+    input:  [batch, predictor_input_size, predictor_input_size, BGR]
+    output: [batch, predictor_input_size, predictor_input_size, BGR]
 '''
 
 class ConverterImage(ConverterBase):
@@ -31,14 +31,14 @@ class ConverterImage(ConverterBase):
         
     #override
     def dummy_predict(self):
-        self.predictor ( np.zeros ( (self.predictor_input_size, self.predictor_input_size,3), dtype=np.float32) )
+        self.predictor ( np.zeros ( (1,self.predictor_input_size, self.predictor_input_size,3), dtype=np.float32) )
         
     #override
     def convert_image (self, img_bgr, img_landmarks, debug):
         img_size = img_bgr.shape[1], img_bgr.shape[0]
 
         predictor_input_bgr = cv2.resize ( img_bgr, (self.predictor_input_size, self.predictor_input_size), cv2.INTER_LANCZOS4 )
-        predicted_bgr = self.predictor ( predictor_input_bgr )
+        predicted_bgr = self.predictor ( np.expand_dims(predictor_input_bgr, 0) )[0]
 
         output = cv2.resize ( predicted_bgr, (self.output_size, self.output_size), cv2.INTER_LANCZOS4 )
         if debug:
@@ -7,10 +7,56 @@ from utils import image_utils
 
 '''
 predictor: 
-    input:  [predictor_input_size, predictor_input_size, BGRA]
-    output: [predictor_input_size, predictor_input_size, BGRA]
+    input:  [batch, predictor_input_size, predictor_input_size, BGRA]
+    output: [batch, predictor_input_size, predictor_input_size, BGRA]
 '''
 
+def get_face_roi (face_mat, face_size, img_w, img_h, face_margin=5, img_margin=5):
+    #returns (l,t,r,b) region of frame, which holds face square of face_mat with margins for LANCZOS4 kernel
+    #in face space and in frame space, clamped to frame
+    pts = np.array ( [ [-face_margin, -face_margin], [face_size+face_margin, -face_margin],
+                       [-face_margin, face_size+face_margin], [face_size+face_margin, face_size+face_margin] ], dtype=np.float32 )
+    pts = LandmarksProcessor.transform_points (pts, face_mat, invert=True)
+    l, t = np.floor ( pts.min(axis=0) ).astype(int) - img_margin
+    r, b = np.ceil ( pts.max(axis=0) ).astype(int) + img_margin + 1
+    return max(0, l), max(0, t), min(img_w, r), min(img_h, b)
+
+def get_roi_mat (face_mat, l, t):
+    #face_mat for region of frame starting at (l,t)
+    mat = face_mat.copy()
+    mat[:,2] += np.dot (face_mat[:,0:2], (l, t) )
+    return mat
+
+def load_roi (frame_bgr, roi):
+    #returns float32 [0..1] copy of region roi of uint8 frame
+    l, t, r, b = roi
+    img = frame_bgr[t:b,l:r].astype(np.float32)
+    img /= 255.0
+    return img
+
+def paste_roi (frame_bgr, roi, roi_img):
+    #pastes float32 [0..1] roi_img to region roi of uint8 frame in place
+    l, t, r, b = roi
+    frame_bgr[t:b,l:r] = roi_img * 255
+    return frame_bgr
+
+def debug_roi (img, roi, roi_img):
+    #returns float32 copy of img with roi_img pasted to region roi, for debug images only
+    l, t, r, b = roi
+    img = img.astype(np.float32) / 255.0 if img.dtype == np.uint8 else img.copy()
+    img[t:b,l:r] = roi_img
+    return img
+
+def blend (img_bgr, img_over_bgr, mask_a_0, out, clip=True):
+    #out = img_bgr*(1-mask) + img_over_bgr*mask, computed in place of out, which may be img_over_bgr
+    #mask_a_0 - single channel, broadcasted over channels
+    np.subtract (img_over_bgr, img_bgr, out=out)
+    out *= mask_a_0[...,np.newaxis]
+    out += img_bgr
+    if clip:
+        np.clip (out, 0, 1.0, out=out)
+    return out
+
 class ConverterMasked(ConverterBase):
 
     #override
@@ -25,6 +71,7 @@ class ConverterMasked(ConverterBase):
                         mode='seamless', 
                         erode_mask_modifier=0, 
                         blur_mask_modifier=0,                         
+                        use_roi=True,
                         **in_options):
                         
         super().__init__(predictor)
@@ -39,6 +86,9 @@ class ConverterMasked(ConverterBase):
         self.mode = mode
         self.erode_mask_modifier = erode_mask_modifier
         self.blur_mask_modifier = blur_mask_modifier
+        #use_roi - work only on region of frame around face, result is not identical to whole frame path:
+        #cv2 warps round sampling coordinates in fixed point relative to origin of region, so pixels differ by a few levels
+        self.use_roi = use_roi
         
         if self.erode_mask_modifier != 0 and not self.erode_mask:
             print ("Erode mask modifier not used in this model.")
@@ -52,18 +102,43 @@ class ConverterMasked(ConverterBase):
         
     #override
     def dummy_predict(self):
-        self.predictor ( np.zeros ( (self.predictor_input_size,self.predictor_input_size,4), dtype=np.float32 ) )
+        self.predictor ( np.zeros ( (1,self.predictor_input_size,self.predictor_input_size,4), dtype=np.float32 ) )
         
     #override
-    def convert_face (self, img_bgr, img_face_landmarks, debug):        
+    def get_plan_key(self):
+        return 'masked_%d_%s%s' % (self.output_size, FaceType.toString(self.face_type), '_roi' if self.use_roi else '' )
+
+    #override
+    def build_plan (self, img_size, img_face_landmarks):
+        frame_w, frame_h = img_size
+        face_mat = LandmarksProcessor.get_transform_mat (img_face_landmarks, self.output_size, face_type=self.face_type)
+        if self.use_roi:
+            roi = get_face_roi (face_mat, self.output_size, frame_w, frame_h)
+        else:
+            roi = (0, 0, frame_w, frame_h)
+        return {'face_mat' : face_mat, 
+                'roi' : np.array (roi) }
+
+    #override
+    def convert_face (self, frame_bgr, img_face_landmarks, debug, plan=None):        
         if debug:        
-            debugs = [img_bgr.copy()]
+            debugs = [frame_bgr.copy()]
+
+        frame_h, frame_w = frame_bgr.shape[0:2]
+        if plan is None:
+            plan = self.build_plan ( (frame_w, frame_h), img_face_landmarks )
+        frame_face_mat = plan['face_mat']
 
-        img_size = img_bgr.shape[1], img_bgr.shape[0]
+        #frame is changed only around the face, so the work is done on region of interest (roi) of frame:
+        #img_bgr, img_size and face_mat below refer to the roi, it is grown later by reach of mask erode and blur
+        roi = tuple ( [ int(x) for x in plan['roi'] ] )
+        l, t, r, b = roi
+        img_bgr  = load_roi (frame_bgr, roi)
+        img_size = (r-l, b-t)
+        face_mat = get_roi_mat (frame_face_mat, l, t)
 
-        img_face_mask_a = LandmarksProcessor.get_image_hull_mask (img_bgr, img_face_landmarks)
+        img_face_mask_a = LandmarksProcessor.get_image_hull_mask (img_bgr, img_face_landmarks - (l, t) )
         
-        face_mat = LandmarksProcessor.get_transform_mat (img_face_landmarks, self.output_size, face_type=self.face_type)
         dst_face_bgr      = cv2.warpAffine( img_bgr        , face_mat, (self.output_size, self.output_size), flags=cv2.INTER_LANCZOS4 )
         dst_face_mask_a_0 = cv2.warpAffine( img_face_mask_a, face_mat, (self.output_size, self.output_size), flags=cv2.INTER_LANCZOS4 )
 
@@ -71,34 +146,35 @@ class ConverterMasked(ConverterBase):
         predictor_input_mask_a_0 = cv2.resize (dst_face_mask_a_0, (self.predictor_input_size,self.predictor_input_size))
         predictor_input_mask_a   = np.expand_dims (predictor_input_mask_a_0, -1) 
         
-        predicted_bgra = self.predictor ( np.concatenate( (predictor_input_bgr, predictor_input_mask_a), -1) )
+        predicted_bgra = self.predictor ( np.expand_dims (np.concatenate( (predictor_input_bgr, predictor_input_mask_a), -1), 0) )[0]
 
         prd_face_bgr      = np.clip (predicted_bgra[:,:,0:3], 0, 1.0 )
         prd_face_mask_a_0 = np.clip (predicted_bgra[:,:,3], 0.0, 1.0)
         prd_face_mask_a_0[ prd_face_mask_a_0 < 0.001 ] = 0.0
         
         prd_face_mask_a   = np.expand_dims (prd_face_mask_a_0, axis=-1)
-        prd_face_mask_aaa = np.repeat (prd_face_mask_a, (3,), axis=-1)
 
-        img_prd_face_mask_aaa = cv2.warpAffine( prd_face_mask_aaa, face_mat, img_size, np.zeros(img_bgr.shape, dtype=float), flags=cv2.WARP_INVERSE_MAP | cv2.INTER_LANCZOS4 )
-        img_prd_face_mask_aaa = np.clip (img_prd_face_mask_aaa, 0.0, 1.0)
-            
-        img_face_mask_aaa = img_prd_face_mask_aaa
+        #frame sized masks are equal in all channels, so they are kept single channel and broadcasted in blend(),
+        #which works in place, so no frame sized float temporaries are allocated
+        img_face_mask_a_0 = cv2.warpAffine( prd_face_mask_a_0, face_mat, img_size, flags=cv2.WARP_INVERSE_MAP | cv2.INTER_LANCZOS4 )
+        np.clip (img_face_mask_a_0, 0.0, 1.0, out=img_face_mask_a_0)
         
         if debug:
-            debugs += [img_face_mask_aaa.copy()]
+            debugs += [ debug_roi ( np.zeros(frame_bgr.shape, dtype=np.float32), roi, np.repeat (np.expand_dims (img_face_mask_a_0, -1), (3,), -1) ) ]
         
-        img_face_mask_aaa [ img_face_mask_aaa <= 0.1 ] = 0.0
+        img_face_mask_a_0 [ img_face_mask_a_0 <= 0.1 ] = 0.0
             
-        img_face_mask_flatten_aaa = img_face_mask_aaa.copy()
-        img_face_mask_flatten_aaa[img_face_mask_flatten_aaa > 0.9] = 1.0
+        img_face_mask_flatten_a_0 = img_face_mask_a_0.copy()
+        img_face_mask_flatten_a_0[img_face_mask_flatten_a_0 > 0.9] = 1.0
 
-        maxregion = np.argwhere(img_face_mask_flatten_aaa==1.0)        
+        maxregion = img_face_mask_flatten_a_0 == 1.0
+        maxregion_rows = np.nonzero ( maxregion.any(axis=1) )[0]
 
-        out_img = img_bgr.copy()
-        if maxregion.size != 0:
-            miny,minx = maxregion.min(axis=0)[:2]
-            maxy,maxx = maxregion.max(axis=0)[:2]
+        out_img = img_bgr
+        if maxregion_rows.size != 0:
+            maxregion_cols = np.nonzero ( maxregion.any(axis=0) )[0]
+            miny, maxy = maxregion_rows[0], maxregion_rows[-1]
+            minx, maxx = maxregion_cols[0], maxregion_cols[-1]
             lenx = maxx - minx
             leny = maxy - miny
             masky = int(minx+(lenx//2))
@@ -113,18 +189,39 @@ class ConverterMasked(ConverterBase):
           
             if debug:
                 print ("ero = %d, blur = %d" % (ero, blur) )
+
+            if self.use_roi:
+                #mask is zero at roi border, grow roi by reach of erode/dilate, blur and seamless clone, padding masks with zeros
+                #seamlessClone places bounding rect of mask around center of maxregion, so they may be off by some pixels
+                mask_rows = np.nonzero ( img_face_mask_flatten_a_0.any(axis=1) )[0]
+                mask_cols = np.nonzero ( img_face_mask_flatten_a_0.any(axis=0) )[0]
+                clone_offset = max ( abs ( (mask_cols[0]+mask_cols[-1]) - 2*masky ), abs ( (mask_rows[0]+mask_rows[-1]) - 2*maskx ) )
+                margin = abs(ero) + max(0, blur) + clone_offset + 8
+                roi = ( max(0, l-margin), max(0, t-margin), min(frame_w, r+margin), min(frame_h, b+margin) )
+                pad = ( t-roi[1], roi[3]-b, l-roi[0], roi[2]-r )
+                img_face_mask_a_0         = cv2.copyMakeBorder (img_face_mask_a_0,         *pad, cv2.BORDER_CONSTANT, value=0)
+                img_face_mask_flatten_a_0 = cv2.copyMakeBorder (img_face_mask_flatten_a_0, *pad, cv2.BORDER_CONSTANT, value=0)
+                masky += pad[2]
+                maskx += pad[0]
+
+                l, t, r, b = roi
+                img_bgr  = load_roi (frame_bgr, roi)
+                img_size = (r-l, b-t)
+                face_mat = get_roi_mat (frame_face_mat, l, t)
+
+            out_img = img_bgr.copy()
                 
-            img_mask_blurry_aaa = img_face_mask_aaa
+            img_mask_blurry_a_0 = img_face_mask_a_0
             if self.erode_mask:
                 if ero > 0:
-                    img_mask_blurry_aaa = cv2.erode(img_mask_blurry_aaa, cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(ero,ero)), iterations = 1 )
+                    img_mask_blurry_a_0 = cv2.erode(img_mask_blurry_a_0, cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(ero,ero)), iterations = 1 )
                 elif ero < 0:
-                    img_mask_blurry_aaa = cv2.dilate(img_mask_blurry_aaa, cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(-ero,-ero)), iterations = 1 )
+                    img_mask_blurry_a_0 = cv2.dilate(img_mask_blurry_a_0, cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(-ero,-ero)), iterations = 1 )
 
             if self.blur_mask and blur > 0:
-                img_mask_blurry_aaa = cv2.blur(img_mask_blurry_aaa, (blur, blur) )
+                img_mask_blurry_a_0 = cv2.blur(img_mask_blurry_a_0, (blur, blur) )
                 
-            img_mask_blurry_aaa = np.clip( img_mask_blurry_aaa, 0, 1.0 )
+            img_mask_blurry_a_0 = np.clip( img_mask_blurry_a_0, 0, 1.0 )
             
             if self.clip_border_mask_per > 0:
                 prd_border_rect_mask_a = np.ones ( prd_face_mask_a.shape, dtype=prd_face_mask_a.dtype)        
@@ -142,16 +239,12 @@ class ConverterMasked(ConverterBase):
             
             if self.mode == 'hist-match' or self.mode == 'hist-match-bw':
                 if debug:
-                    debugs += [ cv2.warpAffine( prd_face_bgr, face_mat, img_size, np.zeros(img_bgr.shape, dtype=np.float32), cv2.WARP_INVERSE_MAP | cv2.INTER_LANCZOS4, cv2.BORDER_TRANSPARENT ) ]
-                    
-                hist_mask_a = np.ones ( prd_face_bgr.shape[:2] + (1,) , dtype=prd_face_bgr.dtype)
+                    debugs += [ cv2.warpAffine( prd_face_bgr, frame_face_mat, (frame_w, frame_h), np.zeros(frame_bgr.shape, dtype=np.float32), cv2.WARP_INVERSE_MAP | cv2.INTER_LANCZOS4, cv2.BORDER_TRANSPARENT ) ]
                     
-                if self.masked_hist_match:
-                    hist_mask_a *= prd_face_mask_a
+                #masked histograms count only pixels of predicted face, weighted by its mask
+                hist_mask_a = prd_face_mask_a if self.masked_hist_match else None
 
-                new_prd_face_bgr = image_utils.color_hist_match(prd_face_bgr*hist_mask_a, dst_face_bgr*hist_mask_a )
-
-                prd_face_bgr = new_prd_face_bgr
+                prd_face_bgr = image_utils.color_hist_match(prd_face_bgr, dst_face_bgr, mask=hist_mask_a )
                     
             if self.mode == 'hist-match-bw':
                 prd_face_bgr = prd_face_bgr.astype(np.float32)
@@ -159,36 +252,39 @@ class ConverterMasked(ConverterBase):
             out_img = cv2.warpAffine( prd_face_bgr, face_mat, img_size, out_img, cv2.WARP_INVERSE_MAP | cv2.INTER_LANCZOS4, cv2.BORDER_TRANSPARENT )
 
             if debug:
-                debugs += [out_img.copy()]
-                debugs += [img_mask_blurry_aaa.copy()]
+                debugs += [ debug_roi (frame_bgr, roi, out_img) ]
+                debugs += [ debug_roi ( np.zeros(frame_bgr.shape, dtype=np.float32), roi, np.repeat (np.expand_dims (img_mask_blurry_a_0, -1), (3,), -1) ) ]
 
             if self.mode == 'seamless' or self.mode == 'seamless-hist-match':
-                out_img = np.clip( img_bgr*(1-img_face_mask_aaa) + (out_img*img_face_mask_aaa) , 0, 1.0 )
+                blend (img_bgr, out_img, img_face_mask_a_0, out_img)
                 if debug:
-                    debugs += [out_img.copy()]
-                out_img = cv2.seamlessClone( (out_img*255).astype(np.uint8), (img_bgr*255).astype(np.uint8), (img_face_mask_flatten_aaa*255).astype(np.uint8), (masky,maskx) , cv2.NORMAL_CLONE )
-                out_img = out_img.astype(np.float32) / 255.0
+                    debugs += [ debug_roi (frame_bgr, roi, out_img) ]
+                out_img *= 255
+                out_img[...] = cv2.seamlessClone( out_img.astype(np.uint8), (img_bgr*255).astype(np.uint8), (img_face_mask_flatten_a_0*255).astype(np.uint8), (masky,maskx) , cv2.NORMAL_CLONE )
+                out_img /= 255.0
                 
                 if debug:
-                    debugs += [out_img.copy()]
+                    debugs += [ debug_roi (frame_bgr, roi, out_img) ]
                     
             if self.clip_border_mask_per > 0:
-                img_prd_border_rect_mask_a = cv2.warpAffine( prd_border_rect_mask_a, face_mat, img_size, np.zeros(img_bgr.shape, dtype=np.float32), cv2.WARP_INVERSE_MAP | cv2.INTER_LANCZOS4, cv2.BORDER_TRANSPARENT )
-                img_prd_border_rect_mask_a = np.expand_dims (img_prd_border_rect_mask_a, -1)
+                img_prd_border_rect_mask_a_0 = cv2.warpAffine( prd_border_rect_mask_a, face_mat, img_size, np.zeros(img_bgr.shape[0:2], dtype=np.float32), cv2.WARP_INVERSE_MAP | cv2.INTER_LANCZOS4, cv2.BORDER_TRANSPARENT )
 
-                out_img = out_img * img_prd_border_rect_mask_a + img_bgr * (1.0 - img_prd_border_rect_mask_a)
-                img_mask_blurry_aaa *= img_prd_border_rect_mask_a
+                blend (img_bgr, out_img, img_prd_border_rect_mask_a_0, out_img, clip=False)
+                img_mask_blurry_a_0 *= img_prd_border_rect_mask_a_0
             
-            out_img =  np.clip( img_bgr*(1-img_mask_blurry_aaa) + (out_img*img_mask_blurry_aaa) , 0, 1.0 )
+            blend (img_bgr, out_img, img_mask_blurry_a_0, out_img)
 
             if self.mode == 'seamless-hist-match':
                 out_face_bgr = cv2.warpAffine( out_img, face_mat, (self.output_size, self.output_size) )                
                 new_out_face_bgr = image_utils.color_hist_match(out_face_bgr, dst_face_bgr )                
                 new_out = cv2.warpAffine( new_out_face_bgr, face_mat, img_size, img_bgr.copy(), cv2.WARP_INVERSE_MAP | cv2.INTER_LANCZOS4, cv2.BORDER_TRANSPARENT )
-                out_img =  np.clip( img_bgr*(1-img_mask_blurry_aaa) + (new_out*img_mask_blurry_aaa) , 0, 1.0 )
+                out_img = blend (img_bgr, new_out, img_mask_blurry_a_0, new_out)
+
+            #only roi of frame is changed, in place, so the frame stays uint8 and is not copied per face
+            paste_roi (frame_bgr, roi, out_img)
  
         if debug:
-            debugs += [out_img.copy()]
+            debugs += [frame_bgr.copy()]
             
-        return debugs if debug else out_img     
+        return debugs if debug else frame_bgr     
      
\ No newline at end of file
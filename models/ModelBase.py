@@ -3,6 +3,7 @@ import time
 import inspect
 import operator
 import pickle
+import zlib
 from pathlib import Path
 from utils import Path_utils
 from utils import std_utils
@@ -303,6 +304,11 @@ class ModelBase(object):
     def get_epoch(self):
         return self.epoch
         
+    def get_model_key(self):
+        #identifies saved state of model, changed by every save
+        data_crc = zlib.crc32 ( self.model_data_path.read_bytes() ) if self.model_data_path.exists() else 0
+        return '%s_%.6d_%.8x' % ( self.get_model_name(), self.epoch, data_crc )
+        
     def get_loss_history(self):
         return self.loss_history
  
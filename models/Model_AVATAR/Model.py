@@ -145,9 +145,9 @@ class Model(ModelBase):
 
         return [ ('AVATAR', result ) ]
 
-    def predictor_func (self, img):
-        x, = self.BA256_view ([ np.expand_dims(img, 0) ])[0]
-        return x
+    def predictor_func (self, imgs):
+        #imgs: batch of BGR images
+        return self.BA256_view ([ imgs ])[0]
         
     #override
     def get_converter(self, **in_options):
@@ -235,7 +235,7 @@ class ConverterAvatar(ConverterBase):
         
     #override
     def dummy_predict(self):
-        self.predictor ( np.zeros ( (self.predictor_input_size, self.predictor_input_size,3), dtype=np.float32) )
+        self.predictor ( np.zeros ( (1,self.predictor_input_size, self.predictor_input_size,3), dtype=np.float32) )
         
     #override
     def convert_image (self, img_bgr, img_face_landmarks, debug):
@@ -244,7 +244,7 @@ class ConverterAvatar(ConverterBase):
         face_mat            = LandmarksProcessor.get_transform_mat (img_face_landmarks, self.predictor_input_size, face_type=FaceType.HALF )
         predictor_input_bgr = cv2.warpAffine( img_bgr, face_mat, (self.predictor_input_size, self.predictor_input_size), flags=cv2.INTER_LANCZOS4 )
 
-        predicted_bgr = self.predictor ( predictor_input_bgr )
+        predicted_bgr = self.predictor ( np.expand_dims(predictor_input_bgr, 0) )[0]
 
         output = cv2.resize ( predicted_bgr, (self.output_size, self.output_size), cv2.INTER_LANCZOS4 )
         if debug:
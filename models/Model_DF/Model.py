@@ -95,13 +95,13 @@ class Model(ModelBase):
             
         return [ ('DF', np.concatenate ( st, axis=0 ) ) ]
     
-    def predictor_func (self, face):
+    def predictor_func (self, faces):
+        #faces: batch of BGRA faces
         
-        face_128_bgr = face[...,0:3]
-        face_128_mask = np.expand_dims(face[...,3],-1)
+        face_128_bgr = faces[...,0:3]
+        face_128_mask = np.expand_dims(faces[...,3],-1)
         
-        x, mx = self.autoencoder_src.predict ( [ np.expand_dims(face_128_bgr,0), np.expand_dims(face_128_mask,0) ] )
-        x, mx = x[0], mx[0]
+        x, mx = self.autoencoder_src.predict ( [ face_128_bgr, face_128_mask ] )
         
         return np.concatenate ( (x,mx), -1 )
         
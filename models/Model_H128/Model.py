@@ -100,12 +100,12 @@ class Model(ModelBase):
             
         return [ ('H128', np.concatenate ( st, axis=0 ) ) ]
 
-    def predictor_func (self, face):        
-        face_128_bgr = face[...,0:3]
-        face_128_mask = np.expand_dims(face[...,3],-1)
+    def predictor_func (self, faces):
+        #faces: batch of BGRA faces
+        face_128_bgr = faces[...,0:3]
+        face_128_mask = np.expand_dims(faces[...,3],-1)
         
-        x, mx = self.src_view ( [ np.expand_dims(face_128_bgr,0) ] )
-        x, mx = x[0], mx[0]     
+        x, mx = self.src_view ( [ face_128_bgr ] )
         
         return np.concatenate ( (x,mx), -1 )
 
@@ -99,13 +99,13 @@ class Model(ModelBase):
             
         return [ ('H64', np.concatenate ( st, axis=0 ) ) ]
 
-    def predictor_func (self, face):
+    def predictor_func (self, faces):
+        #faces: batch of BGRA faces
         
-        face_64_bgr = face[...,0:3]
-        face_64_mask = np.expand_dims(face[...,3],-1)
+        face_64_bgr = faces[...,0:3]
+        face_64_mask = np.expand_dims(faces[...,3],-1)
         
-        x, mx = self.src_view ( [ np.expand_dims(face_64_bgr,0) ] )
-        x, mx = x[0], mx[0]     
+        x, mx = self.src_view ( [ face_64_bgr ] )
         
         return np.concatenate ( (x,mx), -1 )
 
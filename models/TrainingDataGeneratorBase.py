@@ -4,7 +4,8 @@ from pathlib import Path
 from tqdm import tqdm
 import numpy as np
 import cv2
-from utils.AlignedPNG import AlignedPNG
+from utils.AlignedIndex import AlignedIndex
+from utils.PackedFaceset import PackedFaceset
 from utils import iter_utils
 from utils import Path_utils
 from .BaseTypes import TrainingDataType
@@ -149,11 +150,11 @@ class TrainingDataGeneratorBase(object):
 
         if            trainingdatatype == TrainingDataType.IMAGE:
             if  datas[trainingdatatype] is None:  
-                datas[trainingdatatype] = [ TrainingDataSample(filename=filename) for filename in tqdm( Path_utils.get_image_paths(training_data_path), desc="Loading" ) ]
+                datas[trainingdatatype] = [ s for s in tqdm( X_RAWS(training_data_path), desc="Loading" ) ]
 
         elif          trainingdatatype == TrainingDataType.FACE:
             if  datas[trainingdatatype] is None:  
-                datas[trainingdatatype] = X_LOAD( [ TrainingDataSample(filename=filename) for filename in Path_utils.get_image_paths(training_data_path) ] )
+                datas[trainingdatatype] = X_LOAD( X_RAWS(training_data_path) )
         
         elif          trainingdatatype == TrainingDataType.FACE_YAW_SORTED:
             if  datas[trainingdatatype] is None:
@@ -167,8 +168,18 @@ class TrainingDataGeneratorBase(object):
             
         return datas[trainingdatatype]
         
+def X_RAWS ( training_data_path ):
+    #samples of files of directory, or of its faceset.pak if directory is packed
+    packed_faceset = PackedFaceset.load (training_data_path)
+    if packed_faceset is not None:
+        print ("Loading packed faceset %s" % (str(packed_faceset.filepath)) )
+        packed_faceset.warn_unpacked_files()
+        return [ TrainingDataSample(filename=filename, packed_faceset=packed_faceset) for filename in packed_faceset.get_filepaths() ]
+    return [ TrainingDataSample(filename=filename) for filename in Path_utils.get_image_paths(training_data_path) ]
+
 def X_LOAD ( RAWS ):
     sample_list = []
+    indexes = {}
     
     for s in tqdm( RAWS, desc="Loading" ):
 
@@ -177,19 +188,27 @@ def X_LOAD ( RAWS ):
             print ("%s is not a png file required for training" % (s_filename_path.name) ) 
             continue
         
-        a_png = AlignedPNG.load ( str(s_filename_path) )
-        if a_png is None:
+        if s.packed_faceset is not None:
+            index = s.packed_faceset.index
+        else:
+            dir_path = str(s_filename_path.parent)
+            if dir_path not in indexes:
+                indexes[dir_path] = AlignedIndex.load (dir_path)
+            index = indexes[dir_path]
+
+        i = index.find (s_filename_path)
+        if i is None:
             print ("%s failed to load" % (s_filename_path.name) )
             continue
 
-        d = a_png.getFaceswapDictData()
+        d = index.get_dict (i)
         if d is None or d['landmarks'] is None or d['yaw_value'] is None:
             print ("%s - no embedded faceswap info found required for training" % (s_filename_path.name) ) 
             continue
             
         face_type = d['face_type'] if 'face_type' in d.keys() else 'full_face'        
         face_type = FaceType.fromString (face_type) 
-        sample_list.append( s.copy_and_set(face_type=face_type, shape=a_png.get_shape(), landmarks=d['landmarks'], yaw=d['yaw_value']) )
+        sample_list.append( s.copy_and_set(face_type=face_type, shape=index.get_shape(i), landmarks=d['landmarks'], yaw=d['yaw_value']) )
         
     return sample_list
     
@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+import pickle
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+import numpy as np
+import cv2
+
+sys.path.insert (0, str(Path(__file__).resolve().parent.parent))
+from utils.AlignedPNG import AlignedPNG, Chunk
+from utils.AlignedIndex import AlignedIndex
+
+def write_aligned_png(filepath, rnd, legacy=False, **kwargs):
+    #legacy - dict data is pickled as by older versions, which did not check it
+    img = rnd.randint (0, 256, (16,16,3)).astype(np.uint8)
+    d = { 'face_type'        : 'full_face',
+          'landmarks'        : rnd.uniform (0, 16, (68,2)).astype(np.float32),
+          'yaw_value'        : float(rnd.uniform(-1, 1)),
+          'pitch_value'      : float(rnd.uniform(-1, 1)),
+          'source_filename'  : '%s.jpg' % (Path(filepath).stem),
+          'source_rect'      : (1, 2, 30, 40),
+          'source_landmarks' : rnd.randint (0, 100, (68,2)) }
+    d.update (kwargs)
+    a_png = AlignedPNG.from_bytes ( cv2.imencode('.png', img)[1].tobytes() )
+    a_png.setFaceswapDictData (d)
+    if legacy:
+        a_png.chunks[-2] = Chunk ("fcWp", pickle.dumps(d))
+    a_png.save (filepath)
+
+class AlignedIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_path = Path ( tempfile.mkdtemp() )
+        self.dir_path = self.tmp_path / 'aligned'
+        self.dir_path.mkdir()
+        self.rnd = np.random.RandomState(0)
+
+    def tearDown(self):
+        shutil.rmtree ( str(self.tmp_path) )
+
+    def assertIndexMatchesFiles(self, index):
+        filepaths = sorted ( [ str(x) for x in self.dir_path.glob('*.png') ] )
+        self.assertEqual ( sorted ( [ index.get_filepath(i) for i in range(len(index)) ] ), filepaths )
+        for filepath in filepaths:
+            i = index.find (filepath)
+            a_png = AlignedPNG.load (filepath)
+            self.assertEqual (index.get_shape(i), a_png.get_shape())
+
+            expected = a_png.getFaceswapDictData()
+            d = index.get_dict(i)
+            if expected is None:
+                self.assertIsNone (d)
+                continue
+            for key, value in expected.items():
+                if isinstance(value, np.ndarray):
+                    np.testing.assert_array_equal (d[key], value)
+                    self.assertEqual ( np.issubdtype(d[key].dtype, np.integer), np.issubdtype(value.dtype, np.integer) )
+                else:
+                    self.assertEqual (d[key], value)
+                    self.assertEqual (type(d[key]), type(value))
+
+    def test_build_and_reload(self):
+        for i in range(5):
+            write_aligned_png ( self.dir_path / ('%d.png' % (i)), self.rnd )
+        write_aligned_png ( self.dir_path / 'manual.png', self.rnd, source_rect=(1.5, 2.25, 30, 40), pitch_value=None )
+        cv2.imwrite ( str(self.dir_path / 'plain.png'), np.zeros ( (8,8,3), dtype=np.uint8 ) )
+
+        index = AlignedIndex.load (self.dir_path)
+        self.assertEqual (len(index), 7)
+        self.assertIndexMatchesFiles (index)
+
+        #saved index is opened without reading files
+        index = AlignedIndex.load (self.dir_path, update=False)
+        self.assertEqual (len(index), 7)
+        self.assertIndexMatchesFiles (index)
+
+    def test_invalidation(self):
+        for i in range(3):
+            write_aligned_png ( self.dir_path / ('%d.png' % (i)), self.rnd )
+        AlignedIndex.load (self.dir_path)
+
+        #changed, removed, renamed and added files
+        write_aligned_png ( self.dir_path / '0.png', self.rnd, face_type='half_face' )
+        st = os.stat ( str(self.dir_path / '0.png') )
+        os.utime ( str(self.dir_path / '0.png'), (st.st_atime, st.st_mtime + 10) )
+        (self.dir_path / '1.png').unlink()
+        (self.dir_path / '2.png').rename (self.dir_path / '2_renamed.png')
+        write_aligned_png ( self.dir_path / '3.png', self.rnd )
+
+        index = AlignedIndex.load (self.dir_path)
+        self.assertEqual (len(index), 3)
+        self.assertIsNone ( index.find ('1.png') )
+        self.assertIsNone ( index.find ('2.png') )
+        self.assertEqual ( index.get_dict ( index.find('0.png') )['face_type'], 'half_face' )
+        self.assertIndexMatchesFiles (index)
+
+    def test_malformed_data(self):
+        write_aligned_png ( self.dir_path / '0.png', self.rnd )
+        write_aligned_png ( self.dir_path / '1.png', self.rnd, legacy=True, landmarks=np.zeros ( (5,3), dtype=np.float32 ) )
+
+        index = AlignedIndex.load (self.dir_path)
+        self.assertEqual (len(index), 2)
+        self.assertIsNotNone ( index.get_dict ( index.find('0.png') ) )
+        self.assertIsNone ( index.get_dict ( index.find('1.png') ) )
+
+    def test_points_count(self):
+        write_aligned_png ( self.dir_path / '0.png', self.rnd )
+        AlignedIndex.load (self.dir_path)
+
+        #more points than rows already in index have
+        write_aligned_png ( self.dir_path / '1.png', self.rnd, landmarks=self.rnd.uniform (0, 16, (106,2)), source_landmarks=self.rnd.randint (0, 100, (5,2)) )
+        write_aligned_png ( self.dir_path / '2.png', self.rnd, landmarks=None )
+        index = AlignedIndex.load (self.dir_path)
+        self.assertEqual (index.get_dict ( index.find('1.png') )['landmarks'].shape, (106,2))
+        self.assertIsNone (index.get_dict ( index.find('2.png') )['landmarks'])
+        self.assertIndexMatchesFiles (index)
+
+    def test_unchanged_dir_is_not_read(self):
+        for i in range(3):
+            write_aligned_png ( self.dir_path / ('%d.png' % (i)), self.rnd )
+        past = time.time() - 10
+        os.utime ( str(self.dir_path), (past, past) )
+        AlignedIndex.load (self.dir_path)
+
+        read_row = AlignedIndex.read_row
+        try:
+            AlignedIndex.read_row = None
+            index = AlignedIndex.load (self.dir_path)
+            self.assertEqual (len(index), 3)
+        finally:
+            AlignedIndex.read_row = read_row
+
+        #added file changes mtime of directory
+        write_aligned_png ( self.dir_path / '3.png', self.rnd )
+        os.utime ( str(self.dir_path), (past + 1, past + 1) )
+        index = AlignedIndex.load (self.dir_path)
+        self.assertEqual (len(index), 4)
+        self.assertIndexMatchesFiles (index)
+
+if __name__ == '__main__':
+    unittest.main()
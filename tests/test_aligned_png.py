@@ -0,0 +1,104 @@
+import sys
+import struct
+import pickle
+import unittest
+import collections
+from pathlib import Path
+import numpy as np
+import cv2
+
+sys.path.insert (0, str(Path(__file__).resolve().parent.parent))
+from utils.AlignedPNG import AlignedPNG, Chunk, FaceswapChunk
+
+def get_dict_data(rnd):
+    return { 'face_type'        : 'full_face',
+             'landmarks'        : rnd.uniform (0, 256, (68,2)).astype(np.float32),
+             'yaw_value'        : 0.25,
+             'pitch_value'      : -0.5,
+             'source_filename'  : '00001.png',
+             'source_rect'      : (10, 20, 110, 120),
+             'source_landmarks' : rnd.randint (0, 1000, (68,2)) }
+
+class FaceswapChunkTest(unittest.TestCase):
+    def assertDictDataEqual(self, d, expected):
+        self.assertEqual ( set(d.keys()), set(expected.keys()) )
+        for key, value in expected.items():
+            if isinstance(value, np.ndarray):
+                np.testing.assert_array_equal (d[key], value)
+            else:
+                self.assertEqual (d[key], value)
+
+    def test_round_trip(self):
+        d = get_dict_data ( np.random.RandomState(0) )
+        chunk = FaceswapChunk.load ( FaceswapChunk(d).dump() )
+        self.assertFalse (chunk.legacy)
+        self.assertDictDataEqual (chunk.getDictData(), d)
+        self.assertTrue ( np.issubdtype (chunk.getDictData()['source_landmarks'].dtype, np.integer) )
+        self.assertEqual (chunk.getDictData()['landmarks'].dtype, np.float32)
+
+    def test_missing_fields_and_fractional_rect(self):
+        d = { 'face_type' : 'half_face', 'source_rect' : (1.5, 2, 3, 4) }
+        chunk = FaceswapChunk.load ( FaceswapChunk(d).dump() )
+        expected = { key : None for key, kind in FaceswapChunk.schema if key != 'extra' }
+        expected.update ( { 'face_type' : 'half_face', 'source_rect' : (1.5, 2.0, 3.0, 4.0) } )
+        self.assertDictDataEqual (chunk.getDictData(), expected)
+
+    def test_float64_values(self):
+        d = { 'landmarks' : np.random.RandomState(0).uniform (0, 256, (68,2)), 'yaw_value' : 0.1, 'pitch_value' : 1/3.0 }
+        d2 = FaceswapChunk.load ( FaceswapChunk(d).dump() ).getDictData()
+        self.assertEqual (d2['landmarks'].dtype, np.float64)
+        np.testing.assert_array_equal (d2['landmarks'], d['landmarks'])
+        self.assertEqual (d2['yaw_value'], 0.1)
+        self.assertEqual (d2['pitch_value'], 1/3.0)
+
+    def test_version_1(self):
+        #version 1 stored floats as float32
+        data = FaceswapChunk.header.pack (FaceswapChunk.MAGIC, 1, 1 << 2) + struct.pack ("<f", 0.25)
+        d = FaceswapChunk.load ( Chunk("fcWp", data).dump() ).getDictData()
+        self.assertEqual (d['yaw_value'], 0.25)
+        self.assertIsNone (d['landmarks'])
+        self.assertNotIn ('extra', d)
+
+    def test_unknown_keys(self):
+        d = get_dict_data ( np.random.RandomState(0) )
+        d.update ( { 'unknown' : 1, 'extra' : 'text', 'mask' : np.ones ( (4,4), dtype=np.uint8 ) } )
+        chunk = FaceswapChunk.load ( FaceswapChunk(d).dump() )
+        self.assertDictDataEqual (chunk.getDictData(), d)
+
+        with self.assertRaises (ValueError):
+            FaceswapChunk.encode ( {'face_type' : 'full_face', 'unknown' : collections.OrderedDict()} )
+
+    def test_legacy_pickle(self):
+        d = get_dict_data ( np.random.RandomState(1) )
+        chunk = FaceswapChunk.load ( Chunk("fcWp", pickle.dumps(d)).dump() )
+        self.assertTrue (chunk.legacy)
+        self.assertDictDataEqual (chunk.getDictData(), d)
+
+        #converted chunk is binary and holds the same data
+        chunk = FaceswapChunk.load ( chunk.dump() )
+        self.assertFalse (chunk.legacy)
+        self.assertDictDataEqual (chunk.getDictData(), d)
+
+    def test_legacy_pickle_rejects_globals(self):
+        data = pickle.dumps ( collections.OrderedDict(face_type='full_face') )
+        with self.assertRaises (pickle.UnpicklingError):
+            FaceswapChunk.load ( Chunk("fcWp", data).dump() )
+
+class AlignedPNGTest(unittest.TestCase):
+    def test_round_trip(self):
+        rnd = np.random.RandomState(2)
+        img = rnd.randint (0, 256, (32,48,3)).astype(np.uint8)
+        d = get_dict_data (rnd)
+
+        a_png = AlignedPNG.from_bytes ( cv2.imencode('.png', img)[1].tobytes() )
+        a_png.setFaceswapDictData (d)
+        data = a_png.dump()
+
+        np.testing.assert_array_equal ( cv2.imdecode (np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR), img )
+        a_png = AlignedPNG.from_bytes (data)
+        self.assertEqual (a_png.get_shape(), (32,48,3))
+        self.assertFalse (a_png.isFaceswapDataLegacy())
+        np.testing.assert_array_equal (a_png.getFaceswapDictData()['landmarks'], d['landmarks'])
+
+if __name__ == '__main__':
+    unittest.main()
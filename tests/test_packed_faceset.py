@@ -0,0 +1,127 @@
+import sys
+import pickle
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+import numpy as np
+import cv2
+
+sys.path.insert (0, str(Path(__file__).resolve().parent.parent))
+from utils.AlignedPNG import AlignedPNG
+from utils.AlignedIndex import AlignedIndex
+from utils.PackedFaceset import PackedFaceset
+from models.TrainingDataGeneratorBase import X_RAWS, X_LOAD
+from mainscripts import Util
+
+def write_aligned_png(filepath, rnd):
+    img = rnd.randint (0, 256, (16,16,3)).astype(np.uint8)
+    d = { 'face_type'        : 'full_face',
+          'landmarks'        : rnd.uniform (0, 16, (68,2)).astype(np.float32),
+          'yaw_value'        : float(rnd.uniform(-1, 1)),
+          'source_filename'  : '%s.jpg' % (Path(filepath).stem),
+          'source_rect'      : (1, 2, 30, 40),
+          'source_landmarks' : rnd.randint (0, 100, (68,2)) }
+    a_png = AlignedPNG.from_bytes ( cv2.imencode('.png', img)[1].tobytes() )
+    a_png.setFaceswapDictData (d)
+    a_png.save (filepath)
+
+class PackedFacesetTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_path = Path ( tempfile.mkdtemp() )
+        self.dir_path = self.tmp_path / 'aligned'
+        self.dir_path.mkdir()
+        rnd = np.random.RandomState(0)
+        for i in range(5):
+            write_aligned_png ( self.dir_path / ('%.5d_0.png' % (i)), rnd )
+        self.files = { x.name : x.read_bytes() for x in self.dir_path.glob('*.png') }
+
+    def tearDown(self):
+        shutil.rmtree ( str(self.tmp_path) )
+
+    def pack(self):
+        for filepath in PackedFaceset.pack (self.dir_path):
+            Path(filepath).unlink()
+        return PackedFaceset.load (self.dir_path)
+
+    def test_pack_unpack(self):
+        index = AlignedIndex.load (self.dir_path)
+        packed_faceset = self.pack()
+        self.assertEqual ( len(packed_faceset), len(self.files) )
+        self.assertEqual ( list(self.dir_path.glob('*.png')), [] )
+
+        #packed files are byte exact and index is the same as index of files
+        for i, filepath in enumerate ( packed_faceset.get_filepaths() ):
+            name = Path(filepath).name
+            self.assertEqual ( packed_faceset.get_buffer(i).tobytes(), self.files[name] )
+            d = packed_faceset.index.get_dict(i)
+            expected = index.get_dict ( index.find(name) )
+            for key, value in expected.items():
+                if isinstance(value, np.ndarray):
+                    np.testing.assert_array_equal (d[key], value)
+                else:
+                    self.assertEqual (d[key], value)
+        packed_faceset.close()
+
+        PackedFaceset.unpack (self.dir_path)
+        self.assertFalse ( PackedFaceset.get_path(self.dir_path).exists() )
+        self.assertEqual ( { x.name : x.read_bytes() for x in self.dir_path.glob('*.png') }, self.files )
+
+    def test_load_image(self):
+        images = { name : cv2.imdecode ( np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR ) for name, data in self.files.items() }
+        packed_faceset = self.pack()
+
+        #pickled copy, as sent to subprocess, opens its own mapping
+        for faceset in [packed_faceset, pickle.loads ( pickle.dumps(packed_faceset) )]:
+            for name, img in images.items():
+                np.testing.assert_array_equal ( faceset.load_image ( str(self.dir_path / name) ), img )
+            self.assertIsNone ( faceset.load_image ('missing.png') )
+            faceset.close()
+
+    def test_training_samples(self):
+        expected = { Path(s.filename).name : s for s in X_LOAD ( X_RAWS (str(self.dir_path)) ) }
+        expected_images = { name : s.load_bgr() for name, s in expected.items() }
+        self.pack()
+
+        samples = X_LOAD ( X_RAWS (str(self.dir_path)) )
+        self.assertEqual ( len(samples), len(expected) )
+        for s in samples:
+            e = expected[ Path(s.filename).name ]
+            self.assertEqual (s.shape, e.shape)
+            self.assertEqual (s.yaw, e.yaw)
+            np.testing.assert_array_equal (s.landmarks, e.landmarks)
+            np.testing.assert_array_equal (s.load_bgr(), expected_images[ Path(s.filename).name ])
+
+    def test_verify(self):
+        filepaths = PackedFaceset.pack (self.dir_path)
+        packed_faceset = PackedFaceset.load (self.dir_path)
+        self.assertTrue ( packed_faceset.verify (filepaths) )
+        self.assertFalse ( packed_faceset.verify (filepaths[1:]) )
+
+        #file changed after packing
+        Path(filepaths[0]).write_bytes (b'changed')
+        self.assertFalse ( packed_faceset.verify (filepaths) )
+        packed_faceset.close()
+
+    def test_pack_faceset_keeps_files(self):
+        Util.pack_faceset (self.dir_path)
+        self.assertEqual ( { x.name : x.read_bytes() for x in self.dir_path.glob('*.png') }, self.files )
+        self.assertEqual ( len ( PackedFaceset.load (self.dir_path) ), len(self.files) )
+
+    def test_pack_faceset_delete_packed(self):
+        Util.pack_faceset (self.dir_path, delete_packed=True)
+        self.assertEqual ( list(self.dir_path.glob('*.png')), [] )
+        packed_faceset = PackedFaceset.load (self.dir_path)
+        self.assertEqual ( { Path(x).name : packed_faceset.get_buffer(i).tobytes() for i, x in enumerate(packed_faceset.get_filepaths()) }, self.files )
+        packed_faceset.close()
+
+    def test_load_index(self):
+        self.pack()
+        #loose file of packed directory is not indexed
+        cv2.imwrite ( str(self.dir_path / 'loose.png'), np.zeros ( (8,8,3), dtype=np.uint8 ) )
+        index = PackedFaceset.load_index (self.dir_path)
+        self.assertEqual ( len(index), len(self.files) )
+        self.assertIsNone ( index.find ('loose.png') )
+
+if __name__ == '__main__':
+    unittest.main()
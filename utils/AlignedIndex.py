@@ -0,0 +1,225 @@
+import os
+import time
+import shutil
+from pathlib import Path
+import numpy as np
+from tqdm import tqdm
+from utils import Path_utils
+from utils.AlignedPNG import AlignedPNG
+
+class AlignedIndex(object):
+    #embedded data of all aligned faces of directory, stored in <dir>_cache/index as .npy columns, which are opened memory mapped
+    #rows are matched to files by name, mtime and size, so only new and changed files are read by update
+    #missing values are stored as NaN or empty string
+    #points columns have shape (rows, max points count, 2), count of points of row is in <name>_count column, -1 if missing
+
+    columns = { 'filename'         : ( (), '<U255' ),
+                'mtime'            : ( (), np.float64 ),
+                'size'             : ( (), np.int64 ),
+                'has_data'         : ( (), np.bool_ ),
+                'shape'            : ( (3,), np.int32 ),
+                'face_type'        : ( (), '<U16' ),
+                'landmarks'        : ( (None,2), np.float64 ),
+                'landmarks_count'  : ( (), np.int32 ),
+                'yaw_value'        : ( (), np.float64 ),
+                'pitch_value'      : ( (), np.float64 ),
+                'source_filename'  : ( (), '<U255' ),
+                'source_rect'      : ( (4,), np.float64 ),
+                'source_landmarks' : ( (None,2), np.float64 ),
+                'source_landmarks_count' : ( (), np.int32 ),
+              }
+    points_columns = ['landmarks', 'source_landmarks']
+    #directory, which was changed recently, may be changed again within its mtime resolution, so its mtime is not trusted
+    dir_mtime_resolution = 2.0
+
+    def __init__(self, dir_path, data=None):
+        #data - columns of already loaded index, such as index of PackedFaceset
+        self.dir_path = Path(dir_path)
+        self.index_path = self.dir_path.parent / (self.dir_path.name + '_cache') / 'index'
+        #(mtime_ns, files count) of directory, when index was last matched to its files
+        self.dir_state = None
+        if data is None:
+            self.open()
+        else:
+            self.data = data
+            self.rows = None
+
+    @staticmethod
+    def create_data(count, points_count=68):
+        return { name : np.zeros ( (count,)+tuple ( [ points_count if x is None else x for x in shape ] ), dtype=dtype ) for name, (shape, dtype) in AlignedIndex.columns.items() }
+
+    @staticmethod
+    def load(dir_path, update=True):
+        #returns index of directory, updated by its current files
+        index = AlignedIndex(dir_path)
+        if update:
+            index.update()
+        return index
+
+    def open(self):
+        self.data = None
+        self.rows = None
+        try:
+            data = {}
+            for name in AlignedIndex.columns.keys():
+                filepath = str ( self.index_path / (name + '.npy') )
+                try:
+                    data[name] = np.load (filepath, mmap_mode='r')
+                except ValueError:
+                    #column without rows cannot be memory mapped
+                    data[name] = np.load (filepath)
+            if len ( set ( [ len(x) for x in data.values() ] ) ) == 1:
+                self.data = data
+                self.dir_state = np.load ( str(self.index_path / 'dir_state.npy') )
+        except:
+            pass
+
+        if self.data is None:
+            self.data = AlignedIndex.create_data (0)
+
+    def __len__(self):
+        return len(self.data['filename'])
+
+    def find(self, filename):
+        #returns row of file with name of filename, or None
+        if self.rows is None:
+            self.rows = { name : i for i, name in enumerate(self.data['filename']) }
+        return self.rows.get ( Path(filename).name, None )
+
+    def get_filepath(self, i):
+        return str ( self.dir_path / self.data['filename'][i] )
+
+    def get_shape(self, i):
+        return tuple ( [ int(x) for x in self.data['shape'][i] ] )
+
+    def get_dict(self, i):
+        #returns the same dict as AlignedPNG.getFaceswapDictData of file, None if file has no embedded data
+        if not self.data['has_data'][i]:
+            return None
+        d = {}
+        for name in AlignedIndex.points_columns:
+            count = self.data[name + '_count'][i]
+            if count < 0:
+                d[name] = None
+            else:
+                value = np.array(self.data[name][i][0:count])
+                #landmarks of source frame are integer
+                d[name] = value.astype(np.int32) if (value == np.round(value)).all() else value
+        for name in ['yaw_value', 'pitch_value']:
+            value = self.data[name][i]
+            d[name] = None if np.isnan(value) else float(value)
+        for name in ['face_type', 'source_filename']:
+            value = str(self.data[name][i])
+            d[name] = value if len(value) != 0 else None
+        value = self.data['source_rect'][i]
+        if np.isnan(value).any():
+            d['source_rect'] = None
+        else:
+            #rects of detectors are integer, rects of manual extractor may be not
+            value = tuple ( [ float(x) for x in value ] )
+            d['source_rect'] = tuple ( [ int(x) for x in value ] ) if all ( [ x.is_integer() for x in value ] ) else value
+        return d
+
+    def get_dir_state(self, count):
+        #files are added, removed, renamed and rewritten by AlignedPNG.save through rename, all of which change mtime of directory
+        st = os.stat ( str(self.dir_path) )
+        if time.time() - st.st_mtime < AlignedIndex.dir_mtime_resolution:
+            return None
+        return np.array ( [st.st_mtime_ns, count], dtype=np.int64 )
+
+    def update(self):
+        #reads new and changed .png files of directory, removes rows of missing files and saves index if it is changed
+        #files are not checked one by one, if mtime of directory and count of files are the same as last time
+        filepaths = [ x for x in Path_utils.get_image_paths(self.dir_path) if Path(x).suffix == '.png' ]
+        dir_state = self.get_dir_state ( len(filepaths) )
+        if dir_state is not None and self.dir_state is not None and np.array_equal (dir_state, self.dir_state) and len(filepaths) == len(self):
+            return
+
+        rows = []
+        changed = False
+        for filepath in tqdm ( filepaths, desc="Indexing", disable=len(filepaths) < 1000 ):
+            st = os.stat (filepath)
+            i = self.find (filepath)
+            if i is not None and self.data['mtime'][i] == st.st_mtime and self.data['size'][i] == st.st_size:
+                rows.append (i)
+            else:
+                rows.append ( self.read_row (filepath, st) )
+                changed = True
+
+        self.dir_state = dir_state
+        if not changed and len(rows) == len(self):
+            self.save_dir_state()
+            return
+
+        kept = [ j for j, row in enumerate(rows) if not isinstance(row, dict) ]
+        kept_rows = [ rows[j] for j in kept ]
+        points_count = max ( [ self.data['landmarks'].shape[1] ] + [ len(row[name]) for row in rows if isinstance(row, dict) for name in AlignedIndex.points_columns if row[name + '_count'] >= 0 ] )
+        data = AlignedIndex.create_data ( len(rows), points_count )
+        for name, column in data.items():
+            if name in AlignedIndex.points_columns:
+                column[kept, 0:self.data[name].shape[1]] = self.data[name][kept_rows]
+            else:
+                column[kept] = self.data[name][kept_rows]
+            for j, row in enumerate(rows):
+                if isinstance(row, dict):
+                    if name in AlignedIndex.points_columns:
+                        column[j, 0:max(0, row[name + '_count'])] = row[name]
+                    else:
+                        column[j] = row[name]
+        self.data = data
+        self.rows = None
+        self.save()
+
+    def read_row(self, filepath, st):
+        row = { 'filename' : Path(filepath).name, 'mtime' : st.st_mtime, 'size' : st.st_size, 'has_data' : False,
+                'shape' : (0,0,0), 'face_type' : '', 'landmarks' : np.nan, 'landmarks_count' : -1, 'yaw_value' : np.nan, 'pitch_value' : np.nan,
+                'source_filename' : '', 'source_rect' : np.nan, 'source_landmarks' : np.nan, 'source_landmarks_count' : -1 }
+        try:
+            a_png = AlignedPNG.load_metadata (str(filepath))
+        except:
+            return row
+
+        row['shape'] = a_png.get_shape()
+        d = a_png.getFaceswapDictData()
+        if d is not None:
+            #values are checked against columns here, so file with malformed data is indexed as file without data
+            try:
+                values = {}
+                for name in ['face_type', 'landmarks', 'yaw_value', 'pitch_value', 'source_filename', 'source_rect', 'source_landmarks']:
+                    value = d.get (name, None)
+                    if value is not None:
+                        shape, dtype = AlignedIndex.columns[name]
+                        values[name] = np.asarray (value, dtype=dtype)
+                        if values[name].ndim != len(shape) or any ( [ x is not None and x != y for x, y in zip(shape, values[name].shape) ] ):
+                            raise ValueError ("%s has shape %s, expected %s" % (name, values[name].shape, shape) )
+                        if name in AlignedIndex.points_columns:
+                            values[name + '_count'] = len(values[name])
+                row.update (values)
+                row['has_data'] = True
+            except Exception as e:
+                print ("%s - invalid embedded data: %s" % (filepath, str(e)) )
+        return row
+
+    def save(self):
+        #columns are written to new directory, which replaces the old one
+        tmp_path = self.index_path.parent / (self.index_path.name + '.tmp')
+        if tmp_path.exists():
+            shutil.rmtree ( str(tmp_path) )
+        tmp_path.mkdir (parents=True)
+        for name, column in self.data.items():
+            np.save ( str(tmp_path / (name + '.npy')), column )
+        if self.dir_state is not None:
+            np.save ( str(tmp_path / 'dir_state.npy'), self.dir_state )
+
+        if self.index_path.exists():
+            shutil.rmtree ( str(self.index_path) )
+        tmp_path.rename (self.index_path)
+
+    def save_dir_state(self):
+        if not self.index_path.exists():
+            return
+        filepath = self.index_path / 'dir_state.npy'
+        if self.dir_state is not None:
+            np.save ( str(filepath), self.dir_state )
+        elif filepath.exists():
+            filepath.unlink()
@@ -1,9 +1,12 @@
 PNG_HEADER = b"\x89PNG\r\n\x1a\n"
 
+import io
+import os
 import string
 import struct
 import zlib
 import pickle
+import numpy as np
 
 class Chunk(object):
     def __init__(self, name=None, data=None):
@@ -13,7 +16,7 @@ class Chunk(object):
         self.data = data if data else b""
 
     @classmethod
-    def load(cls, data):
+    def load(cls, data, verify_crc=True):
         """Load a chunk including header and footer"""
         inst = cls()
         if len(data) < 12:
@@ -29,7 +32,8 @@ class Chunk(object):
 
         # chunk crc
         inst.crc = struct.unpack("!I", data[8+inst.length:8+inst.length+4])[0]
-        inst.verify_crc()
+        if verify_crc:
+            inst.verify_crc()
 
         return inst
 
@@ -38,7 +42,7 @@ class Chunk(object):
         if auto_length: self.update_length()
         if auto_crc: self.update_crc()
         self.verify_name()
-        return struct.pack("!I", self.length) + self.get_raw_name() + self.data + struct.pack("!I", self.crc)
+        return b"".join ( [struct.pack("!I", self.length), self.get_raw_name(), self.data, struct.pack("!I", self.crc)] )
 
     def verify_length(self):
         if len(self.data) != self.length:
@@ -146,8 +150,8 @@ class IHDR(Chunk):
 		super().__init__("IHDR")
 
 	@classmethod
-	def load(cls, data):
-		inst = super().load(data)
+	def load(cls, data, verify_crc=True):
+		inst = super().load(data, verify_crc)
 		fields = struct.unpack("!IIBBBBB", inst.data)
 		inst.width = fields[0]
 		inst.height = fields[1]
@@ -184,10 +188,47 @@ class IEND(Chunk):
     def __str__(self):
         return "<Chunk:IEND>".format(**self.__dict__)
 
+class LegacyUnpickler(pickle.Unpickler):
+    #dict data of fcWp chunks written by older versions is pickled
+    #only builtin types and numpy arrays and scalars are allowed to be loaded from it
+    allowed_globals = [ ('numpy.core.multiarray', '_reconstruct'), ('numpy.core.multiarray', 'scalar'),
+                        ('numpy._core.multiarray', '_reconstruct'), ('numpy._core.multiarray', 'scalar'),
+                        ('numpy', 'ndarray'), ('numpy', 'dtype') ]
+
+    def find_class(self, module, name):
+        if (module, name) in LegacyUnpickler.allowed_globals:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError("global '%s.%s' is not allowed in fcWp chunk" % (module, name) )
+
 class FaceswapChunk(Chunk):
+    #dict data is stored in binary schema:
+    #header - magic, version, bit mask of present fields
+    #fields in order of schema, little endian:
+    #   'str'    - uint16 length, utf-8 bytes
+    #   'float'  - float64, float32 in version 1
+    #   'rect'   - 4 float64
+    #   'points' - uint16 count, uint8 dtype code, count x 2 array of int32, float32 or float64,
+    #              integer points are stored as int32, float points keep their precision
+    #   'pickle' - uint32 length, pickled dict of keys, which are not in schema, loaded by LegacyUnpickler
+    #missing or None fields are not stored and loaded as None
+
+    MAGIC = b"DFLm"
+    VERSION = 2
+    header = struct.Struct("<4sBH")
+    schema = [ ('face_type', 'str'),
+               ('landmarks', 'points'),
+               ('yaw_value', 'float'),
+               ('pitch_value', 'float'),
+               ('source_filename', 'str'),
+               ('source_rect', 'rect'),
+               ('source_landmarks', 'points'),
+               ('extra', 'pickle') ]
+    points_dtypes = [ np.dtype('<i4'), np.dtype('<f4'), np.dtype('<f8') ]
+
     def __init__(self, dict_data=None):
         super().__init__("fcWp")
-        self.dict_data = dict_data       
+        self.dict_data = dict_data
+        self.legacy = False
 
     def setDictData(self, dict_data):
         self.dict_data = dict_data
@@ -196,15 +237,113 @@ class FaceswapChunk(Chunk):
         return self.dict_data
         
     @classmethod
-    def load(cls, data):
-        inst = super().load(data)
-        inst.dict_data = pickle.loads( inst.data )        
+    def load(cls, data, verify_crc=True):
+        inst = super().load(data, verify_crc)
+        if inst.data[0:4] == FaceswapChunk.MAGIC:
+            inst.dict_data = FaceswapChunk.decode (inst.data)
+        else:
+            inst.dict_data = LegacyUnpickler ( io.BytesIO(inst.data) ).load()
+            inst.legacy = True
         return inst
         
     def dump(self):
-        self.data = pickle.dumps (self.dict_data)
+        self.data = FaceswapChunk.encode (self.dict_data)
+        self.legacy = False
         return super().dump()
-        
+
+    @staticmethod
+    def encode(dict_data):
+        schema_keys = [ key for key, kind in FaceswapChunk.schema if key != 'extra' ]
+        extra = { key : value for key, value in dict_data.items() if key not in schema_keys }
+        dict_data = { key : value for key, value in dict_data.items() if key in schema_keys }
+        if len(extra) != 0:
+            dict_data['extra'] = extra
+
+        mask = 0
+        fields = []
+        for i, (key, kind) in enumerate(FaceswapChunk.schema):
+            value = dict_data.get (key, None)
+            if value is None:
+                continue
+            mask |= 1 << i
+
+            if kind == 'str':
+                value = str(value).encode('utf-8')
+                fields.append ( struct.pack("<H", len(value)) + value )
+            elif kind == 'float':
+                fields.append ( struct.pack("<d", value) )
+            elif kind == 'rect':
+                fields.append ( struct.pack("<4d", *value) )
+            elif kind == 'points':
+                value = np.asarray (value)
+                if np.issubdtype (value.dtype, np.integer):
+                    code = 0
+                elif value.dtype == np.float32:
+                    code = 1
+                else:
+                    code = 2
+                value = value.astype (FaceswapChunk.points_dtypes[code]).reshape ( (-1,2) )
+                fields.append ( struct.pack("<HB", len(value), code) + value.tobytes() )
+            elif kind == 'pickle':
+                value = pickle.dumps (value, protocol=4)
+                try:
+                    LegacyUnpickler ( io.BytesIO(value) ).load()
+                except pickle.UnpicklingError as e:
+                    raise ValueError ( "Keys %s of fcWp chunk can not be stored: %s" % (list(extra.keys()), e) )
+                fields.append ( struct.pack("<I", len(value)) + value )
+
+        return FaceswapChunk.header.pack (FaceswapChunk.MAGIC, FaceswapChunk.VERSION, mask) + b"".join(fields)
+
+    @staticmethod
+    def decode(data):
+        magic, version, mask = FaceswapChunk.header.unpack_from (data, 0)
+        if version > FaceswapChunk.VERSION:
+            raise ValueError ( "fcWp chunk version %d is not supported" % (version) )
+
+        #arrays share writable copy of data
+        data = bytearray(data)
+        d = {}
+        offset = FaceswapChunk.header.size
+        for i, (key, kind) in enumerate(FaceswapChunk.schema):
+            if not mask & (1 << i):
+                d[key] = None
+                continue
+
+            if kind == 'str':
+                length, = struct.unpack_from ("<H", data, offset)
+                offset += 2
+                d[key] = data[offset:offset+length].decode('utf-8')
+                offset += length
+            elif kind == 'float':
+                if version < 2:
+                    d[key] = struct.unpack_from ("<f", data, offset)[0]
+                    offset += 4
+                else:
+                    d[key] = struct.unpack_from ("<d", data, offset)[0]
+                    offset += 8
+            elif kind == 'rect':
+                value = struct.unpack_from ("<4d", data, offset)
+                offset += 32
+                #rects of detectors are integer, rects of manual extractor may be not
+                d[key] = tuple ( [ int(x) for x in value ] ) if all ( [ x.is_integer() for x in value ] ) else value
+            elif kind == 'points':
+                count, code = struct.unpack_from ("<HB", data, offset)
+                offset += 3
+                dtype = FaceswapChunk.points_dtypes[code]
+                d[key] = np.frombuffer (data, dtype=dtype, count=count*2, offset=offset).reshape ( (count,2) )
+                offset += count*2*dtype.itemsize
+            elif kind == 'pickle':
+                length, = struct.unpack_from ("<I", data, offset)
+                offset += 4
+                d[key] = LegacyUnpickler ( io.BytesIO(data[offset:offset+length]) ).load()
+                offset += length
+        #keys, which are not in schema, are returned as they were given
+        d.update ( d.pop ('extra') or {} )
+        return d
+
+    def __str__(self):
+        return "<Chunk:fcWp length={length} legacy={legacy}>".format(**self.__dict__)
+
 chunk_map = {
     b"IHDR": IHDR,
     b"fcWp": FaceswapChunk,
@@ -216,6 +355,7 @@ class AlignedPNG(object):
         self.data = b""
         self.length = 0
         self.chunks = []
+        self.metadata_only = False
 
     @staticmethod
     def load(data):
@@ -225,7 +365,12 @@ class AlignedPNG(object):
                 data = f.read()
         except:
             raise FileNotFoundError(data)
-    
+
+        return AlignedPNG.from_bytes (data)
+
+    @staticmethod
+    def from_bytes(data, verify_crc=True):
+        #data - PNG file in memory, such as buffer of cv2.imencode
         inst = AlignedPNG()
         inst.data = data
         inst.length = len(data)
@@ -239,25 +384,63 @@ class AlignedPNG(object):
             (chunk_length, chunk_name) = struct.unpack("!I4s", data[chunk_start:chunk_start+8])
             chunk_end = chunk_start + chunk_length + 12
 
-            chunk = chunk_map.get(chunk_name, Chunk).load(data[chunk_start:chunk_end])
+            chunk = chunk_map.get(chunk_name, Chunk).load(data[chunk_start:chunk_end], verify_crc)
             inst.chunks.append(chunk)
             chunk_start = chunk_end
 
         return inst
-        
+
+    @staticmethod
+    def load_metadata(filename, verify_crc=False):
+        #reads only IHDR and fcWp chunks, other chunks (IDAT) are skipped by seeking over them
+        #returned AlignedPNG has no image data and cannot be saved
+        try:
+            f = open(filename, "rb")
+        except:
+            raise FileNotFoundError(filename)
+
+        inst = AlignedPNG()
+        inst.metadata_only = True
+
+        with f:
+            if f.read(8) != PNG_HEADER:
+                msg = "No Valid PNG header"
+                raise ValueError(msg)
+
+            found = set()
+            while len(found) < 2:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                (chunk_length, chunk_name) = struct.unpack("!I4s", header)
+                if chunk_name == b"IEND":
+                    break
+
+                if chunk_name == b"IHDR" or chunk_name == b"fcWp":
+                    chunk = chunk_map[chunk_name].load(header + f.read(chunk_length + 4), verify_crc)
+                    inst.chunks.append(chunk)
+                    found.add(chunk_name)
+                else:
+                    f.seek(chunk_length + 4, 1)
+
+            inst.length = f.tell()
+
+        return inst
         
     def save(self, filename):
+        #file is written once, to temporary file which replaces filename, so it is never left partially written
+        tmp_filename = str(filename) + '.tmp'
         try:
-            with open(filename, "wb") as f:
+            with open(tmp_filename, "wb") as f:
                 f.write ( self.dump() )
+            os.replace (tmp_filename, str(filename))
         except:
             raise Exception( 'cannot save %s' % (filename) )
 
     def dump(self):
-        data = PNG_HEADER
-        for chunk in self.chunks:
-            data += chunk.dump()
-        return data
+        if self.metadata_only:
+            raise Exception('AlignedPNG loaded by load_metadata has no image data to dump')
+        return b"".join ( [PNG_HEADER] + [ chunk.dump() for chunk in self.chunks ] )
         
     def get_shape(self):
         for chunk in self.chunks:
@@ -280,6 +463,13 @@ class AlignedPNG(object):
                 return chunk.getDictData()
         return None
                 
+    def isFaceswapDataLegacy(self):
+        #True if embedded dict data is pickled by older version
+        for chunk in self.chunks:
+            if type(chunk) == FaceswapChunk:
+                return chunk.legacy
+        return False
+
     def setFaceswapDictData (self, dict_data=None):
         for chunk in self.chunks:
             if type(chunk) == FaceswapChunk:
@@ -0,0 +1,174 @@
+import io
+import mmap
+import struct
+from pathlib import Path
+import numpy as np
+import cv2
+from tqdm import tqdm
+from utils import Path_utils
+from utils.AlignedIndex import AlignedIndex
+
+class PackedFaceset(object):
+    #aligned faces of directory packed in single file <dir>/faceset.pak
+    #layout: header (magic, version, offset of index), .png files as they are on disk one after another, index
+    #index - columns of AlignedIndex with offset and length of every file, saved by np.savez
+    #files are read from memory mapped pak, opened on first read, so pickled copy sent to subprocess opens its own
+
+    filename = 'faceset.pak'
+    MAGIC = b"DFLpak"
+    VERSION = 1
+    header = struct.Struct("<6sBQ")
+
+    def __init__(self, filepath):
+        self.filepath = Path(filepath)
+        self.open()
+
+    def __getstate__(self):
+        return {'filepath': self.filepath}
+
+    def __setstate__(self, d):
+        self.filepath = d['filepath']
+        self.open()
+
+    @staticmethod
+    def get_path(dir_path):
+        return Path(dir_path) / PackedFaceset.filename
+
+    @staticmethod
+    def load(dir_path):
+        #returns PackedFaceset of directory, or None if directory is not packed
+        filepath = PackedFaceset.get_path(dir_path)
+        if not filepath.exists():
+            return None
+        return PackedFaceset(filepath)
+
+    @staticmethod
+    def load_index(dir_path):
+        #returns AlignedIndex of faces of directory, index of its faceset.pak if directory is packed
+        packed_faceset = PackedFaceset.load(dir_path)
+        if packed_faceset is None:
+            return AlignedIndex.load (dir_path)
+        packed_faceset.warn_unpacked_files()
+        return packed_faceset.index
+
+    def warn_unpacked_files(self):
+        #files added to packed directory, for example by later extract, are not read
+        dir_path = self.filepath.parent
+        count = len ( [ x for x in Path_utils.get_image_paths(dir_path) if Path(x).suffix == '.png' and self.index.find(x) is None ] )
+        if count > 0:
+            print ("Warning: %s is packed, its %d .png files which are not in %s are not used. Unpack and pack it again to include them." % (str(dir_path), count, PackedFaceset.filename) )
+
+    def open(self):
+        with open(str(self.filepath), "rb") as f:
+            magic, version, index_offset = PackedFaceset.header.unpack ( f.read(PackedFaceset.header.size) )
+            if magic != PackedFaceset.MAGIC:
+                raise ValueError ("%s is not packed faceset" % (self.filepath) )
+            if version > PackedFaceset.VERSION:
+                raise ValueError ("%s version %d is not supported" % (self.filepath, version) )
+            f.seek (index_offset)
+            with np.load ( io.BytesIO(f.read()) ) as npz:
+                data = { name : npz[name] for name in npz.files }
+
+        self.offsets = data.pop('offset')
+        self.lengths = data.pop('length')
+        self.index = AlignedIndex (self.filepath.parent, data)
+        self.mm = None
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_filepaths(self):
+        #paths of packed files as they were in directory
+        return [ self.index.get_filepath(i) for i in range(len(self.index)) ]
+
+    def get_buffer(self, i):
+        #returns uint8 array of packed file, which is view of mapped pak
+        if self.mm is None:
+            with open(str(self.filepath), "rb") as f:
+                self.mm = mmap.mmap (f.fileno(), 0, access=mmap.ACCESS_READ)
+        return np.frombuffer (self.mm, dtype=np.uint8, count=int(self.lengths[i]), offset=int(self.offsets[i]) )
+
+    def load_image(self, filename):
+        #cv2.imread of packed file with name of filename
+        i = self.index.find (filename)
+        if i is None:
+            return None
+        return cv2.imdecode ( self.get_buffer(i), cv2.IMREAD_COLOR )
+
+    @staticmethod
+    def pack(dir_path):
+        #packs aligned .png files of directory, returns paths of packed files
+        dir_path = Path(dir_path)
+        index = AlignedIndex.load (dir_path)
+        count = len(index)
+        if count == 0:
+            return []
+
+        filepath = PackedFaceset.get_path(dir_path)
+        tmp_filepath = Path( str(filepath) + '.tmp' )
+        data = { name : np.array(column) for name, column in index.data.items() }
+        data['offset'] = np.zeros ( (count,), dtype=np.int64 )
+        data['length'] = np.zeros ( (count,), dtype=np.int64 )
+
+        with open(str(tmp_filepath), "wb") as f:
+            f.write ( PackedFaceset.header.pack (PackedFaceset.MAGIC, PackedFaceset.VERSION, 0) )
+            for i in tqdm( range(count), desc="Packing"):
+                file_data = Path(index.get_filepath(i)).read_bytes()
+                data['offset'][i] = f.tell()
+                data['length'][i] = len(file_data)
+                f.write (file_data)
+
+            #string columns of AlignedIndex are wide, pak keeps only the longest used length
+            for name in ['filename', 'face_type', 'source_filename']:
+                data[name] = data[name].astype ( '<U%d' % ( max(1, np.char.str_len(data[name]).max() ) ) )
+
+            index_offset = f.tell()
+            npz = io.BytesIO()
+            np.savez (npz, **data)
+            f.write ( npz.getvalue() )
+            f.seek (0)
+            f.write ( PackedFaceset.header.pack (PackedFaceset.MAGIC, PackedFaceset.VERSION, index_offset) )
+
+        tmp_filepath.replace (filepath)
+        return [ index.get_filepath(i) for i in range(count) ]
+
+    def verify(self, filepaths):
+        #returns True if pak holds the same bytes as files of filepaths and its index can be read, errors are printed
+        try:
+            if len(self) != len(filepaths):
+                print ("%s has %d files, expected %d" % (self.filepath, len(self), len(filepaths)) )
+                return False
+            for filepath in tqdm (filepaths, desc="Verifying"):
+                i = self.index.find (filepath)
+                if i is None:
+                    print ("%s is not in %s" % (filepath, self.filepath) )
+                    return False
+                self.index.get_shape(i)
+                self.index.get_dict(i)
+                if self.get_buffer(i).tobytes() != Path(filepath).read_bytes():
+                    print ("%s differs from its copy in %s" % (filepath, self.filepath) )
+                    return False
+        except Exception as e:
+            print ("Unable to read %s: %s" % (self.filepath, str(e)) )
+            return False
+        return True
+
+    @staticmethod
+    def unpack(dir_path):
+        #writes packed files back to directory and removes pak, returns paths of written files
+        packed_faceset = PackedFaceset.load(dir_path)
+        if packed_faceset is None:
+            return []
+
+        filepaths = packed_faceset.get_filepaths()
+        for i, filepath in enumerate( tqdm(filepaths, desc="Unpacking") ):
+            Path(filepath).write_bytes ( packed_faceset.get_buffer(i).tobytes() )
+
+        packed_faceset.close()
+        packed_faceset.filepath.unlink()
+        return filepaths
@@ -2,7 +2,7 @@ from pathlib import Path
 from scandir import scandir
 import os
 
-image_extensions = [".jpg", ".jpeg", ".png", ".tif", ".tiff"]
+image_extensions = [".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp"]
 
 def get_image_paths(dir_path, recursive=False):
     dir_path = Path (dir_path)
@@ -1,16 +1,39 @@
 import traceback
 from tqdm import tqdm
 import multiprocessing
+import queue
+import threading
 import time
 import sys
 import os
+import numpy as np
+from utils import os_utils
 
 class SubprocessorBase(object):
+    chunk_target_time_sec = 0.1
+    chunk_max_size = 64
+    #processes are checked for termination and response deadline at this interval, also while messages keep coming
+    check_interval_sec = 1.0
+    autoscale_interval_sec = 5
+    autoscale_min_gain = 1.05
+    #count of autoscale intervals, for which pool keeps its size after reverted or blocked step
+    autoscale_hold_intervals = 6
+    #free system memory is kept above this count of memory of process
+    autoscale_memory_reserve = 2
 
     #overridable
-    def __init__(self, name, no_response_time_sec = 60): 
+    def __init__(self, name, no_response_time_sec = 60, prefetch_depth = 2, chunk_size = 1, workers_range = None, client_prefetch = False):
         self.name = name
         self.no_response_time_sec = no_response_time_sec
+        #count of data chunks queued to every client at once
+        self.prefetch_depth = prefetch_depth
+        #count of data items sent to client in one message, 0 - tune by measured item process time
+        self.chunk_size = chunk_size
+        #(min, max) count of processes, started from min and scaled by measured throughput
+        #None - start a process for every info of process_info_generator
+        self.workers_range = workers_range
+        #client calls onClientPrefetchData for queued data on separate thread, while it processes previous data
+        self.client_prefetch = client_prefetch
         
     #overridable    
     def process_info_generator(self):
@@ -34,6 +57,12 @@ class SubprocessorBase(object):
         #return data here
         return None
     
+    #overridable
+    def onHostKeepSentData (self, data):
+        #returns data kept by host while it is processed by client, which is given to onHostResult and onHostDataReturn
+        #override to drop large parts of data, which host can get again, such as decoded image
+        return data
+
     #overridable
     def onHostDataReturn (self, data):
         #input_data.insert(0, obj['data'])   
@@ -48,11 +77,30 @@ class SubprocessorBase(object):
     def onClientFinalize(self):
         pass
         
+    #overridable
+    def onClientPrefetchData(self, data):
+        #called on client prefetch thread, if client_prefetch is set, for data which waits for processing
+        #return data to be processed instead, for example with loaded content
+        return data
+
     #overridable
     def onClientProcessData(self, data):
         #return result object
         return None  
         
+    #overridable
+    def onClientProcessDataList(self, data_list, result_list):
+        #append result of every data to result_list, override to process several data at once
+        #results already in result_list are kept if exception occurs
+        for data in data_list:
+            result_list.append ( self.onClientProcessData (data) )
+
+    #overridable
+    def onClientSendResult(self, obj):
+        #called for every success and error message of processed data, sends it to host
+        #override to send it later, for example after data is written by background thread, messages must keep their order
+        self.client_cq.put (obj)
+
     #overridable
     def onClientGetDataName (self, data):
         #return string identificator of your data
@@ -75,6 +123,14 @@ class SubprocessorBase(object):
     def get_start_return(self):
         return None
         
+    @staticmethod
+    def get_workers_range(workers=None):
+        #default range starts with 2 processes and may grow up to count of CPUs
+        if workers is not None:
+            return workers
+        cpu_count = multiprocessing.cpu_count()
+        return (min(2, cpu_count), cpu_count)
+
     def inc_progress_bar(self, c):
         self.progress_bar.n += c
         self.progress_bar.refresh()
@@ -86,167 +142,422 @@ class SubprocessorBase(object):
     
     def process(self):
         #returns start_return
-        
+
         self.processes = []
-        
-        self.print_lock = multiprocessing.Lock()        
-        for name, host_dict, client_dict in self.process_info_generator():            
-            sq = multiprocessing.Queue()
-            cq = multiprocessing.Queue()
-            
-            client_dict.update ( {'print_lock' : self.print_lock} ) 
-            
-            p = multiprocessing.Process(target=self.subprocess, args=(sq,cq,client_dict))
-            p.daemon = True
-            p.start()
-            self.processes.append ( { 'process' : p,
-                                      'sq' : sq,
-                                      'cq' : cq,
-                                      'state' : 'busy',
-                                      'sent_time': time.time(),
-                                      'name': name,
-                                      'host_dict' : host_dict
-                                    } )
 
-        while True:
-            for p in self.processes[:]:
-                while not p['cq'].empty():
-                    obj = p['cq'].get()
-                    obj_op = obj['op']
-                        
-                    if obj_op == 'init_ok':
-                        p['state'] = 'free'
-                    elif obj_op == 'error':                       
-                        if obj['close'] == True:
-                            p['process'].terminate()
-                            p['process'].join()
-                            self.processes.remove(p)
-                            break                
-                    
-            if all ([ p['state'] == 'free' for p in self.processes ] ):
-                break
-                
+        self.print_lock = multiprocessing.Lock()
+        self.result_queue = multiprocessing.Queue()
+        self.pending_results = []
+        self.item_time = None
+        self.check_time = time.time()
+        self.process_infos = iter(self.process_info_generator())
+        self.closed_process_infos = []
+        self.next_process_idx = 0
+        self.autoscale_enabled = self.workers_range is not None and self.workers_range[0] < self.workers_range[1]
+        self.autoscale_throughput = None
+        #last step of autoscale: 1 - process added, -1 - process closed, 0 - none
+        self.autoscale_step = 0
+        self.autoscale_direction = 1
+        self.autoscale_hold = 0
+        #set if processing is stopped by exception or Ctrl-C, unfinished data is returned to host by onHostDataReturn
+        self.interrupted = False
+
+        if self.workers_range is None:
+            while self.start_process():
+                pass
+        else:
+            for i in range(self.workers_range[0]):
+                if not self.start_process():
+                    break
+
+        while any ([ p['state'] == 'init' for p in self.processes ]):
+            obj = self.get_result ( max(0, self.check_time + self.check_interval_sec - time.time()) )
+            if obj is not None:
+                self.handle_message (obj)
+            self.check_processes_at_interval()
+
         if len(self.processes) == 0:
             print ( self.get_no_process_started_message() )
             return self.get_start_return()
-            
+
         self.onHostClientsInitialized()
-        
-        self.progress_bar = tqdm( total=self.onHostGetProgressBarLen(), desc=self.onHostGetProgressBarDesc() )  
-        
-        try: 
+
+        self.progress_bar = tqdm( total=self.onHostGetProgressBarLen(), desc=self.onHostGetProgressBarDesc() )
+
+        self.autoscale_reset()
+
+        try:
             while True:
-                for p in self.processes[:]:
-                    while not p['cq'].empty():
-                        obj = p['cq'].get()
-                        obj_op = obj['op']
-                        
-                        if obj_op == 'success':   
-                            data = obj['data']
-                            result = obj['result']
-                            
-                            c = self.onHostResult (data, result)                        
-                            if c > 0:
-                                self.progress_bar.update(c)
-                                
-                            p['state'] = 'free'
-                            
-                        elif obj_op == 'error':
-                            if 'data' in obj.keys():
-                                self.onHostDataReturn ( obj['data'] )
-            
-                            if obj['close'] == True:
-                                p['sq'].put ( {'op': 'close'} )
-                                p['process'].join()
-                                self.processes.remove(p)
+                #keep every worker fed with up to prefetch_depth items, so it never waits for the host
+                data_exhausted = False
+                for p in self.processes:
+                    if p['state'] != 'free':
+                        continue
+                    while len(p['sent_data']) < self.prefetch_depth:
+                        data_list = []
+                        while len(data_list) < self.get_chunk_size():
+                            data = self.onHostGetData()
+                            if data is None:
+                                data_exhausted = True
                                 break
-                            p['state'] = 'free'
-                            
-                for p in self.processes[:]:
-                    if p['state'] == 'free':
-                        data = self.onHostGetData()
-                        if data is not None:
-                            p['sq'].put ( {'op': 'data', 'data' : data} )
+                            data_list.append (data)
+
+                        if len(data_list) == 0:
+                            break
+                        if len(p['sent_data']) == 0:
                             p['sent_time'] = time.time()
-                            p['sent_data'] = data
-                            p['state'] = 'busy'
-                        
-                    elif p['state'] == 'busy':
-                        if (time.time() - p['sent_time']) > self.no_response_time_sec:
-                            print ( '%s doesnt response, terminating it.' % (p['name']) )
-                            self.onHostDataReturn ( p['sent_data'] )                        
-                            p['sq'].put ( {'op': 'close'} )
-                            p['process'].join()
-                            self.processes.remove(p)
-                            
-                if all ([p['state'] == 'free' for p in self.processes]):
+                        p['sq'].put ( {'op': 'data', 'data' : data_list} )
+                        p['sent_data'].append ( [ self.onHostKeepSentData(data) for data in data_list ] )
+
+                for p in self.processes:
+                    if p['state'] == 'closing' and len(p['sent_data']) == 0:
+                        p['sq'].put ( {'op': 'close'} )
+                        p['state'] = 'close_sent'
+
+                busy_processes = [ p for p in self.processes if len(p['sent_data']) > 0 ]
+                if len(busy_processes) == 0 and not any ([ p['state'] == 'init' for p in self.processes ]):
                     break
-                    
-                time.sleep(0.005)
+
+                #response deadlines of processes are checked by check_processes_at_interval
+                deadlines = [ self.check_time + self.check_interval_sec ]
+                if self.autoscale_enabled:
+                    deadlines.append ( self.autoscale_time + self.autoscale_interval_sec )
+                timeout = min (deadlines) - time.time()
+
+                obj = self.get_result ( max(0, timeout) )
+                if obj is not None:
+                    self.handle_message (obj)
+
+                self.check_processes_at_interval()
+
+                if self.autoscale_enabled and time.time() >= self.autoscale_time + self.autoscale_interval_sec:
+                    self.autoscale (data_exhausted)
+
         except:
             print ("Exception occured in Subprocessor.start(): %s" % (traceback.format_exc()) )
-        
+            self.interrupted = True
+            for p in self.processes:
+                for data_list in p['sent_data'][::-1]:
+                    for data in data_list[::-1]:
+                        self.onHostDataReturn (data)
+                p['sent_data'] = []
+
         self.progress_bar.close()
-        
-        for p in self.processes[:]:
-            p['sq'].put ( {'op': 'close'} )
-            
-        while True:
-            for p in self.processes[:]:
-                while not p['cq'].empty():
-                    obj = p['cq'].get()
-                    obj_op = obj['op']                    
-                    if obj_op == 'finalized':
+
+        for p in self.processes:
+            if p['state'] != 'close_sent':
+                p['sq'].put ( {'op': 'close'} )
+
+        while any ([ p['state'] != 'finalized' for p in self.processes ]):
+            obj = self.get_result (1.0)
+            if obj is None:
+                for p in self.processes[:]:
+                    if not p['process'].is_alive():
                         p['state'] = 'finalized'
-                        
-            if all ([p['state'] == 'finalized' for p in self.processes]):
-                break
-                    
+                continue
+
+            p = self.get_process_by_idx (obj['idx'])
+            if p is not None and obj['op'] == 'finalized':
+                p['state'] = 'finalized'
+
         for p in self.processes[:]:
             p['process'].terminate()
-         
-        self.onHostProcessEnd() 
-         
+
+        self.onHostProcessEnd()
+
         return self.get_start_return()
-         
-    def subprocess(self, sq, cq, client_dict):    
+
+    def start_process(self):
+        #starts process for next info of process_info_generator, returns False if no more infos
+        #info of process closed by autoscale is used again
+        if len(self.closed_process_infos) > 0:
+            name, host_dict, client_dict = self.closed_process_infos.pop(0)
+        else:
+            try:
+                name, host_dict, client_dict = next(self.process_infos)
+            except StopIteration:
+                return False
+
+        sq = multiprocessing.Queue()
+        idx = self.next_process_idx
+        self.next_process_idx += 1
+
+        client_dict.update ( {'print_lock' : self.print_lock} )
+
+        p = multiprocessing.Process(target=self.subprocess, args=(idx,sq,self.result_queue,client_dict))
+        p.daemon = True
+        p.start()
+        self.processes.append ( { 'process' : p,
+                                  'idx' : idx,
+                                  'sq' : sq,
+                                  'state' : 'init',
+                                  'sent_time': time.time(),
+                                  'sent_data': [],
+                                  'rss': None,
+                                  'name': name,
+                                  'host_dict' : host_dict,
+                                  'client_dict' : client_dict
+                                } )
+        return True
+
+    def handle_message(self, obj):
+        p = self.get_process_by_idx (obj['idx'])
+        if p is None:
+            return
+
+        obj_op = obj['op']
+        if obj_op == 'init_ok':
+            p['state'] = 'free'
+            p['rss'] = obj['rss']
+            #throughput is measured with all processes running
+            self.autoscale_reset()
+
+        elif obj_op == 'success':
+            data_list = p['sent_data'][0]
+            result_list = obj['result']
+            p['rss'] = obj['rss']
+
+            #chunk stays sent until all its results are taken, so interrupted host returns it whole
+            c = 0
+            for data, result in zip(data_list, result_list):
+                c += self.onHostResult (data, result)
+            if c > 0:
+                self.progress_bar.update(c)
+
+            if len(result_list) < len(data_list):
+                #client failed in the middle of chunk, remaining data will come back with the error
+                p['sent_data'][0] = data_list[len(result_list):]
+            else:
+                p['sent_data'].pop(0)
+            p['sent_time'] = time.time()
+
+            if len(result_list) > 0:
+                self.update_item_time (obj['process_time'] / len(result_list))
+                self.autoscale_items += len(result_list)
+
+        elif obj_op == 'error':
+            if obj['close'] == True:
+                if p['state'] == 'init':
+                    #process can not be started, keep current pool
+                    self.autoscale_enabled = False
+                self.close_process (p, terminate = p['state'] == 'init')
+            else:
+                if 'data' in obj.keys():
+                    p['sent_data'].pop(0)
+                    for data in obj['data'][::-1]:
+                        self.onHostDataReturn (data)
+                p['sent_time'] = time.time()
+
+        elif obj_op == 'finalized':
+            #process closed by autoscale
+            self.processes.remove(p)
+            self.closed_process_infos.append ( (p['name'], p['host_dict'], p['client_dict']) )
+            p['process'].terminate()
+            p['process'].join()
+
+    def check_processes_at_interval(self):
+        if time.time() >= self.check_time + self.check_interval_sec:
+            self.check_time = time.time()
+            self.check_processes()
+
+    def check_processes(self):
+        for p in self.processes[:]:
+            if p['state'] == 'init' or len(p['sent_data']) > 0:
+                if not p['process'].is_alive():
+                    print ( '%s is terminated unexpectedly.' % (p['name']) )
+                    self.close_process (p, terminate=True)
+                elif len(p['sent_data']) > 0 and time.time() > self.get_deadline(p):
+                    print ( '%s doesnt response, terminating it.' % (p['name']) )
+                    self.close_process (p, terminate=True)
+
+    def autoscale_reset(self):
+        self.autoscale_time = time.time()
+        self.autoscale_items = 0
+
+    def autoscale(self, data_exhausted):
+        #hill climb on throughput for the whole run: one process is added or closed per step,
+        #step is kept if it changed throughput at least by autoscale_min_gain in its favour, otherwise it is reverted,
+        #then pool keeps its size for autoscale_hold_intervals and probes the other direction
+        throughput = self.autoscale_items / (time.time() - self.autoscale_time)
+        self.autoscale_reset()
+
+        #measure only complete pool, started process is waited for init and closed one for its remaining data
+        if any ([ p['state'] in ['init', 'closing', 'close_sent'] for p in self.processes ]):
+            return
+        running = [ p for p in self.processes if p['state'] == 'free' ]
+
+        last_step, last_throughput = self.autoscale_step, self.autoscale_throughput
+        self.autoscale_step = 0
+        self.autoscale_throughput = throughput
+
+        #free memory is kept above autoscale_memory_reserve of the largest process, as reported by processes
+        worker_memory = max ( [ p['rss'] for p in running if p['rss'] is not None ] + [0] )
+        free_memory = os_utils.get_free_memory()
+        low_memory = free_memory is not None and free_memory < worker_memory * self.autoscale_memory_reserve
+        can_start = free_memory is None or free_memory >= worker_memory * (self.autoscale_memory_reserve + 1)
+
+        #data not sent yet, new process needs enough of it to be busy
+        items_left = self.progress_bar.total - self.progress_bar.n - sum ( [ len(x) for p in running for x in p['sent_data'] ] )
+        can_start = can_start and not data_exhausted and len(running) < self.workers_range[1] and \
+                    ( self.progress_bar.total == 0 or items_left > self.get_chunk_size() * self.prefetch_depth )
+        can_close = len(running) > self.workers_range[0]
+
+        if (low_memory or data_exhausted) and can_close:
+            #memory is short or processes without data remain idle till the end
+            idle = [ p for p in running if len(p['sent_data']) == 0 ]
+            self.autoscale_close ( idle[-1] if len(idle) > 0 else running[-1] )
+            self.autoscale_hold = self.autoscale_hold_intervals
+        elif last_step > 0 and throughput < last_throughput * self.autoscale_min_gain:
+            #added process did not help
+            self.autoscale_close (running[-1])
+            self.autoscale_hold = self.autoscale_hold_intervals
+            self.autoscale_direction = -1
+        elif last_step < 0 and throughput * self.autoscale_min_gain < last_throughput:
+            #closed process was needed
+            if can_start:
+                self.start_process()
+            self.autoscale_hold = self.autoscale_hold_intervals
+            self.autoscale_direction = 1
+        elif self.autoscale_hold > 0:
+            self.autoscale_hold -= 1
+        else:
+            #kept step is continued in the same direction
+            direction = last_step if last_step != 0 else self.autoscale_direction
+            if direction > 0 and can_start and self.start_process():
+                self.autoscale_step = 1
+            elif direction < 0 and can_close:
+                self.autoscale_close (running[-1])
+                self.autoscale_step = -1
+            else:
+                self.autoscale_direction = -direction
+                self.autoscale_hold = self.autoscale_hold_intervals
+
+    def autoscale_close(self, p):
+        #process gets no more data and is closed when its sent data is processed
+        p['state'] = 'closing'
+
+    def get_chunk_size(self):
+        if self.chunk_size != 0:
+            return self.chunk_size
+        if self.item_time is None:
+            return 1
+        return int ( np.clip ( self.chunk_target_time_sec / max(self.item_time, 1e-6), 1, self.chunk_max_size ) )
+
+    def update_item_time(self, item_time):
+        #moving average of client process time per item
+        if self.item_time is None:
+            self.item_time = item_time
+        else:
+            self.item_time = self.item_time*0.9 + item_time*0.1
+
+    def get_deadline(self, p):
+        #allow expected process time of the chunk in addition to no_response_time_sec
+        chunk_time = len(p['sent_data'][0]) * self.item_time if self.item_time is not None else 0
+        return p['sent_time'] + self.no_response_time_sec + chunk_time
+
+    def get_result(self, timeout):
+        if len(self.pending_results) > 0:
+            return self.pending_results.pop(0)
+        try:
+            return self.result_queue.get (timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_process_by_idx(self, idx):
+        for p in self.processes:
+            if p['idx'] == idx:
+                return p
+        return None
+
+    def close_process(self, p, terminate=False):
+        #returns all unprocessed data of the process to the host, in original order
+        for data_list in p['sent_data'][::-1]:
+            for data in data_list[::-1]:
+                self.onHostDataReturn (data)
+        p['sent_data'] = []
+        self.processes.remove(p)
+
+        if not terminate:
+            #client stops on error by itself, wait its finalization
+            while p['process'].is_alive():
+                try:
+                    obj = self.result_queue.get (timeout=1.0)
+                except queue.Empty:
+                    continue
+                if obj['idx'] == p['idx'] and obj['op'] == 'finalized':
+                    break
+                self.pending_results.append (obj)
+
+        p['process'].terminate()
+        p['process'].join()
+
+    def subprocess(self, idx, sq, cq, client_dict):
         self.print_lock = client_dict['print_lock']
-        
+        self.client_cq = cq
+
         try:
             fail_message = self.onClientInitialize(client_dict)
         except:
             fail_message = 'Exception while initialization: %s' % (traceback.format_exc())
-    
+
         if fail_message is None:
-            cq.put ( {'op': 'init_ok'} )
+            cq.put ( {'op': 'init_ok', 'idx': idx, 'rss': os_utils.get_process_memory()} )
         else:
             print (fail_message)
-            cq.put ( {'op': 'error', 'close': True} )
-            return 
+            cq.put ( {'op': 'error', 'idx': idx, 'close': True} )
+            return
 
         if 'PYDEVD_DEBUGGING' in os.environ and os.environ['PYDEVD_DEBUGGING']:
             import pydevd
             pydevd.settrace(suspend=False)
 
+        if self.client_prefetch:
+            #prefetch thread takes messages from host and prefetches their data, while previous message is processed
+            prefetched_q = queue.Queue(maxsize=1)
+            prefetch_thread = threading.Thread(target=self.client_prefetch_thread_func, args=(sq, prefetched_q))
+            prefetch_thread.daemon = True
+            prefetch_thread.start()
+            sq = prefetched_q
+
         while True:
             obj = sq.get()
             obj_op = obj['op']
 
             if obj_op == 'data':
-                data = obj['data']
+                data_list = obj['data']
+                result_list = []
+                process_time = time.time()
                 try:
-                    result = self.onClientProcessData (data)                    
-                    cq.put ( {'op': 'success', 'data' : data, 'result' : result} )                    
+                    self.onClientProcessDataList (obj.get('prefetched', data_list), result_list)
+                    self.onClientSendResult ( {'op': 'success', 'idx': idx, 'result' : result_list, 'process_time' : time.time() - process_time, 'rss': os_utils.get_process_memory()} )
                 except:
-                    
+                    data = data_list[ min(len(result_list), len(data_list)-1) ]
                     print ( 'Exception while process data [%s]: %s' % (self.onClientGetDataName(data), traceback.format_exc()) )
-                    cq.put ( {'op': 'error', 'close': True, 'data' : data } )
+                    if len(result_list) > 0:
+                        self.onClientSendResult ( {'op': 'success', 'idx': idx, 'result' : result_list, 'process_time' : time.time() - process_time, 'rss': os_utils.get_process_memory()} )
+                    #host returns unprocessed data it keeps, so data is not sent back
+                    self.onClientSendResult ( {'op': 'error', 'idx': idx, 'close': True} )
+                    break
             elif obj_op == 'close':
                 break
-                
-            time.sleep(0.005)
-                
+
         self.onClientFinalize()
-        cq.put ( {'op': 'finalized'} )
+        cq.put ( {'op': 'finalized', 'idx': idx} )
+        while True:
+            time.sleep(0.1)
+
+    def client_prefetch_thread_func(self, sq, prefetched_q):
         while True:
-            time.sleep(0.1)
\ No newline at end of file
+            obj = sq.get()
+            if obj['op'] == 'data':
+                prefetched = []
+                for data in obj['data']:
+                    try:
+                        prefetched.append ( self.onClientPrefetchData (data) )
+                    except:
+                        #data is processed as is, so its error is reported by onClientProcessData
+                        prefetched.append (data)
+                obj['prefetched'] = prefetched
+            prefetched_q.put (obj)
+            if obj['op'] == 'close':
+                break
@@ -0,0 +1,227 @@
+import os
+import queue
+import threading
+import cv2
+
+video_extensions = [".mp4", ".avi", ".mkv", ".mov", ".m4v", ".webm", ".mpg", ".mpeg", ".wmv"]
+
+#fourcc used by cv2.VideoWriter for output video extension
+video_fourccs = { ".avi" : "XVID", ".mkv" : "XVID" }
+default_fourcc = "mp4v"
+
+def is_video_path(path):
+    return os.path.splitext(str(path))[1].lower() in video_extensions
+
+def get_frame_path(video_path, frame_idx):
+    #frames of video are addressed as files inside of video path, named like ffmpeg frame dumps, numbered from 1
+    return os.path.join ( str(video_path), '%.5d.png' % (frame_idx+1) )
+
+def get_frame_idx(frame_path):
+    return int ( os.path.splitext ( os.path.basename(str(frame_path)) )[0] ) - 1
+
+def split_frame_path(path):
+    #returns (video_path, frame_idx) if path is frame of video file, otherwise None
+    video_path = os.path.dirname(str(path))
+    if is_video_path(video_path) and os.path.isfile(video_path):
+        try:
+            return video_path, get_frame_idx(path)
+        except ValueError:
+            pass
+    return None
+
+def get_source_path(path):
+    #returns file which holds image of path
+    frame = split_frame_path(path)
+    return frame[0] if frame is not None else str(path)
+
+def get_video_info(video_path):
+    #returns (frames count, fps), count is taken from container and may be approximate
+    cap = cv2.VideoCapture ( str(video_path) )
+    count = int ( cap.get(cv2.CAP_PROP_FRAME_COUNT) )
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    return max(0, count), fps
+
+def get_frames_per_memory(frame_path, memory):
+    #returns count of decoded frames of size of frame_path which fit memory, None if frame cannot be read
+    image = imread(frame_path)
+    if image is None:
+        return None
+    return int ( memory // image.nbytes )
+
+def get_frame_paths(video_path):
+    count, _ = get_video_info(video_path)
+    return [ get_frame_path(video_path, i) for i in range(count) ]
+
+class VideoFrame(str):
+    #path of video frame or image file which carries decoded image, sent to subprocessor clients instead of plain path
+    #or made by client prefetch thread, str(frame) gives plain path without image
+
+    def __new__(cls, path, image):
+        obj = str.__new__(cls, path)
+        obj.image = image
+        return obj
+
+    def __reduce__(self):
+        return (VideoFrame, (str(self), self.image) )
+
+def imread(path):
+    #cv2.imread which also reads frames of video
+    if isinstance(path, VideoFrame):
+        return path.image
+
+    frame = split_frame_path(path)
+    if frame is None:
+        return cv2.imread ( str(path) )
+
+    video_path, frame_idx = frame
+    cap = cv2.VideoCapture (video_path)
+    cap.set (cv2.CAP_PROP_POS_FRAMES, frame_idx)
+    ret, image = cap.read()
+    cap.release()
+    return image if ret else None
+
+class VideoFrameSource(object):
+    #decodes requested frames of video on background thread
+    #frames have to be requested in ascending order, other requests are read by seeking
+    #used only by host, pickled copy has no decoder
+
+    def __init__(self, video_path, frame_idxs, prefetch_count=32):
+        self.video_path = str(video_path)
+        self.frame_idxs = sorted(frame_idxs)
+        self.queue = queue.Queue(maxsize=prefetch_count)
+        self.next_item = None
+        self.closing = False
+        self.thread = threading.Thread(target=self.decode_thread_func)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __getstate__(self):
+        return {'video_path': self.video_path}
+
+    def __setstate__(self, d):
+        self.video_path = d['video_path']
+        self.thread = None
+
+    def decode_thread_func(self):
+        cap = cv2.VideoCapture (self.video_path)
+        pos = 0
+        for frame_idx in self.frame_idxs:
+            if self.closing:
+                break
+
+            #skip not requested frames without decoding them
+            while pos < frame_idx and cap.grab():
+                pos += 1
+
+            image = None
+            if pos == frame_idx:
+                ret, image = cap.read()
+                pos += 1
+                if not ret:
+                    image = None
+
+            self.queue.put ( (frame_idx, image) )
+        cap.release()
+
+    def get(self, frame_path):
+        #returns VideoFrame of frame_path
+        frame_idx = get_frame_idx(frame_path)
+        if self.thread is not None:
+            while True:
+                if self.next_item is None:
+                    if not self.thread.is_alive() and self.queue.empty():
+                        break
+                    try:
+                        self.next_item = self.queue.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+
+                idx, image = self.next_item
+                if idx > frame_idx:
+                    break
+                self.next_item = None
+                if idx == frame_idx:
+                    return VideoFrame (frame_path, image)
+
+        return VideoFrame (frame_path, imread(frame_path) )
+
+    def close(self):
+        if self.thread is not None:
+            self.closing = True
+            while self.thread.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.thread = None
+
+class VideoFrameSink(object):
+    #writes frames to video file in order of their positions 0,1,2...
+    #frames may be put in any order, they are held in reorder buffer until all previous frames are written
+    #if more than max_pending frames wait, missing frames before them are skipped
+    #used only by host, pickled copy has no writer
+
+    max_pending = 64
+
+    def __init__(self, video_path, fps):
+        self.video_path = str(video_path)
+        self.fps = fps if fps is not None and fps > 0 else 25
+        self.fourcc = video_fourccs.get ( os.path.splitext(self.video_path)[1].lower(), default_fourcc )
+        self.pending = {}
+        self.next_position = 0
+        self.queue = queue.Queue(maxsize=32)
+        self.thread = threading.Thread(target=self.write_thread_func)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __getstate__(self):
+        return {'video_path': self.video_path}
+
+    def __setstate__(self, d):
+        self.video_path = d['video_path']
+        self.thread = None
+
+    def write_thread_func(self):
+        writer = None
+        size = None
+        while True:
+            image = self.queue.get()
+            if image is None:
+                break
+            if writer is None:
+                size = (image.shape[1], image.shape[0])
+                writer = cv2.VideoWriter (self.video_path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, size)
+            if (image.shape[1], image.shape[0]) != size:
+                image = cv2.resize (image, size)
+            writer.write (image)
+        if writer is not None:
+            writer.release()
+
+    def put(self, position, image):
+        #image - uint8 BGR, None if frame has no output and is skipped
+        if position < self.next_position:
+            print ("Frame %d came after frames behind it were written, skipped." % (position) )
+            return
+        self.pending[position] = image
+        while len(self.pending) > 0:
+            if self.next_position not in self.pending:
+                if len(self.pending) <= VideoFrameSink.max_pending:
+                    break
+                print ("Frame %d is late, skipped." % (self.next_position) )
+            else:
+                image = self.pending.pop(self.next_position)
+                if image is not None:
+                    self.queue.put (image)
+            self.next_position += 1
+
+    def close(self):
+        #missing frames are skipped
+        for position in sorted(self.pending.keys()):
+            image = self.pending.pop(position)
+            if image is not None:
+                self.queue.put (image)
+        if self.thread is not None:
+            self.queue.put (None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,51 @@
+import pickle
+from collections import deque
+from pathlib import Path
+
+class WorkQueue(object):
+    #FIFO of work items for subprocessor hosts
+    #returned items go to the priority lane and are given out before the remaining items
+
+    def __init__(self, items=None):
+        self.items = deque(items if items is not None else [])
+        self.returned = deque()
+
+    def __len__(self):
+        return len(self.returned) + len(self.items)
+
+    def __iter__(self):
+        #remaining items in order they are given out, without taking them
+        return iter ( list(self.returned) + list(self.items) )
+
+    def put(self, item):
+        self.items.append (item)
+
+    def put_front(self, item):
+        #item is given out next, before any previously returned item
+        self.returned.appendleft (item)
+
+    def get(self):
+        #returns None if queue is empty
+        if len(self.returned) > 0:
+            return self.returned.popleft()
+        if len(self.items) > 0:
+            return self.items.popleft()
+        return None
+
+    def peek(self):
+        if len(self.returned) > 0:
+            return self.returned[0]
+        if len(self.items) > 0:
+            return self.items[0]
+        return None
+
+    def save(self, filepath):
+        #saves remaining items, so interrupted run can be resumed with WorkQueue.load
+        filepath = Path(filepath)
+        tmp_filepath = Path( str(filepath) + '.tmp' )
+        tmp_filepath.write_bytes ( pickle.dumps ( list(self) ) )
+        tmp_filepath.replace (filepath)
+
+    @staticmethod
+    def load(filepath):
+        return WorkQueue ( pickle.loads ( Path(filepath).read_bytes() ) )
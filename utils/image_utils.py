@@ -6,48 +6,51 @@ import localization
 from scipy.spatial import Delaunay
 from PIL import Image, ImageDraw, ImageFont
 
-def channel_hist_match(source, template, mask=None):
-    # Code borrowed from:
-    # https://stackoverflow.com/questions/32655686/histogram-matching-of-two-images-in-python-2-x
-    masked_source = source
-    masked_template = template
+def hist_match(source, template, mask=None, bins=1024):
+    #maps values of source, so histogram of each channel matches histogram of the same channel of template
+    #source (N,C), template (M,C), mask - weights of pixels of both source and template (N,) or None
+    #histograms have fixed count of bins over common value range of all channels and all channels are counted by single bincount,
+    #each source bin is mapped to template value at cumulative histogram of the bin, which is looked up by np.interp
+    c = source.shape[1]
+    lo = min ( source.min(), template.min() )
+    hi = max ( source.max(), template.max() )
+    scale = bins / max (hi - lo, 1e-6)
+    weights = None if mask is None else np.repeat (mask.ravel(), c)
 
-    if mask is not None:
-        masked_source = source * mask
-        masked_template = template * mask
+    def bin_idxs(x):
+        idx = ( (x - lo) * scale ).astype(np.int32)
+        np.minimum (idx, bins-1, out=idx)
+        idx += np.arange(c, dtype=np.int32) * bins
+        return idx.ravel()
 
-    oldshape = source.shape
-    source = source.ravel()
-    template = template.ravel()
-    masked_source = masked_source.ravel()
-    masked_template = masked_template.ravel()
-    s_values, bin_idx, s_counts = np.unique(source, return_inverse=True,
-                                            return_counts=True)
-    t_values, t_counts = np.unique(template, return_counts=True)
-    ms_values, mbin_idx, ms_counts = np.unique(source, return_inverse=True,
-                                            return_counts=True)
-    mt_values, mt_counts = np.unique(template, return_counts=True)
+    s_idx = bin_idxs(source)
+    t_idx = bin_idxs(template)
+    s_hist = np.bincount (s_idx, weights=weights, minlength=c*bins).reshape ( (c,bins) )
+    t_hist = np.bincount (t_idx, weights=weights, minlength=c*bins).reshape ( (c,bins) )
+    #mean template value of each bin, so spikes of equal values are mapped exactly
+    t_sum  = np.bincount (t_idx, weights=template.ravel() if weights is None else template.ravel()*weights, minlength=c*bins).reshape ( (c,bins) )
+
+    s_cdf = np.cumsum (s_hist, axis=1)
+    t_cdf = np.cumsum (t_hist, axis=1)
+    if s_cdf[:,-1].min() <= 0 or t_cdf[:,-1].min() <= 0:
+        return source.copy()
 
-    s_quantiles = np.cumsum(s_counts).astype(np.float64)
-    s_quantiles /= s_quantiles[-1]
-    t_quantiles = np.cumsum(t_counts).astype(np.float64)
-    t_quantiles /= t_quantiles[-1]
-    interp_t_values = np.interp(s_quantiles, t_quantiles, t_values)
+    lut = np.empty ( (c, bins), dtype=source.dtype )
+    for ch in range(c):
+        nz = np.nonzero (t_hist[ch])[0]
+        lut[ch] = np.interp (s_cdf[ch] / s_cdf[ch,-1], t_cdf[ch,nz] / t_cdf[ch,-1], t_sum[ch,nz] / t_hist[ch,nz])
 
-    return interp_t_values[bin_idx].reshape(oldshape)    
+    return lut.ravel()[s_idx].reshape (source.shape)
+
+def channel_hist_match(source, template, mask=None):
+    oldshape = source.shape
+    return hist_match ( source.reshape( (-1,1) ), template.reshape( (-1,1) ), mask ).reshape(oldshape)
 
 def color_hist_match(src_im, tar_im, mask=None):
+    #matches BGR channels, other channels of src_im are kept
     h,w,c = src_im.shape
-    matched_R = channel_hist_match(src_im[:,:,0], tar_im[:,:,0], mask)
-    matched_G = channel_hist_match(src_im[:,:,1], tar_im[:,:,1], mask)
-    matched_B = channel_hist_match(src_im[:,:,2], tar_im[:,:,2], mask)
-    
-    to_stack = (matched_R, matched_G, matched_B)
-    for i in range(3, c):
-        to_stack += ( src_im[:,:,i],)
-    
-    
-    matched = np.stack(to_stack, axis=-1).astype(src_im.dtype)
+    matched = src_im.copy()
+    matched[:,:,0:3] = hist_match ( src_im[:,:,0:3].reshape( (-1,3) ), tar_im[:,:,0:3].reshape( (-1,3) ), mask ).reshape( (h,w,3) )
     return matched
     
 
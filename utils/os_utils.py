@@ -1,4 +1,6 @@
 import sys
+import os
+import ctypes
 
 if sys.platform[0:3] == 'win':
     from ctypes import windll
@@ -15,4 +17,103 @@ def set_process_lowest_prio():
         
 def set_process_dpi_aware():
     if sys.platform[0:3] == 'win':
-        windll.user32.SetProcessDPIAware(True)
\ No newline at end of file
+        windll.user32.SetProcessDPIAware(True)
+
+def get_process_memory():
+    #returns resident memory of current process in bytes, or None if unknown
+    try:
+        if sys.platform[0:3] == 'win':
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [ ('cb', wintypes.DWORD),
+                             ('PageFaultCount', wintypes.DWORD),
+                             ('PeakWorkingSetSize', ctypes.c_size_t),
+                             ('WorkingSetSize', ctypes.c_size_t),
+                             ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                             ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                             ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                             ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                             ('PagefileUsage', ctypes.c_size_t),
+                             ('PeakPagefileUsage', ctypes.c_size_t) ]
+            GetCurrentProcess = windll.kernel32.GetCurrentProcess
+            GetCurrentProcess.restype = wintypes.HANDLE
+            GetProcessMemoryInfo = windll.psapi.GetProcessMemoryInfo
+            GetProcessMemoryInfo.argtypes = (wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD)
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+            GetProcessMemoryInfo ( GetCurrentProcess(), ctypes.byref(counters), counters.cb )
+            return counters.WorkingSetSize
+
+        if os.path.exists('/proc/self/statm'):
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+        #peak resident memory, kilobytes on linux, bytes on macOS
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+    except:
+        return None
+
+def is_process_alive(pid):
+    #True if process with pid is running, also for process which is not child of current one
+    if sys.platform[0:3] == 'win':
+        OpenProcess = windll.kernel32.OpenProcess
+        OpenProcess.restype = wintypes.HANDLE
+        GetExitCodeProcess = windll.kernel32.GetExitCodeProcess
+        GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+        CloseHandle = windll.kernel32.CloseHandle
+        CloseHandle.argtypes = (wintypes.HANDLE,)
+
+        #PROCESS_QUERY_LIMITED_INFORMATION
+        handle = OpenProcess (0x1000, False, pid)
+        if not handle:
+            return False
+        exit_code = wintypes.DWORD()
+        GetExitCodeProcess (handle, ctypes.byref(exit_code))
+        CloseHandle (handle)
+        #STILL_ACTIVE
+        return exit_code.value == 259
+
+    try:
+        os.kill (pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    #terminated child which is not joined yet is zombie
+    if os.path.exists('/proc/%d/stat' % (pid)):
+        try:
+            with open('/proc/%d/stat' % (pid)) as f:
+                return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+        except:
+            pass
+    return True
+
+def get_free_memory():
+    #returns available physical memory in bytes, or None if unknown
+    try:
+        if sys.platform[0:3] == 'win':
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [ ('dwLength', wintypes.DWORD),
+                             ('dwMemoryLoad', wintypes.DWORD),
+                             ('ullTotalPhys', ctypes.c_ulonglong),
+                             ('ullAvailPhys', ctypes.c_ulonglong),
+                             ('ullTotalPageFile', ctypes.c_ulonglong),
+                             ('ullAvailPageFile', ctypes.c_ulonglong),
+                             ('ullTotalVirtual', ctypes.c_ulonglong),
+                             ('ullAvailVirtual', ctypes.c_ulonglong),
+                             ('ullAvailExtendedVirtual', ctypes.c_ulonglong) ]
+            stat = MEMORYSTATUSEX()
+            stat.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            windll.kernel32.GlobalMemoryStatusEx ( ctypes.byref(stat) )
+            return stat.ullAvailPhys
+
+        if os.path.exists('/proc/meminfo'):
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except:
+        return None